@@ -0,0 +1,50 @@
+# embeddings throughput: one request per chunk (old path) vs BatchEmbedder.
+# meant to run against the local fake server from rag_monitoring_service:
+#
+#   python fake_openai.py --port 8100 --latency-ms 80
+#   OPENAI_BASE_URL=http://localhost:8100/v1 OPEN_AI_API_KEY=fake python bench_embed.py --chunks 2000
+
+import os
+import time
+import random
+import argparse
+from openai import OpenAI
+from embedder import BatchEmbedder
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+WORDS = ["амонит", "мегалодон", "зъб", "фосил", "белемнит", "трилобит", "кристал", "размер", "см", "цена"]
+
+
+def synthetic_chunks(count: int, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 200))) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=1000)
+    parser.add_argument("--serial-chunks", type=int, default=100, dest="serial_chunks")
+    parser.add_argument("--batch-size", type=int, default=256, dest="batch_size")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    client = OpenAI(api_key=os.getenv("OPEN_AI_API_KEY"))
+    chunks = synthetic_chunks(args.chunks)
+
+    t0 = time.perf_counter()
+    for chunk in chunks[:args.serial_chunks]:
+        client.embeddings.create(model=EMBEDDING_MODEL, input=chunk)
+    serial_rate = args.serial_chunks / (time.perf_counter() - t0)
+
+    embedder = BatchEmbedder(client, EMBEDDING_MODEL, max_items=args.batch_size, concurrency=args.concurrency)
+    t0 = time.perf_counter()
+    vectors = embedder.embed_many(chunks)
+    batched_rate = len(vectors) / (time.perf_counter() - t0)
+
+    print(f"serial:  {serial_rate:.1f} chunks/s ({args.serial_chunks} chunks, 1 request each)")
+    print(f"batched: {batched_rate:.1f} chunks/s ({len(vectors)} chunks, {embedder.stats['requests']} requests, "
+          f"{embedder.stats['retries']} retries)")
+
+
+if __name__ == "__main__":
+    main()
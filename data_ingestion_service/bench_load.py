@@ -0,0 +1,55 @@
+# rows/sec of the per-row INSERT path vs the COPY + merge path, with synthetic
+# records and random vectors (no embeddings calls). the rows are removed afterwards.
+#
+#   python bench_load.py --rows 5000
+
+import time
+import random
+import argparse
+from sqlalchemy import text
+from ingestor import DataIngestor, ProductEmbedding, EMBEDDING_DIM
+
+
+def synthetic_records(prefix: str, count: int, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    return [
+        {
+            "id": f"{prefix}{i}_0",
+            "name": f"bench product {i}",
+            "url": f"https://example.com/4-fosili/{i}-bench",
+            "price": round(rng.uniform(1, 500), 2),
+            "chunk_index": 0,
+            "text": f"bench product {i} " * 20,
+            "embedding": [rng.uniform(-1, 1) for _ in range(EMBEDDING_DIM)]
+        }
+        for i in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2000)
+    args = parser.parse_args()
+
+    ingestor = DataIngestor()
+    results = {}
+    try:
+        records = synthetic_records("bench-insert-", args.rows)
+        t0 = time.perf_counter()
+        ingestor.write_records(records)
+        results["insert"] = args.rows / (time.perf_counter() - t0)
+
+        records = synthetic_records("bench-copy-", args.rows)
+        t0 = time.perf_counter()
+        ingestor.loader.load([records])
+        results["copy"] = args.rows / (time.perf_counter() - t0)
+    finally:
+        with ingestor.engine.begin() as conn:
+            conn.execute(text(f"DELETE FROM {ProductEmbedding.__tablename__} WHERE id LIKE 'bench-%'"))
+
+    for mode, rate in results.items():
+        print(f"{mode}: {rate:.0f} rows/s ({args.rows} rows)")
+
+
+if __name__ == "__main__":
+    main()
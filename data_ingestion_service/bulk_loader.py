@@ -0,0 +1,81 @@
+# bulk load path for the embeddings table: records are streamed with COPY
+# into a temporary staging table and upserted with one set-based INSERT ... SELECT,
+# all in a single transaction. a few round trips instead of one per chunk.
+
+import io
+import time
+from typing import Iterable, Tuple
+
+COPY_COLUMNS = ("id", "name", "url", "price", "chunk_index", "text", "embedding", "product_id", "content_hash")
+
+
+def copy_value(value) -> str:
+    # text format of COPY: \N for NULL, backslash escapes for the rest
+    if value is None:
+        return r"\N"
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(map(str, value)) + "]"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_buffer(records: list, columns=COPY_COLUMNS) -> io.StringIO:
+    buf = io.StringIO()
+    for record in records:
+        buf.write("\t".join(copy_value(record.get(col)) for col in columns))
+        buf.write("\n")
+    buf.seek(0)
+    return buf
+
+
+class BulkLoader:
+    def __init__(self, engine, table: str = "fosils_embeddings"):
+        self.engine = engine
+        self.table = table
+        self.stage = f"{table}_stage"
+
+    def merge_sql(self) -> str:
+        # rows whose product hash did not change are left untouched
+        cols = ", ".join(COPY_COLUMNS)
+        updates = ", ".join(f"{col} = EXCLUDED.{col}" for col in COPY_COLUMNS if col != "id")
+        return (
+            f"INSERT INTO {self.table} ({cols}) "
+            f"SELECT DISTINCT ON (id) {cols} FROM {self.stage} ORDER BY id "
+            f"ON CONFLICT (id) DO UPDATE SET {updates} "
+            f"WHERE {self.table}.content_hash IS DISTINCT FROM EXCLUDED.content_hash"
+        )
+
+    def load(self, record_batches: Iterable[list]) -> Tuple[int, float]:
+        # returns (rows copied, seconds spent in the database)
+        cols = ", ".join(COPY_COLUMNS)
+        rows, db_seconds = 0, 0.0
+        conn = self.engine.raw_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                f"CREATE TEMP TABLE {self.stage} (LIKE {self.table} INCLUDING DEFAULTS) ON COMMIT DROP"
+            )
+            for records in record_batches:
+                if not records:
+                    continue
+                buf = copy_buffer(records)
+                t0 = time.perf_counter()
+                cur.copy_expert(f"COPY {self.stage} ({cols}) FROM STDIN", buf)
+                db_seconds += time.perf_counter() - t0
+                rows += len(records)
+
+            t0 = time.perf_counter()
+            cur.execute(self.merge_sql())
+            conn.commit()
+            db_seconds += time.perf_counter() - t0
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return rows, db_seconds
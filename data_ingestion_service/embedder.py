@@ -0,0 +1,86 @@
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+
+def estimate_tokens(text: str) -> int:
+    # cheap upper bound for the openai tokenizers on mixed bulgarian/latin text
+    return len(text) // 2 + 1
+
+
+class BatchEmbedder:
+    # packs many texts into few embeddings requests (bounded by item count and
+    # estimated tokens), keeps several requests in flight and returns the
+    # vectors in the order of the input texts
+
+    def __init__(self, client, model: str, max_items: int = 256, max_tokens: int = 100000,
+                 concurrency: int = 4, retries: int = 5,
+                 count_tokens: Callable[[str], int] = estimate_tokens):
+        self.client = client
+        self.model = model
+        self.max_items = max_items
+        self.max_tokens = max_tokens
+        self.concurrency = concurrency
+        self.retries = retries
+        self.count_tokens = count_tokens
+        self.stats = {"requests": 0, "texts": 0, "retries": 0, "seconds": 0.0}
+        self.lock = threading.Lock()
+
+    def make_batches(self, texts: List[str]) -> List[List[int]]:
+        batches, current, current_tokens = [], [], 0
+        for i, text in enumerate(texts):
+            tokens = self.count_tokens(text)
+            if current and (len(current) >= self.max_items or current_tokens + tokens > self.max_tokens):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def embed_batch(self, texts: List[str]) -> List[list]:
+        for attempt in range(self.retries + 1):
+            try:
+                resp = self.client.embeddings.create(model=self.model, input=texts)
+                with self.lock:
+                    self.stats["requests"] += 1
+                return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.retries:
+                    raise
+                with self.lock:
+                    self.stats["retries"] += 1
+                delay = self.retry_delay(e, attempt)
+                print(f"Embeddings request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def retry_delay(self, error: Exception, attempt: int) -> float:
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            return min(30.0, 0.5 * 2 ** attempt) * (0.5 + random.random())
+
+    def embed_many(self, texts: List[str]) -> List[list]:
+        if not texts:
+            return []
+        t0 = time.perf_counter()
+        vectors = [None] * len(texts)
+        batches = self.make_batches(texts)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            results = pool.map(lambda batch: self.embed_batch([texts[i] for i in batch]), batches)
+            for batch, batch_vectors in zip(batches, results):
+                for i, vector in zip(batch, batch_vectors):
+                    vectors[i] = vector
+
+        self.stats["texts"] += len(texts)
+        self.stats["seconds"] += time.perf_counter() - t0
+        return vectors
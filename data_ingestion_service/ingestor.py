@@ -1,18 +1,72 @@
 import os
 import json
+import time
+import hashlib
 from pathlib import Path
 from openai import OpenAI
-from sqlalchemy import create_engine, Column, String, Float, Integer
+from sqlalchemy import create_engine, text, Column, String, Float, Integer
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.types import UserDefinedType
 from sqlalchemy_utils import database_exists, create_database
+from embedder import BatchEmbedder
+from embedding_cache import EmbeddingCache
+from embedding_provider import get_provider
+from bulk_loader import BulkLoader
+from snapshot import export_snapshot
+from shard_reader import load_manifest, iter_shard_entries
 
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
-EMBEDDING_DIM = 1536 if "large" in EMBEDDING_MODEL else 1536
+# the vector column follows the provider (openai model or local hashing-<dim>)
+EMBEDDING_DIM = get_provider(EMBEDDING_MODEL).dim
+# one table per embedding model, so the monitoring sweep can compare models side by side
+EMBEDDING_TABLE = os.getenv("EMBEDDING_TABLE", "fosils_embeddings")
 PG_URI = os.getenv("PG_URI", "postgresql://postgres:postgres@db:5432/postgres")
+# batching of the embeddings requests, openai allows up to 2048 inputs / 300k tokens per request
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "100000"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_RETRIES = int(os.getenv("EMBED_RETRIES", "5"))
+# how many processed files are pooled together before embedding + writing
+INGEST_FILES_PER_BATCH = int(os.getenv("INGEST_FILES_PER_BATCH", "500"))
+# "files" reads one json per product, "shards" the JSONL shards of the processor,
+# "auto" the shards when the processor wrote a manifest
+INGEST_SOURCE = os.getenv("INGEST_SOURCE", "auto")
+# "copy" streams everything through COPY + one merge, "insert" is the old per-row path
+INGEST_MODE = os.getenv("INGEST_MODE", "copy")
+# ANN index on the embeddings: "hnsw", "ivfflat" or "none" (exact scans only);
+# pgvector indexes vector columns of up to 2000 dimensions
+VECTOR_INDEX = os.getenv("VECTOR_INDEX", "hnsw")
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+# 0 = pick from the row count (rows / 1000, sqrt(rows) above 1M rows)
+IVFFLAT_LISTS = int(os.getenv("IVFFLAT_LISTS", "0"))
+# "halfvec" and/or "binary" (comma separated) keep quantized copies of the
+# embedding in generated columns, each with its own ANN index, for a compact
+# first pass that the queries re-rank on the full vectors (pgvector >= 0.7)
+VECTOR_QUANTIZATION = [q.strip() for q in os.getenv("VECTOR_QUANTIZATION", "none").split(",") if q.strip() not in ("", "none")]
+# the full precision index is what the quantized ones replace
+FULL_VECTOR_INDEX = os.getenv("FULL_VECTOR_INDEX", "0" if VECTOR_QUANTIZATION else "1") == "1"
+# pg_trgm indexes on name/text and btree indexes on url/price for the hybrid retrieval mode
+LEXICAL_INDEX = os.getenv("LEXICAL_INDEX", "1") == "1"
+# one row per product, the websocket service answers count/price aggregates from it
+PRODUCTS_VIEW = os.getenv(
+    "PRODUCTS_VIEW", "fosils_products" if EMBEDDING_TABLE == "fosils_embeddings" else f"{EMBEDDING_TABLE}_products"
+)
+# the websocket service LISTENs here to drop its cached search results
+NOTIFY_CHANNEL = os.getenv("NOTIFY_CHANNEL", "fosils_embeddings_changed")
+# publish a numpy snapshot of the table after every load that changed rows
+SNAPSHOT_EXPORT = os.getenv("SNAPSHOT_EXPORT", "0") == "1"
+# delete rows of products that are no longer in the processed dir on a full run
+INGEST_DELETE_MISSING = os.getenv("INGEST_DELETE_MISSING", "1") == "1"
 Base = declarative_base()
 
+# kind -> (column, type, expression, index operator class, max indexed dimensions)
+QUANTIZED_COLUMNS = {
+    "halfvec": ("embedding_half", "halfvec", "embedding::halfvec({dim})", "halfvec_cosine_ops", 4000),
+    "binary": ("embedding_bit", "bit", "binary_quantize(embedding)::bit({dim})", "bit_hamming_ops", 64000)
+}
+
 class Vector(UserDefinedType):
     def __init__(self, dimensions=1536):
         self.dimensions = dimensions
@@ -24,57 +78,362 @@ class Vector(UserDefinedType):
         return col
 
 class ProductEmbedding(Base):
-    __tablename__ = "fosils_embeddings"
+    __tablename__ = EMBEDDING_TABLE
     id = Column(String, primary_key=True)
     name = Column(String)
     url = Column(String)
     price = Column(Float)
     chunk_index = Column(Integer)
     text = Column(String)
-    embedding = Column(Vector(1536))
+    embedding = Column(Vector(EMBEDDING_DIM))
+    product_id = Column(String, index=True)
+    # hash of the whole processed product, the same on all of its chunks
+    content_hash = Column(String)
+
+
+def product_hash(data: dict) -> str:
+    # the processor's shard manifest carries the same hash (shard_writer.py there)
+    payload = json.dumps(
+        {key: data.get(key) for key in ("id", "name", "price", "url", "chunks")},
+        sort_keys=True, ensure_ascii=False, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
 
 class DataIngestor:
     def __init__(self, processed_dir="/data/processed/fosili"):
         self.processed_dir = Path(processed_dir)
-        self.client = OpenAI(api_key=os.getenv("OPEN_AI_API_KEY"))
+        self.provider = get_provider(EMBEDDING_MODEL)
+        if self.provider.kind == "openai":
+            self.provider.client = OpenAI(api_key=os.getenv("OPEN_AI_API_KEY"))
+            self.embedder = BatchEmbedder(
+                self.provider.client,
+                EMBEDDING_MODEL,
+                max_items=EMBED_BATCH_SIZE,
+                max_tokens=EMBED_BATCH_TOKENS,
+                concurrency=EMBED_CONCURRENCY,
+                retries=EMBED_RETRIES
+            )
+        else:
+            # local backends batch on their own process pool
+            self.embedder = self.provider
+        self.cache = EmbeddingCache(self.provider.name)
         self.engine = create_engine(PG_URI)
         if not database_exists(self.engine.url):
             create_database(self.engine.url)
         Base.metadata.create_all(self.engine)
+        self.ensure_schema()
         self.Session = sessionmaker(bind=self.engine)
+        self.loader = BulkLoader(self.engine, ProductEmbedding.__tablename__)
 
     def embed_text(self, text: str) -> list:
-        resp = self.client.embeddings.create(
-            model=EMBEDDING_MODEL,
-            input=text
-        )
-        return resp.data[0].embedding
+        return self.cache.embed_many([text], self.embedder.embed_many)[0]
 
-    def ingest_file(self, filepath: Path):
+    def ensure_schema(self):
+        # create_all does not add columns to a table created by an older version
+        table = ProductEmbedding.__tablename__
+        with self.engine.begin() as conn:
+            # pgvector keeps the dimension in the column's typmod
+            dim = conn.execute(text(
+                "SELECT atttypmod FROM pg_attribute WHERE attrelid = to_regclass(:table) AND attname = 'embedding'"
+            ), {"table": table}).scalar()
+            if dim is not None and dim > 0 and dim != EMBEDDING_DIM:
+                raise ValueError(
+                    f"{table}.embedding is vector({dim}) but {EMBEDDING_MODEL} gives {EMBEDDING_DIM} dimensions, "
+                    f"ingest it into another EMBEDDING_TABLE"
+                )
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS product_id VARCHAR"))
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS content_hash VARCHAR"))
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_product_id ON {table} (product_id)"))
+            self.ensure_quantized_columns(conn)
+            conn.execute(text(
+                f"UPDATE {table} SET product_id = regexp_replace(id, '_[0-9]+$', '') WHERE product_id IS NULL"
+            ))
+            # all chunks of a product carry the same name/url/price, the first one represents it
+            conn.execute(text(
+                f"CREATE MATERIALIZED VIEW IF NOT EXISTS {PRODUCTS_VIEW} AS "
+                f"SELECT DISTINCT ON (product_id) product_id, name, url, price "
+                f"FROM {table} ORDER BY product_id, chunk_index"
+            ))
+            # the unique index allows REFRESH ... CONCURRENTLY, readers are never blocked
+            conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS {PRODUCTS_VIEW}_product_id_idx ON {PRODUCTS_VIEW} (product_id)"))
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {PRODUCTS_VIEW}_price_idx ON {PRODUCTS_VIEW} (price)"))
+
+    def ensure_quantized_columns(self, conn):
+        # generated columns, so the loaders keep writing only the full vector
+        table = ProductEmbedding.__tablename__
+        unknown = set(VECTOR_QUANTIZATION) - set(QUANTIZED_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown VECTOR_QUANTIZATION {sorted(unknown)}, use {sorted(QUANTIZED_COLUMNS)}")
+        if VECTOR_QUANTIZATION:
+            # halfvec and binary_quantize came with pgvector 0.7
+            conn.execute(text("ALTER EXTENSION vector UPDATE"))
+        for kind, (column, type_, expression, _, _) in QUANTIZED_COLUMNS.items():
+            if kind in VECTOR_QUANTIZATION:
+                conn.execute(text(
+                    f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {type_}({EMBEDDING_DIM}) "
+                    f"GENERATED ALWAYS AS ({expression.format(dim=EMBEDDING_DIM)}) STORED"
+                ))
+            else:
+                conn.execute(text(f"ALTER TABLE {table} DROP COLUMN IF EXISTS {column}"))
+
+    def refresh_products_view(self):
+        t0 = time.perf_counter()
+        with self.engine.begin() as conn:
+            conn.execute(text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {PRODUCTS_VIEW}"))
+        print(f"Refreshed {PRODUCTS_VIEW} in {time.perf_counter() - t0:.2f}s")
+
+    def existing_products(self) -> dict:
+        # product_id -> (content_hash, chunk count), None hash if the chunks disagree
+        table = ProductEmbedding.__tablename__
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(
+                f"SELECT product_id, min(content_hash), max(content_hash), count(*) "
+                f"FROM {table} GROUP BY product_id"
+            ))
+            return {pid: (lo if lo == hi else None, n) for pid, lo, hi, n in rows}
+
+    def load_product(self, filepath: Path) -> dict:
         with open(filepath, "r", encoding="utf-8") as f:
-            data = json.load(f)
+            return json.load(f)
+
+    def product_records(self, data: dict) -> list:
+        digest = product_hash(data)
+        return [
+            {
+                "id": f"{data['id']}_{idx}",
+                "name": data["name"],
+                "url": data["url"],
+                "price": data["price"],
+                "chunk_index": idx,
+                "text": chunk,
+                "product_id": str(data["id"]),
+                "content_hash": digest
+            }
+            for idx, chunk in enumerate(data.get("chunks", []))
+        ]
+
+    def load_records(self, filepath: Path) -> list:
+        return self.product_records(self.load_product(filepath))
+
+    def embed_records(self, records: list):
+        # one pass over all records, vectors come back in the same order;
+        # only texts missing from the embedding cache reach the api
+        vectors = self.cache.embed_many([r["text"] for r in records], self.embedder.embed_many)
+        for record, vector in zip(records, vectors):
+            record["embedding"] = vector
+
+    def write_records(self, records: list):
         session = self.Session()
         try:
-            for idx, chunk in enumerate(data.get("chunks", [])):
-                embedding = self.embed_text(chunk)
-                record_dict = {
-                    "id": f"{data['id']}_{idx}",
-                    "name": data["name"],
-                    "url": data["url"],
-                    "price": data["price"],
-                    "chunk_index": idx,
-                    "text": chunk,
-                    "embedding": embedding
-                }
+            for record_dict in records:
                 stmt = insert(ProductEmbedding).values(**record_dict)
-                stmt = stmt.on_conflict_do_nothing(index_elements=["id"])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=["id"],
+                    set_={k: stmt.excluded[k] for k in record_dict if k != "id"}
+                )
                 session.execute(stmt)
             session.commit()
-            print(f"Ingested {filepath.name} ({len(data.get('chunks', []))} chunks)")
         finally:
             session.close()
 
+    def ingest_file(self, filepath: Path):
+        records = self.load_records(filepath)
+        self.embed_records(records)
+        self.write_records(records)
+        print(f"Ingested {filepath.name} ({len(records)} chunks)")
+
+    def delete_stale(self, chunk_counts: dict, seen: set = None) -> int:
+        # chunks past the new chunk count of a changed product, plus (on a full
+        # run) every product that is not among the processed files anymore
+        table = ProductEmbedding.__tablename__
+        deleted = 0
+        with self.engine.begin() as conn:
+            if chunk_counts:
+                deleted += conn.execute(text(
+                    f"DELETE FROM {table} e "
+                    f"USING (SELECT unnest(CAST(:pids AS text[])) AS product_id, "
+                    f"unnest(CAST(:counts AS int[])) AS chunk_count) c "
+                    f"WHERE e.product_id = c.product_id AND e.chunk_index >= c.chunk_count"
+                ), {"pids": list(chunk_counts), "counts": list(chunk_counts.values())}).rowcount
+            if seen:
+                deleted += conn.execute(text(
+                    f"DELETE FROM {table} WHERE NOT (product_id = ANY(CAST(:pids AS text[])))"
+                ), {"pids": list(seen)}).rowcount
+        return deleted
+
+    def notify_changed(self, upserted: int, deleted: int):
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": NOTIFY_CHANNEL, "payload": json.dumps({"upserted": upserted, "deleted": deleted})}
+            )
+
+    def publish_changes(self, upserted: int, deleted: int):
+        # the products view, the numpy snapshot and the websocket caches follow the table
+        if not (upserted or deleted):
+            return
+        self.refresh_products_view()
+        if SNAPSHOT_EXPORT:
+            export_snapshot(self.engine, ProductEmbedding.__tablename__)
+        self.notify_changed(upserted, deleted)
+
+    def iter_file_entries(self, files: list):
+        # (product id, content hash, chunk count, product) of per-product json files
+        for f in files:
+            data = self.load_product(f)
+            yield str(data["id"]), product_hash(data), len(data.get("chunks", [])), data
+
+    def iter_record_batches(self, entries, existing: dict, chunk_counts: dict, seen: set,
+                            per_batch: int = INGEST_FILES_PER_BATCH):
+        # embedded records of new/changed products, per_batch products at a
+        # time; unchanged products are skipped before any embeddings call
+        # (shard lines of unchanged products aren't even parsed). a None entry
+        # flushes the pending products early (the worker sends one when its
+        # input queue runs dry)
+        records, group = [], 0
+        for entry in entries:
+            if entry is not None:
+                pid, digest, n_chunks, product = entry
+                seen.add(pid)
+                group += 1
+                if existing.get(pid) != (digest, n_chunks):
+                    chunk_counts[pid] = n_chunks
+                    data = json.loads(product) if isinstance(product, str) else product
+                    records.extend(self.product_records(data))
+            if group >= per_batch or (entry is None and group):
+                if records:
+                    yield self.embed_batch(records, group)
+                records, group = [], 0
+        if records:
+            yield self.embed_batch(records, group)
+
+    def embed_batch(self, records: list, products: int) -> list:
+        self.embed_records(records)
+        print(f"Embedded {len(records)} chunks of changed products from {products} products")
+        return records
+
+    def ingest_products(self, entries, full: bool = True):
+        existing = self.existing_products()
+        chunk_counts, seen = {}, set()
+        batches = self.iter_record_batches(entries, existing, chunk_counts, seen)
+
+        if INGEST_MODE == "insert":
+            rows, db_seconds = 0, 0.0
+            for records in batches:
+                t0 = time.perf_counter()
+                self.write_records(records)
+                db_seconds += time.perf_counter() - t0
+                rows += len(records)
+        else:
+            rows, db_seconds = self.loader.load(batches)
+        if db_seconds:
+            print(f"Wrote {rows} rows in {db_seconds:.2f}s ({rows / db_seconds:.0f} rows/s, mode={INGEST_MODE})")
+
+        deleted = self.delete_stale(chunk_counts, seen if full and INGEST_DELETE_MISSING else None)
+        self.publish_changes(rows, deleted)
+        print(
+            f"Products: {len(seen)} seen, {len(chunk_counts)} new/changed, "
+            f"{len(seen) - len(chunk_counts)} unchanged, {deleted} stale chunks deleted"
+        )
+
+    def ivfflat_lists(self, rows: int) -> int:
+        if IVFFLAT_LISTS:
+            return IVFFLAT_LISTS
+        return max(1, int(rows ** 0.5) if rows > 1_000_000 else rows // 1000)
+
+    def vector_index_columns(self) -> dict:
+        # column -> (operator class, max indexed dimensions) of every ANN index
+        columns = {"embedding": ("vector_cosine_ops", 2000)} if FULL_VECTOR_INDEX else {}
+        for kind in VECTOR_QUANTIZATION:
+            column, _, _, ops, max_dims = QUANTIZED_COLUMNS[kind]
+            columns[column] = (ops, max_dims)
+        return columns
+
+    def ensure_vector_index(self):
+        # creates the configured ANN index on the full vectors and on every
+        # quantized column, drops the other kind and the unused ones, and
+        # rebuilds when the build parameters changed (ivfflat: lists off by more than 2x)
+        table = ProductEmbedding.__tablename__
+        columns = self.vector_index_columns()
+        kinds = ("hnsw", "ivfflat")
+
+        with self.engine.begin() as conn:
+            for column in ["embedding"] + [c[0] for c in QUANTIZED_COLUMNS.values()]:
+                for kind in kinds:
+                    if kind != VECTOR_INDEX or column not in columns:
+                        conn.execute(text(f"DROP INDEX IF EXISTS {table}_{column}_{kind}_idx"))
+            if VECTOR_INDEX not in kinds:
+                return
+
+            if VECTOR_INDEX == "hnsw":
+                options = {"m": HNSW_M, "ef_construction": HNSW_EF_CONSTRUCTION}
+            else:
+                rows = conn.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+                if not rows:
+                    # ivfflat lists are trained on the data, nothing to train on yet
+                    return
+                options = {"lists": self.ivfflat_lists(rows)}
+
+            for column, (ops, max_dims) in columns.items():
+                if EMBEDDING_DIM > max_dims:
+                    print(f"No {VECTOR_INDEX} index on {column}: {EMBEDDING_DIM} dimensions, pgvector indexes up to {max_dims}")
+                    continue
+                self.ensure_column_index(conn, column, ops, options)
+
+    def ensure_column_index(self, conn, column: str, ops: str, options: dict):
+        table = ProductEmbedding.__tablename__
+        name = f"{table}_{column}_{VECTOR_INDEX}_idx"
+        current = conn.execute(
+            text("SELECT reloptions FROM pg_class WHERE relname = :name"), {"name": name}
+        ).first()
+        if current is not None:
+            built = dict(opt.split("=", 1) for opt in (current[0] or []))
+            if VECTOR_INDEX == "ivfflat":
+                lists = int(built.get("lists", 100))
+                stale = not (0.5 <= options["lists"] / lists <= 2)
+            else:
+                stale = any(built.get(k) != str(v) for k, v in options.items())
+            if not stale:
+                return
+            conn.execute(text(f"DROP INDEX {name}"))
+
+        with_clause = ", ".join(f"{k} = {v}" for k, v in options.items())
+        print(f"Building {VECTOR_INDEX} index {name} ({with_clause})")
+        conn.execute(text(
+            f"CREATE INDEX {name} ON {table} USING {VECTOR_INDEX} ({column} {ops}) WITH ({with_clause})"
+        ))
+
+    def ensure_lexical_index(self):
+        # trigram GIN indexes serve `name % q` and `q <% text` of the lexical
+        # leg, the btree ones the exact url lookups and price range filters
+        table = ProductEmbedding.__tablename__
+        with self.engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {table}_name_trgm_idx ON {table} USING gin (name gin_trgm_ops)"))
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {table}_text_trgm_idx ON {table} USING gin (text gin_trgm_ops)"))
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {table}_url_idx ON {table} (url)"))
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {table}_price_idx ON {table} (price)"))
+
     def run(self):
-        files = list(self.processed_dir.glob("*.json"))
-        for file in files:
-            self.ingest_file(file)
+        shards_dir = self.processed_dir / "shards"
+        manifest = load_manifest(shards_dir) if INGEST_SOURCE != "files" else None
+        if manifest is not None:
+            print(f"Streaming {manifest['products']} products from {len(manifest['shards'])} shards")
+            self.ingest_products(iter_shard_entries(shards_dir, manifest), full=True)
+        elif INGEST_SOURCE == "shards":
+            raise FileNotFoundError(f"No shard manifest in {shards_dir}")
+        else:
+            files = list(self.processed_dir.glob("*.json"))
+            self.ingest_products(self.iter_file_entries(files), full=True)
+        self.ensure_vector_index()
+        if LEXICAL_INDEX:
+            self.ensure_lexical_index()
+
+        stats = self.embedder.stats
+        if stats["seconds"]:
+            print(
+                f"Embedded {stats['texts']} chunks in {stats['requests']} requests "
+                f"({stats['texts'] / stats['seconds']:.1f} chunks/s, {stats.get('retries', 0)} retries)"
+            )
+        print(f"Embedding cache: {json.dumps(self.cache.report())}")
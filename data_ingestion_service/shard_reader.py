@@ -0,0 +1,31 @@
+# reads the JSONL shards written by the processing service (shard_writer.py
+# there): the manifest lists every line's product id, content hash and chunk
+# count, so lines of unchanged products are skipped without being parsed.
+
+import os
+import gzip
+import json
+
+MANIFEST = "manifest.json"
+
+
+def load_manifest(shards_dir: str) -> dict:
+    path = os.path.join(shards_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def open_shard(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8", buffering=1 << 20)
+
+
+def iter_shard_entries(shards_dir: str, manifest: dict):
+    # (product id, content hash, chunk count, json line) in manifest order
+    for shard in manifest["shards"]:
+        with open_shard(os.path.join(shards_dir, shard["file"])) as f:
+            for (product_id, digest, n_chunks), line in zip(shard["products"], f):
+                yield str(product_id), digest, n_chunks, line
@@ -0,0 +1,97 @@
+# exports the embeddings table into a snapshot for the in-process numpy
+# retrieval backend (vector_index.py in the websocket and monitoring services):
+#
+#   <SNAPSHOT_DIR>/<version>/vectors.npy   normalized float32/float16 matrix, memory-mapped by the readers
+#   <SNAPSHOT_DIR>/<version>/meta.json     ids, names, urls, prices and texts in row order
+#   <SNAPSHOT_DIR>/CURRENT                 name of the published version, replaced atomically
+#
+#   python snapshot.py [--dtype float16]
+
+import os
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "/data/snapshots/fosils_embeddings")
+SNAPSHOT_DTYPE = os.getenv("SNAPSHOT_DTYPE", "float32")
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "3"))
+
+
+def parse_vector(literal: str) -> np.ndarray:
+    return np.array(literal[1:-1].split(","), dtype=np.float32)
+
+
+def export_snapshot(engine, table: str = "fosils_embeddings", out_dir: str = SNAPSHOT_DIR,
+                    dtype: str = SNAPSHOT_DTYPE) -> str:
+    # sub-second suffix, a second export within the same second must not
+    # rewrite a vectors.npy that readers may have mapped already; versions
+    # still sort by time for SNAPSHOT_KEEP
+    now = time.time_ns()
+    version = f"{time.strftime('%Y%m%dT%H%M%S', time.localtime(now // 10**9))}.{now % 10**9:09d}"
+    version_dir = os.path.join(out_dir, version)
+
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        # count and rows from the same snapshot of the table
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        cur.execute(f"SELECT count(*), max(vector_dims(embedding)) FROM {table}")
+        rows, dim = cur.fetchone()
+        if not rows:
+            print(f"Nothing to export from {table}")
+            return None
+
+        os.makedirs(out_dir, exist_ok=True)
+        # never reuse an existing version directory
+        os.mkdir(version_dir)
+        matrix = np.lib.format.open_memmap(
+            os.path.join(version_dir, "vectors.npy"), mode="w+", dtype=dtype, shape=(rows, dim)
+        )
+        meta = {"table": table, "dtype": dtype, "id": [], "name": [], "url": [], "price": [], "text": []}
+
+        # server-side cursor, the table is never fully materialized in memory
+        stream = conn.cursor(name="snapshot_export")
+        stream.itersize = 5000
+        stream.execute(f"SELECT id, name, url, price, text, embedding::text FROM {table} ORDER BY id")
+        for i, (id_, name, url, price, text, embedding) in enumerate(stream):
+            if i >= rows:
+                break
+            vector = parse_vector(embedding)
+            matrix[i] = vector / (np.linalg.norm(vector) or 1.0)
+            for key, value in zip(("id", "name", "url", "price", "text"), (id_, name, url, price, text)):
+                meta[key].append(value)
+        stream.close()
+        conn.commit()
+    finally:
+        conn.close()
+
+    matrix.flush()
+    del matrix
+    with open(os.path.join(version_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, separators=(",", ":"))
+
+    # publish: readers pick the new version up on their next reload check
+    tmp_path = os.path.join(out_dir, "CURRENT.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(out_dir, "CURRENT"))
+    print(f"Published snapshot {version_dir} ({len(meta['id'])} rows, dim {dim}, {dtype})")
+
+    versions = sorted(d for d in os.listdir(out_dir) if os.path.isdir(os.path.join(out_dir, d)))
+    for old in versions[:-SNAPSHOT_KEEP]:
+        # readers that still map an old file keep their pages until they reload
+        shutil.rmtree(os.path.join(out_dir, old), ignore_errors=True)
+    return version_dir
+
+
+if __name__ == "__main__":
+    from sqlalchemy import create_engine
+    from ingestor import PG_URI, ProductEmbedding
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dtype", default=SNAPSHOT_DTYPE, choices=["float32", "float16"])
+    parser.add_argument("--out-dir", default=SNAPSHOT_DIR, dest="out_dir")
+    args = parser.parse_args()
+    export_snapshot(create_engine(PG_URI), ProductEmbedding.__tablename__, args.out_dir, args.dtype)
@@ -0,0 +1,140 @@
+# throughput of the token-aware chunker against the previous character based
+# one, plus randomized invariant checks of the new chunker (run before the
+# timing, any violation stops the script):
+#
+#   - every chunk fits into max_tokens and ends with the suffix
+#   - without overlap the chunks give back exactly the words of the text, in order
+#   - with overlap every chunk starts inside the previous one and no text is lost
+#   - the same input always gives the same chunks
+#
+#   python bench_chunker.py --sizes 1000 10000 100000 1000000 --cases 500
+
+import time
+import random
+import argparse
+from chunker import chunk_text, estimate_tokens, get_token_counter
+
+WORDS = "амонит белемнит трилобит мегалодон зъб фосил юра креда мароко опализиран рядък образец 12 см. т.е.".split()
+
+
+def legacy_chunk_text(text: str, max_length: int = 10000) -> list:
+    # the chunker before the token-aware one, kept for comparison
+    if not text:
+        return []
+
+    paragraphs = [p.strip() for p in text.split("\n") if p.strip()]
+
+    chunks = []
+    current_chunk = ""
+
+    for para in paragraphs:
+        if len(para) > max_length:
+            words = para.split()
+            for word in words:
+                if len(current_chunk) + len(word) + 1 <= max_length:
+                    current_chunk += (" " if current_chunk else "") + word
+                else:
+                    chunks.append(current_chunk.strip())
+                    current_chunk = word
+            continue
+
+        if len(current_chunk) + len(para) + 1 > max_length:
+            if current_chunk:
+                chunks.append(current_chunk.strip())
+            current_chunk = para
+        else:
+            current_chunk += ("\n" if current_chunk else "") + para
+
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+
+    return chunks
+
+
+def random_text(rng: random.Random, length: int) -> str:
+    # numbered words, so every piece of the text can be located unambiguously
+    parts, size, n = [], 0, 0
+    while size < length:
+        words = []
+        for _ in range(rng.randint(1, 40)):
+            words.append(f"{rng.choice(WORDS)}{n}")
+            n += 1
+        sentence = " ".join(words)
+        sentence = sentence[0].upper() + sentence[1:] + rng.choice([".", "!", "?", ""])
+        if rng.random() < 0.02:
+            # a "word" longer than a chunk
+            sentence += f" {n}" + "".join(rng.choice("abcdefghij") for _ in range(rng.randint(100, 3000)))
+            n += 1
+        sentence += rng.choice([" ", " ", " ", "\n"])
+        parts.append(sentence)
+        size += len(sentence)
+    return "".join(parts)
+
+
+def check_invariants(cases: int, seed: int = 7):
+    rng = random.Random(seed)
+    for case in range(cases):
+        text = random_text(rng, rng.randint(0, 20000))
+        max_tokens = rng.randint(20, 600)
+        suffix = rng.choice(["", " име: Амонит цена: 12.0 id/идентификатор: 5186 урл/линк/url https://x.bg/1"])
+        if estimate_tokens(suffix) >= max_tokens:
+            suffix = ""
+        overlap = rng.choice([0, rng.randint(1, max_tokens)])
+
+        chunks = chunk_text(text, max_tokens, overlap, suffix, estimate_tokens)
+        context = f"case {case} (max_tokens={max_tokens}, overlap={overlap}, suffix={bool(suffix)})"
+
+        assert chunks == chunk_text(text, max_tokens, overlap, suffix, estimate_tokens), f"not deterministic, {context}"
+        for chunk in chunks:
+            assert estimate_tokens(chunk) <= max_tokens, f"chunk of {estimate_tokens(chunk)} tokens, {context}"
+            assert chunk.endswith(suffix), f"suffix missing, {context}"
+
+        bodies = [c[:len(c) - len(suffix)] if suffix else c for c in chunks]
+        if not text.split():
+            assert bodies in ([], [suffix.strip()]), f"chunks of an empty text, {context}"
+            continue
+        if overlap == 0:
+            # long words are cut without a separator, compare the characters
+            assert "".join("".join(b.split()) for b in bodies) == "".join(text.split()), f"text changed, {context}"
+        else:
+            joined = "".join(text.split())
+            position, previous = 0, -1
+            for body in bodies:
+                compact = "".join(body.split())
+                # latest match that starts after the previous chunk and not after the covered text
+                found = joined.rfind(compact, previous + 1, position + len(compact))
+                assert found != -1, f"gap before a chunk, {context}"
+                position, previous = max(position, found + len(compact)), found
+            assert position == len(joined), f"text lost at the end, {context}"
+    print(f"Invariants hold on {cases} random texts")
+
+
+def bench(fn, text: str, rounds: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        fn(text)
+    return rounds * len(text) / (time.perf_counter() - t0) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--cases", type=int, default=300)
+    parser.add_argument("--tokenizer", default="estimate", choices=["estimate", "tiktoken"])
+    args = parser.parse_args()
+
+    check_invariants(args.cases)
+
+    count_tokens = get_token_counter(args.tokenizer)
+    rng = random.Random(1)
+    for size in args.sizes:
+        # one long paragraph, the worst case of the word by word concatenation
+        text = random_text(rng, size).replace("\n", " ")
+        rounds = max(1, 1000000 // size)
+        legacy = bench(legacy_chunk_text, text, rounds)
+        new = bench(lambda t: chunk_text(t, count_tokens=count_tokens), text, rounds)
+        print(f"{size:>8} chars: legacy {legacy:6.2f} MB/s, token-aware ({args.tokenizer}) {new:6.2f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
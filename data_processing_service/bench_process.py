@@ -0,0 +1,119 @@
+# files/sec and peak RSS of the processing modes over a synthetic raw set:
+# serial per-product json files (the old path), the process pool writing
+# json files, and the process pool writing JSONL shards (plain and gzip).
+# every mode runs in its own subprocess so the RSS peaks don't mix.
+#
+#   python bench_process.py --products 100000 --workers 8
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+MODES = {
+    "serial-files": {"PROCESS_OUTPUT": "files", "PROCESS_WORKERS": "1"},
+    "pool-files": {"PROCESS_OUTPUT": "files"},
+    "pool-jsonl": {"PROCESS_OUTPUT": "jsonl", "PROCESS_COMPRESS": "0"},
+    "pool-jsonl-gz": {"PROCESS_OUTPUT": "jsonl", "PROCESS_COMPRESS": "1"},
+}
+
+WORDS = "амонит белемнит трилобит мегалодон зъб фосил юра креда мароко опализиран рядък образец камък".split()
+
+
+def generate_raw(raw_dir: str, count: int, seed: int = 7):
+    rng = random.Random(seed)
+    os.makedirs(raw_dir, exist_ok=True)
+    for i in range(count):
+        paragraphs = [
+            " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80))) + " &amp; размер 12&nbsp;см"
+            for _ in range(rng.randint(1, 4))
+        ]
+        product = {
+            "id": str(i),
+            "name": f"{rng.choice(WORDS).capitalize()} {i}",
+            "description": "\r\n".join(paragraphs),
+            "price": f"{rng.uniform(1, 500):.2f}".replace(".", ","),
+            "url": f"https://example.com/4-fosili/{i}-bench"
+        }
+        with open(os.path.join(raw_dir, f"{i}.json"), "w", encoding="utf-8") as f:
+            json.dump(product, f, ensure_ascii=False)
+
+
+def dir_size(path: str) -> tuple:
+    files, size = 0, 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+def run_child(raw_dir: str, out_dir: str):
+    # env is set by the parent before processor reads it at import
+    from processor import DataProcessor
+
+    processor = DataProcessor(raw_dir, out_dir)
+    count = len([f for f in os.listdir(raw_dir) if f.endswith(".json")])
+    t0 = time.perf_counter()
+    processor.run()
+    seconds = time.perf_counter() - t0
+    files, size = dir_size(out_dir)
+    print(json.dumps({
+        "files_per_s": count / seconds,
+        "seconds": seconds,
+        # ru_maxrss is in KB on linux; children = the largest pool worker
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "worker_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "output_files": files,
+        "output_mb": size / 1e6
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--raw-dir", dest="raw_dir", help="existing raw set, generated into a temp dir otherwise")
+    parser.add_argument("--child", nargs=2, metavar=("RAW_DIR", "OUT_DIR"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(*args.child)
+        return
+
+    work_dir = tempfile.mkdtemp(prefix="bench_process_")
+    try:
+        raw_dir = args.raw_dir
+        if raw_dir is None:
+            raw_dir = os.path.join(work_dir, "raw")
+            t0 = time.perf_counter()
+            generate_raw(raw_dir, args.products)
+            print(f"Generated {args.products} raw products in {time.perf_counter() - t0:.1f}s")
+
+        for mode in args.modes:
+            out_dir = os.path.join(work_dir, mode)
+            env = {**os.environ, "PROCESS_WORKERS": str(args.workers), **MODES[mode]}
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", raw_dir, out_dir],
+                env=env, capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+            )
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            print(
+                f"{mode:14s} {result['files_per_s']:8.0f} files/s  "
+                f"peak rss {result['peak_rss_mb']:6.1f} MB (worker {result['worker_peak_rss_mb']:6.1f} MB)  "
+                f"{result['output_files']} files, {result['output_mb']:.1f} MB"
+            )
+            shutil.rmtree(out_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
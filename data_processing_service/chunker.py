@@ -1,36 +1,117 @@
-# simple chunk strategy is here based on our data 
-# paragraphs, newlines, and word boundaries are respected first(mostly for the description field)
-# and only if adding paragraph exceeds max_length, save current chunk
+# chunks are sized in embedding-model tokens, not characters.
+# the text is split once into pieces - sentences, and words of sentences
+# that don't fit a chunk on their own - every piece is counted once, and the
+# pieces are packed greedily and joined once per chunk, so the whole thing is
+# linear in the text length. consecutive chunks share up to overlap_tokens of
+# trailing pieces. the field suffix (name, price, id, url) is appended to
+# every chunk and its tokens are reserved in the budget.
 
+import os
+import re
 
-def chunk_text(text: str, max_length: int = 10000) -> list:
-    if not text:
-        return []
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "512"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "64"))
+# "estimate" (no dependency, errs on the large side for cyrillic) or "tiktoken"
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", "estimate")
 
-    paragraphs = [p.strip() for p in text.split("\n") if p.strip()]
+# end of sentence followed by a capital (latin or cyrillic), digit or opening quote/bracket;
+# "12 см. и" or "т.е. така" stay together
+SENTENCE_END_RE = re.compile(r"[.!?…][\"'”“»)]*\s+(?=[\"'„“«(\[]?[A-ZА-ЯЀ-Џ0-9])")
 
-    chunks = []
-    current_chunk = ""
-
-    for para in paragraphs:
-        if len(para) > max_length:
-            words = para.split()
-            for word in words:
-                if len(current_chunk) + len(word) + 1 <= max_length:
-                    current_chunk += (" " if current_chunk else "") + word
-                else:
-                    chunks.append(current_chunk.strip())
-                    current_chunk = word
+
+def estimate_tokens(text: str) -> int:
+    # same estimate as the ingestor's batching, ~2 characters per token
+    return len(text) // 2 + 1
+
+
+def get_token_counter(name: str = CHUNK_TOKENIZER):
+    if name == "tiktoken":
+        import tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text))
+    return estimate_tokens
+
+
+def split_sentences(paragraph: str) -> list:
+    sentences, start = [], 0
+    for match in SENTENCE_END_RE.finditer(paragraph):
+        sentences.append(paragraph[start:match.end()].rstrip())
+        start = match.end()
+    sentences.append(paragraph[start:])
+    return [s for s in sentences if s]
+
+
+def split_pieces(text: str, budget: int, count_tokens) -> tuple:
+    # -> pieces, their token counts and the separator in front of each piece
+    pieces, tokens, seps = [], [], []
+    for paragraph in (p.strip() for p in text.split("\n")):
+        if not paragraph:
             continue
+        for s_idx, sentence in enumerate(split_sentences(paragraph)):
+            sep = "\n" if s_idx == 0 else " "
+            n = count_tokens(sentence)
+            if n <= budget:
+                pieces.append(sentence)
+                tokens.append(n)
+                seps.append(sep)
+                continue
+            # sentence longer than a chunk: fall back to its words
+            for word in sentence.split():
+                n = count_tokens(word)
+                while n > budget:
+                    # a single "word" longer than a chunk (urls, base64...), cut it
+                    cut = max(1, len(word) * budget // n)
+                    while cut > 1 and count_tokens(word[:cut]) > budget:
+                        cut -= max(1, cut // 10)
+                    pieces.append(word[:cut])
+                    tokens.append(count_tokens(word[:cut]))
+                    seps.append(sep)
+                    sep, word = "", word[cut:]
+                    n = count_tokens(word)
+                if word:
+                    pieces.append(word)
+                    tokens.append(n)
+                    seps.append(sep)
+                sep = " "
+    return pieces, tokens, seps
+
+
+def chunk_text(text: str, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+               suffix: str = "", count_tokens=None) -> list:
+    count_tokens = count_tokens or get_token_counter()
+    budget = max_tokens - (count_tokens(suffix) if suffix else 0)
+    if budget < 1:
+        raise ValueError(f"Suffix of {count_tokens(suffix)} tokens doesn't fit into chunks of {max_tokens} tokens")
+
+    # an overlap close to the budget would advance by a piece at a time
+    overlap_tokens = min(overlap_tokens, budget // 2)
+
+    pieces, tokens, seps = split_pieces(text or "", budget, count_tokens)
+    if not pieces:
+        return [suffix.strip()] if suffix.strip() else []
+
+    chunks = []
+    start = 0
+    while start < len(pieces):
+        # pieces' token counts are summed: an upper bound of the joined text
+        # for the estimate, within a few tokens for bpe tokenizers
+        end, used = start, 0
+        while end < len(pieces) and used + tokens[end] <= budget:
+            used += tokens[end]
+            end += 1
 
-        if len(current_chunk) + len(para) + 1 > max_length:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = para
-        else:
-            current_chunk += ("\n" if current_chunk else "") + para
+        body = pieces[start] + "".join(seps[i] + pieces[i] for i in range(start + 1, end))
+        chunks.append(body + suffix)
+        if end == len(pieces):
+            break
 
-    if current_chunk:
-        chunks.append(current_chunk.strip())
+        # next chunk starts with the trailing pieces that fit into the overlap
+        # and still leave room for the next new piece, so it always moves forward
+        room = min(overlap_tokens, budget - tokens[end])
+        next_start, shared = end, 0
+        while next_start - 1 > start and shared + tokens[next_start - 1] <= room:
+            next_start -= 1
+            shared += tokens[next_start]
+        start = next_start
 
     return chunks
@@ -1,7 +1,42 @@
 import json
 import os
+from multiprocessing import Pool
 from utils import clean_text, clean_price
 from chunker import chunk_text
+from shard_writer import ShardWriter, product_hash, MANIFEST
+
+# "files" writes one json per product (the old layout), "jsonl" writes shards + manifest
+PROCESS_OUTPUT = os.getenv("PROCESS_OUTPUT", "files")
+# worker processes, 1 processes in this process
+PROCESS_WORKERS = int(os.getenv("PROCESS_WORKERS", str(os.cpu_count() or 1)))
+# keep the raw dir order in the output, otherwise products are written as they finish
+PROCESS_ORDERED = os.getenv("PROCESS_ORDERED", "0") == "1"
+PROCESS_SHARD_SIZE = int(os.getenv("PROCESS_SHARD_SIZE", "10000"))
+PROCESS_COMPRESS = os.getenv("PROCESS_COMPRESS", "0") == "1"
+
+
+def process_product(data: dict) -> dict:
+    # the fields are appended to every chunk, so each one can match a price, id or url
+    suffix = (" име: " + clean_text(data.get("name")) +
+              " цена: " + clean_text(data.get("price")) +
+              " id/идентификатор: " + clean_text(data.get("id")) +
+              " урл/линк/url " + clean_text(data.get("url")))
+    return {
+        "id": data.get("id"),
+        "name": clean_text(data.get("name")),
+        "price": clean_price(data.get("price")),
+        "url": data.get("url"),
+        "chunks": chunk_text(clean_text(data.get("description")), suffix=suffix)
+    }
+
+
+def process_line(filepath: str) -> tuple:
+    # runs in the pool workers: the product comes back already serialized,
+    # the parent process only writes it
+    with open(filepath, "r", encoding="utf-8") as f:
+        processed = process_product(json.load(f))
+    line = json.dumps(processed, ensure_ascii=False, separators=(",", ":"))
+    return processed["id"], product_hash(processed), len(processed["chunks"]), line
 
 
 class DataProcessor:
@@ -10,31 +45,66 @@ class DataProcessor:
         self.processed_dir = processed_dir
         os.makedirs(self.processed_dir, exist_ok=True)
 
-    def process_file(self, filepath: str):
+    def process_file(self, filepath: str, verbose: bool = True) -> dict:
         with open(filepath, "r", encoding="utf-8") as f:
             data = json.load(f)
 
-        processed = {
-            "id": data.get("id"),
-            "name": clean_text(data.get("name")),
-            "price": clean_price(data.get("price")),
-            "url": data.get("url"),
-            "chunks": chunk_text(clean_text(data.get("description")) +
-                       " име: " + clean_text(data.get("name"))+ 
-                       " цена: " + clean_text(data.get("price")) +
-                       " id/идентификатор: " + clean_text(data.get("id")) + 
-                       " урл/линк/url " + clean_text(data.get("url"))
-                       )
-
-        }
+        processed = process_product(data)
 
         out_path = os.path.join(self.processed_dir, f"{processed['id']}.json")
         with open(out_path, "w", encoding="utf-8") as f:
             json.dump(processed, f, ensure_ascii=False, indent=2)
 
-        print(f"Processed {filepath} → {out_path}")
+        if verbose:
+            print(f"Processed {filepath} → {out_path}")
+        return processed
+
+    def shards_dir(self) -> str:
+        return os.path.join(self.processed_dir, "shards")
+
+    def map_files(self, fn, files: list, workers: int = PROCESS_WORKERS, ordered: bool = PROCESS_ORDERED):
+        if workers <= 1:
+            yield from map(fn, files)
+            return
+        with Pool(workers) as pool:
+            results = pool.imap if ordered else pool.imap_unordered
+            yield from results(fn, files, chunksize=64)
+
+    def run_sharded(self, files: list, workers: int = PROCESS_WORKERS, ordered: bool = PROCESS_ORDERED) -> dict:
+        writer = ShardWriter(self.shards_dir(), PROCESS_SHARD_SIZE, PROCESS_COMPRESS)
+        for product_id, digest, n_chunks, line in self.map_files(process_line, files, workers, ordered):
+            writer.write(product_id, digest, n_chunks, line)
+        manifest = writer.close()
+        print(f"Processed {manifest['products']} products into {len(manifest['shards'])} shards in {self.shards_dir()}")
+        return manifest
+
+    def prune_processed(self, ids: set) -> int:
+        # processed files of products that have no raw file anymore (the
+        # scraper removes those of pages gone from the sitemap)
+        removed = 0
+        for name in os.listdir(self.processed_dir):
+            if name.endswith(".json") and name[:-len(".json")] not in ids:
+                os.remove(os.path.join(self.processed_dir, name))
+                removed += 1
+        if removed:
+            print(f"Removed {removed} processed files of products without a raw file")
+        return removed
 
     def run(self):
         files = [os.path.join(self.raw_dir, f) for f in os.listdir(self.raw_dir) if f.endswith(".json")]
-        for file in files:
-            self.process_file(file)
+        self.prune_processed({os.path.basename(f)[:-len(".json")] for f in files})
+        if PROCESS_OUTPUT != "jsonl":
+            # a manifest of an earlier jsonl run would stay authoritative for
+            # the ingestor (INGEST_SOURCE=auto) and hide these files
+            manifest_path = os.path.join(self.shards_dir(), MANIFEST)
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+        if PROCESS_OUTPUT == "jsonl":
+            self.run_sharded(files)
+        elif PROCESS_WORKERS > 1:
+            # bound method of a picklable object, the workers write their own files
+            for _ in self.map_files(self.process_file, files):
+                pass
+        else:
+            for file in files:
+                self.process_file(file)
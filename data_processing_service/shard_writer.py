@@ -0,0 +1,77 @@
+# processed products as append-only JSONL shards instead of one pretty
+# printed file per product:
+#
+#   <out_dir>/<run>-00000.jsonl[.gz]   one compact product per line
+#   <out_dir>/manifest.json            shards in order, and per shard the
+#                                      [id, content hash, chunk count] of every line
+#
+# the manifest is replaced atomically at the end of a run, shards of older
+# runs are removed after that. the ingestor (shard_reader.py) compares the
+# hashes with the database and only parses the lines of changed products.
+
+import os
+import gzip
+import json
+import time
+import hashlib
+
+MANIFEST = "manifest.json"
+
+
+def product_hash(data: dict) -> str:
+    # must stay identical to product_hash in data_ingestion_service/ingestor.py
+    payload = json.dumps(
+        {key: data.get(key) for key in ("id", "name", "price", "url", "chunks")},
+        sort_keys=True, ensure_ascii=False, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ShardWriter:
+    def __init__(self, out_dir: str, shard_size: int = 10000, compress: bool = False):
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        self.compress = compress
+        self.run = time.strftime("%Y%m%dT%H%M%S")
+        self.shards = []
+        self.file = None
+        os.makedirs(out_dir, exist_ok=True)
+
+    def open_shard(self):
+        name = f"{self.run}-{len(self.shards):05d}.jsonl" + (".gz" if self.compress else "")
+        path = os.path.join(self.out_dir, name)
+        # compresslevel 1: most of the size win for a fraction of the cpu
+        self.file = gzip.open(path, "wt", encoding="utf-8", compresslevel=1) if self.compress \
+            else open(path, "w", encoding="utf-8", buffering=1 << 20)
+        self.shards.append({"file": name, "products": []})
+
+    def write(self, product_id, digest: str, n_chunks: int, line: str):
+        if self.file is None or len(self.shards[-1]["products"]) >= self.shard_size:
+            self.close_shard()
+            self.open_shard()
+        self.file.write(line)
+        self.file.write("\n")
+        self.shards[-1]["products"].append([product_id, digest, n_chunks])
+
+    def close_shard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self) -> dict:
+        self.close_shard()
+        manifest = {
+            "run": self.run,
+            "products": sum(len(s["products"]) for s in self.shards),
+            "shards": self.shards
+        }
+        tmp_path = os.path.join(self.out_dir, MANIFEST + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, os.path.join(self.out_dir, MANIFEST))
+
+        current = {s["file"] for s in self.shards}
+        for name in os.listdir(self.out_dir):
+            if name.endswith((".jsonl", ".jsonl.gz")) and name not in current:
+                os.remove(os.path.join(self.out_dir, name))
+        return manifest
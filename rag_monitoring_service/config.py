@@ -2,8 +2,28 @@ import os
 
 rag_configs = {
     "EMBEDDING_MODEL": os.getenv("EMBEDDING_MODEL", "text-embedding-3-small"),
+    "EMBEDDING_TABLE": os.getenv("EMBEDDING_TABLE", "fosils_embeddings"),
+    # "model=table,model=table" for the models of the sweep that aren't in EMBEDDING_TABLE
+    "EMBEDDING_TABLES": dict(
+        pair.split("=", 1) for pair in os.getenv("EMBEDDING_TABLES", "").split(",") if "=" in pair
+    ),
     "LLM_MODEL": os.getenv("LLM_MODEL", "gpt-4o-mini"),
     "OPEN_AI_API_KEY": os.getenv("OPEN_AI_API_KEY"),
     "TOP_K": int(os.getenv("TOP_K", "5")),
-    "SYSTEM_PROMPT": os.getenv("SYSTEM_PROMPT", "Answer the questions only within the products (fosils) context.")
+    "SYSTEM_PROMPT": os.getenv("SYSTEM_PROMPT", "Answer the questions only within the products (fosils) context."),
+    "RETRIEVAL_BACKEND": os.getenv("RETRIEVAL_BACKEND", "pgvector"),
+    "RETRIEVAL_MODE": os.getenv("RETRIEVAL_MODE", "vector"),
+    "HYBRID_CANDIDATES": int(os.getenv("HYBRID_CANDIDATES", "20")),
+    "HYBRID_RRF_K": int(os.getenv("HYBRID_RRF_K", "60")),
+    "LEXICAL_THRESHOLD": float(os.getenv("LEXICAL_THRESHOLD", "0.3")),
+    "EVAL_CONCURRENCY": int(os.getenv("EVAL_CONCURRENCY", "8")),
+    "EVAL_EMBED_BATCH": int(os.getenv("EVAL_EMBED_BATCH", "256")),
+    "SWEEP_MODEL_CONCURRENCY": int(os.getenv("SWEEP_MODEL_CONCURRENCY", "4")),
+    # single-query embedding requests per model in the sweep, the latency on a cache miss
+    "SWEEP_EMBED_PROBES": int(os.getenv("SWEEP_EMBED_PROBES", "10")),
+    "HNSW_EF_SEARCH": int(os.getenv("HNSW_EF_SEARCH", "40")),
+    "IVFFLAT_PROBES": int(os.getenv("IVFFLAT_PROBES", "1")),
+    # quantized first pass ("halfvec", "binary" or "none") and its re-ranked candidates per top_k
+    "VECTOR_QUANTIZATION": os.getenv("VECTOR_QUANTIZATION", "none").split(",")[0].strip(),
+    "RERANK_OVERSAMPLE": int(os.getenv("RERANK_OVERSAMPLE", "4"))
 }
@@ -0,0 +1,143 @@
+# prompt context from the search results. the rows are chunks and several
+# can belong to one product, each ending with the field suffix of the
+# processor (" име: ... цена: ... id/идентификатор: ... урл/линк/url ...").
+# the hits are collapsed to one entry per product in the order of its best
+# hit, the suffix becomes one compact header line per product, and passages
+# are added best first (one per product, then the second ones, ...) until
+# the token budget is spent; a passage that doesn't fit is cut at a word.
+# the same file is copied into the websocket and monitoring services.
+
+import os
+import re
+
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "1500"))
+CONTEXT_PASSAGES_PER_PRODUCT = int(os.getenv("CONTEXT_PASSAGES_PER_PRODUCT", "2"))
+CONTEXT_PASSAGE_MAX_TOKENS = int(os.getenv("CONTEXT_PASSAGE_MAX_TOKENS", "300"))
+# a cut passage shorter than this is left out
+CONTEXT_MIN_PASSAGE_TOKENS = int(os.getenv("CONTEXT_MIN_PASSAGE_TOKENS", "24"))
+# "estimate" (~2 characters per token, like the chunker) or "tiktoken"
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "estimate")
+
+SUFFIX_RE = re.compile(
+    r"\s*име: (?P<name>.*?) цена: (?P<price>.*?) id/идентификатор: (?P<id>.*?) урл/линк/url ?(?P<url>\S*)\s*$",
+    re.DOTALL
+)
+CHUNK_ID_RE = re.compile(r"^(.+)_\d+$")
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 2 + 1
+
+
+def get_token_counter(name: str = CONTEXT_TOKENIZER):
+    if name == "tiktoken":
+        import tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text))
+    return estimate_tokens
+
+
+def split_suffix(text: str):
+    # -> (passage, suffix fields or None); the last "име: " starts the suffix,
+    # a description may mention the word too
+    text = text or ""
+    start = text.rfind("име: ")
+    match = SUFFIX_RE.match(text, max(0, start - 1)) if start != -1 else None
+    if match is None:
+        return text.strip(), None
+    return text[:match.start()].strip(), match.groupdict()
+
+
+def trim_to_tokens(text: str, max_tokens: int, count_tokens=estimate_tokens) -> str:
+    # longest word prefix within max_tokens, binary search over the word count
+    if count_tokens(text) <= max_tokens:
+        return text
+    words = text.split()
+    lo, hi = 0, len(words)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(" ".join(words[:mid]) + " …") <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return " ".join(words[:lo]) + " …" if lo else ""
+
+
+def collapse_hits(rows: list) -> list:
+    # one entry per product in the order of its best hit, with the distinct
+    # passages of its chunks in rank order
+    products = {}
+    for row in rows:
+        passage, fields = split_suffix(row.get("text"))
+        match = CHUNK_ID_RE.match(str(row.get("id") or ""))
+        key = (fields or {}).get("id") or (match.group(1) if match else None) or row.get("url") or row.get("id")
+        product = products.get(key)
+        if product is None:
+            product = products[key] = {
+                "id": key,
+                "name": row.get("name") or (fields or {}).get("name"),
+                "price": row.get("price") if row.get("price") is not None else (fields or {}).get("price"),
+                "url": row.get("url") or (fields or {}).get("url"),
+                "hits": 0,
+                "passages": []
+            }
+        product["hits"] += 1
+        if passage and passage not in product["passages"]:
+            product["passages"].append(passage)
+    return list(products.values())
+
+
+def format_header(index: int, product: dict) -> str:
+    parts = [f"[{index}] {product['name'] or ''}".rstrip()]
+    if product["price"] is not None:
+        parts.append(f"цена: {product['price']}")
+    parts.append(f"id: {product['id']}")
+    if product["url"]:
+        parts.append(product["url"])
+    return " | ".join(parts)
+
+
+def build_context(rows: list, max_tokens: int = CONTEXT_MAX_TOKENS,
+                  passages_per_product: int = CONTEXT_PASSAGES_PER_PRODUCT,
+                  passage_max_tokens: int = CONTEXT_PASSAGE_MAX_TOKENS, count_tokens=estimate_tokens):
+    # -> (context, stats); the headers come first in the budget, a product
+    # whose header doesn't fit anymore is dropped with its passages
+    products = collapse_hits(rows)
+    headers, used = [], 0
+    for i, product in enumerate(products, start=1):
+        header = format_header(i, product)
+        tokens = count_tokens(header) + 1
+        if used + tokens > max_tokens:
+            break
+        headers.append(header)
+        used += tokens
+    kept = products[:len(headers)]
+
+    selected = [[] for _ in kept]
+    cut = 0
+    for depth in range(max(0, passages_per_product)):
+        for i, product in enumerate(kept):
+            if depth >= len(product["passages"]):
+                continue
+            room = min(passage_max_tokens, max_tokens - used - 1)
+            if room < CONTEXT_MIN_PASSAGE_TOKENS:
+                break
+            passage = trim_to_tokens(product["passages"][depth], room, count_tokens)
+            if not passage or count_tokens(passage) < min(CONTEXT_MIN_PASSAGE_TOKENS, count_tokens(product["passages"][depth])):
+                continue
+            cut += passage != product["passages"][depth]
+            selected[i].append(passage)
+            used += count_tokens(passage) + 1
+
+    blocks = ["\n".join([header] + passages) for header, passages in zip(headers, selected)]
+    context = "\n\n".join(blocks)
+    stats = {
+        "hits": len(rows),
+        "products": len(products),
+        "products_kept": len(kept),
+        "passages": sum(len(p) for p in selected),
+        "passages_cut": cut,
+        "tokens": count_tokens(context) if context else 0,
+        "raw_tokens": count_tokens("\n\n".join(r.get("text") or "" for r in rows))
+    }
+    return context, stats
@@ -0,0 +1,148 @@
+# embedding backends shared by the ingestor, the websocket service and the
+# evaluator (the same file is copied into each service). EMBEDDING_MODEL
+# picks one: an openai model name, or "hashing-<dim>" (e.g. hashing-768) for
+# the local cpu backend - hashed character n-grams, no network and no model
+# files. the provider's name keys the embedding cache and its dim sizes the
+# vector column.
+
+import os
+import re
+import time
+import zlib
+import asyncio
+import threading
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import numpy as np
+
+OPENAI_DIMS = {"text-embedding-3-small": 1536, "text-embedding-3-large": 3072, "text-embedding-ada-002": 1536}
+HASHING_DIM = int(os.getenv("HASHING_DIM", "768"))
+HASHING_NGRAMS = (3, 5)
+HASHING_WORKERS = int(os.getenv("HASHING_WORKERS", str(os.cpu_count() or 1)))
+# smaller batches are embedded in the calling thread, a pool round trip costs more
+HASHING_POOL_MIN_BATCH = int(os.getenv("HASHING_POOL_MIN_BATCH", "512"))
+
+HASHING_RE = re.compile(r"^hashing(?:-(\d+))?$")
+
+
+class EmbeddingProvider:
+    kind = None
+
+    def __init__(self, name: str, dim: int):
+        self.name = name
+        self.dim = dim
+        self.stats = {"requests": 0, "texts": 0, "seconds": 0.0}
+        self.lock = threading.Lock()
+
+    def embed(self, texts: List[str]) -> List[list]:
+        raise NotImplementedError
+
+    def count(self, texts: List[str], seconds: float):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["texts"] += len(texts)
+            self.stats["seconds"] += seconds
+
+    def embed_many(self, texts: List[str]) -> List[list]:
+        if not texts:
+            return []
+        t0 = time.perf_counter()
+        vectors = self.embed(texts)
+        self.count(texts, time.perf_counter() - t0)
+        return vectors
+
+    async def aembed_many(self, texts: List[str]) -> List[list]:
+        return await asyncio.to_thread(self.embed_many, texts)
+
+    def report(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+        return {
+            "provider": self.kind,
+            "name": self.name,
+            "dim": self.dim,
+            **stats,
+            "texts_per_s": stats["texts"] / stats["seconds"] if stats["seconds"] else 0.0
+        }
+
+
+class OpenAIProvider(EmbeddingProvider):
+    kind = "openai"
+
+    def __init__(self, model: str, client=None, async_client=None):
+        super().__init__(model, OPENAI_DIMS.get(model, 1536))
+        self.model = model
+        self.client = client
+        self.async_client = async_client
+
+    def embed(self, texts: List[str]) -> List[list]:
+        if self.client is None:
+            from openai import OpenAI
+            self.client = OpenAI(api_key=os.getenv("OPEN_AI_API_KEY"))
+        resp = self.client.embeddings.create(model=self.model, input=texts)
+        return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+
+    async def aembed_many(self, texts: List[str]) -> List[list]:
+        if self.async_client is None:
+            return await super().aembed_many(texts)
+        if not texts:
+            return []
+        t0 = time.perf_counter()
+        resp = await self.async_client.embeddings.create(model=self.model, input=texts)
+        self.count(texts, time.perf_counter() - t0)
+        return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+
+
+def ngram_hashes(text: str) -> List[int]:
+    padded = " " + " ".join(unicodedata.normalize("NFC", text or "").lower().split()) + " "
+    hashes = []
+    for n in range(HASHING_NGRAMS[0], HASHING_NGRAMS[1] + 1):
+        hashes.extend(zlib.crc32(padded[i:i + n].encode("utf-8")) for i in range(len(padded) - n + 1))
+    return hashes
+
+
+def hashing_embed(texts: List[str], dim: int) -> np.ndarray:
+    # signed feature hashing: every n-gram adds +-1 to one of dim buckets;
+    # the n-grams of the whole batch are summed by one bincount, rows are
+    # l2-normalized so the dot product is the cosine
+    per_text = [ngram_hashes(t) for t in texts]
+    hashes = np.fromiter((h for hs in per_text for h in hs), dtype=np.int64)
+    rows = np.repeat(np.arange(len(texts), dtype=np.int64), [len(hs) for hs in per_text])
+    signs = np.where(hashes & 0x10000, 1.0, -1.0)
+    matrix = np.bincount(rows * dim + hashes % dim, weights=signs, minlength=len(texts) * dim)
+    matrix = matrix.reshape(len(texts), dim).astype(np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class HashingProvider(EmbeddingProvider):
+    kind = "hashing"
+
+    def __init__(self, dim: int = HASHING_DIM, workers: int = HASHING_WORKERS):
+        super().__init__(f"hashing-{dim}", dim)
+        self.workers = workers
+        self.pool = None
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self.pool
+
+    def embed(self, texts: List[str]) -> List[list]:
+        if self.workers <= 1 or len(texts) < HASHING_POOL_MIN_BATCH:
+            return hashing_embed(texts, self.dim).tolist()
+        # a few slices per worker, the n-gram loop is python and holds the GIL
+        step = -(-len(texts) // (self.workers * 4))
+        slices = [texts[i:i + step] for i in range(0, len(texts), step)]
+        matrices = self.get_pool().map(hashing_embed, slices, [self.dim] * len(slices))
+        return np.vstack(list(matrices)).tolist()
+
+
+def get_provider(name: str, client=None, async_client=None) -> EmbeddingProvider:
+    match = HASHING_RE.match(name or "")
+    if match:
+        return HashingProvider(int(match.group(1) or HASHING_DIM))
+    return OpenAIProvider(name, client, async_client)
@@ -1,51 +1,312 @@
 import os
+import re
 import time
 import json
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 import numpy as np
 from sklearn.metrics import ndcg_score
 from openai import OpenAI
-import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 from config import rag_configs
+from embedding_cache import EmbeddingCache
+from embedding_provider import EmbeddingProvider, get_provider
+from vector_index import SnapshotIndex
+from hybrid import parse_structured, rrf_fuse
 
 
 PG_URI = os.getenv("PG_URI", "postgresql://postgres:postgres@db:5432/postgres")
 EMBEDDING_MODEL = rag_configs.get("EMBEDDING_MODEL")
+EMBEDDING_TABLE = rag_configs.get("EMBEDDING_TABLE", "fosils_embeddings")
+EMBEDDING_TABLES = rag_configs.get("EMBEDDING_TABLES", {})
 OPEN_AI_KEY = rag_configs.get("OPEN_AI_API_KEY")
+LLM_MODEL = rag_configs.get("LLM_MODEL", "gpt-4o-mini")
+SYSTEM_PROMPT = rag_configs.get("SYSTEM_PROMPT")
+HNSW_EF_SEARCH = rag_configs.get("HNSW_EF_SEARCH", 40)
+IVFFLAT_PROBES = rag_configs.get("IVFFLAT_PROBES", 1)
+VECTOR_QUANTIZATION = rag_configs.get("VECTOR_QUANTIZATION", "none")
+RERANK_OVERSAMPLE = rag_configs.get("RERANK_OVERSAMPLE", 4)
+# distance on the quantized columns of the ingestor, same as the websocket service
+QUANTIZED_DISTANCE = {
+    "halfvec": "embedding_half <=> %s::vector::halfvec",
+    "binary": "embedding_bit <~> binary_quantize(%s::vector)"
+}
+# pgvector rejects a larger hnsw.ef_search, the candidates of a search are capped to it
+MAX_EF_SEARCH = 1000
+RETRIEVAL_BACKEND = rag_configs.get("RETRIEVAL_BACKEND", "pgvector")
+RETRIEVAL_MODE = rag_configs.get("RETRIEVAL_MODE", "vector")
+HYBRID_CANDIDATES = rag_configs.get("HYBRID_CANDIDATES", 20)
+HYBRID_RRF_K = rag_configs.get("HYBRID_RRF_K", 60)
+LEXICAL_THRESHOLD = rag_configs.get("LEXICAL_THRESHOLD", 0.3)
+FIELDS = {"ids": "expected_ids", "price": "expected_price", "link": "expected_link"}
+NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+# cases evaluated at once (= pooled db connections) and queries per embeddings request
+EVAL_CONCURRENCY = rag_configs.get("EVAL_CONCURRENCY", 8)
+EVAL_EMBED_BATCH = rag_configs.get("EVAL_EMBED_BATCH", 256)
 
 client = OpenAI(api_key=OPEN_AI_KEY)
+embedding_providers = {}
+embedding_caches = {}
+embedding_caches_lock = threading.Lock()
+snapshot_index = SnapshotIndex()
+db_pool = None
+db_pool_lock = threading.Lock()
+# getconn() raises instead of waiting when the pool is exhausted, so every
+# borrower (the cases of parallel model sweeps too) takes a slot first
+db_slots = threading.BoundedSemaphore(EVAL_CONCURRENCY)
+# pool -> open db_cursor() blocks, a replaced pool is closed when it drops to 0
+db_borrowers = {}
 
 
-def embed(text: str):
-    resp = client.embeddings.create(model=EMBEDDING_MODEL, input=text)
-    return resp.data[0].embedding
+def table_for_model(model: str = None) -> str:
+    # the ingestor writes one table per model (its EMBEDDING_TABLE)
+    model = model or EMBEDDING_MODEL
+    if model in EMBEDDING_TABLES:
+        return EMBEDDING_TABLES[model]
+    if model == EMBEDDING_MODEL:
+        return EMBEDDING_TABLE
+    return f"fosils_embeddings_{model.replace('-', '_').replace('.', '_')}"
 
 
-def query_db(vector: List[float], top_k: int = 5):
-    conn = psycopg2.connect(PG_URI, cursor_factory=RealDictCursor)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT id, name, url, text, 1 - (embedding <=> %s::vector) AS score
-        FROM fosils_embeddings
-        ORDER BY embedding <=> %s::vector
-        LIMIT %s;
-        """,
-        (vector, vector, top_k)
-    )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+def get_embedding_provider(model: str = None) -> EmbeddingProvider:
+    # an openai model or a local backend (hashing-<dim>), see embedding_provider.py
+    model = model or EMBEDDING_MODEL
+    with embedding_caches_lock:
+        if model not in embedding_providers:
+            embedding_providers[model] = get_provider(model, client)
+        return embedding_providers[model]
+
+
+def get_embedding_cache(model: str = None) -> EmbeddingCache:
+    model = model or EMBEDDING_MODEL
+    name = get_embedding_provider(model).name
+    with embedding_caches_lock:
+        if model not in embedding_caches:
+            embedding_caches[model] = EmbeddingCache(name)
+        return embedding_caches[model]
+
+
+def embed_many(texts: List[str], model: str = None):
+    return get_embedding_provider(model).embed_many(texts)
+
+
+def embed(text: str, model: str = None):
+    return get_embedding_cache(model).embed_many([text], lambda missing: embed_many(missing, model))[0]
+
+
+def embed_all(texts: List[str], model: str = None):
+    # all queries of a run up front, EVAL_EMBED_BATCH per request;
+    # -> vectors and the seconds of every request that reached the api
+    batch_seconds = []
+
+    def embed_batches(missing: List[str]):
+        vectors = []
+        for start in range(0, len(missing), EVAL_EMBED_BATCH):
+            t0 = time.perf_counter()
+            vectors.extend(embed_many(missing[start:start + EVAL_EMBED_BATCH], model))
+            batch_seconds.append(time.perf_counter() - t0)
+        return vectors
+
+    return get_embedding_cache(model).embed_many(texts, embed_batches), batch_seconds
+
+
+def get_db_pool(size: int = EVAL_CONCURRENCY, borrow: bool = False):
+    # -> (pool, slots) with room for at least size borrowers. a bigger run
+    # (evaluate --concurrency above EVAL_CONCURRENCY) gets a new pool; the
+    # old one is closed as soon as its last borrower returns. borrow counts
+    # the caller as a borrower in the same step, db_cursor() releases it
+    global db_pool, db_slots
+    with db_pool_lock:
+        if db_pool is None or db_pool.maxconn < size:
+            old = db_pool
+            db_pool = ThreadedConnectionPool(1, size, PG_URI, cursor_factory=RealDictCursor)
+            db_slots = threading.BoundedSemaphore(size)
+            db_borrowers[db_pool] = 0
+            if old is not None and not db_borrowers.get(old):
+                db_borrowers.pop(old, None)
+                old.closeall()
+        if borrow:
+            db_borrowers[db_pool] += 1
+        return db_pool, db_slots
+
+
+@contextmanager
+def db_cursor():
+    pool, slots = get_db_pool(borrow=True)
+    try:
+        with slots:
+            conn = pool.getconn()
+            try:
+                yield conn.cursor()
+            finally:
+                # ends the transaction, SET LOCAL settings don't leak to the next case
+                conn.rollback()
+                pool.putconn(conn)
+    finally:
+        with db_pool_lock:
+            db_borrowers[pool] -= 1
+            if pool is not db_pool and not db_borrowers[pool]:
+                del db_borrowers[pool]
+                pool.closeall()
+
+
+def query_db(vector: List[float], top_k: int = 5, ef_search: int = None, probes: int = None, exact: bool = False,
+             backend: str = None, price_min: float = None, price_max: float = None, table: str = None,
+             quantization: str = None, oversample: int = None):
+    # quantization: "halfvec"/"binary" searches that column of the ingestor
+    # for top_k * oversample candidates and re-ranks them on the full vectors,
+    # "none" the full vectors only (default VECTOR_QUANTIZATION)
+    table = table or EMBEDDING_TABLE
+    quantization = quantization or VECTOR_QUANTIZATION
+    if (backend or RETRIEVAL_BACKEND) == "numpy":
+        if table != EMBEDDING_TABLE:
+            raise ValueError(f"The numpy snapshot only covers {EMBEDDING_TABLE}, not {table}")
+        return snapshot_index.search(vector, top_k, price_min, price_max)
+    quantized = quantization in QUANTIZED_DISTANCE and not exact
+    candidates = top_k
+    if quantized:
+        candidates = max(top_k, min(top_k * max(1, oversample or RERANK_OVERSAMPLE), MAX_EF_SEARCH))
+    with db_cursor() as cur:
+        if exact:
+            # no index scan -> sequential scan, the ground truth for ANN recall
+            cur.execute("SET LOCAL enable_indexscan = off")
+        cur.execute("SET LOCAL hnsw.ef_search = %s", (min(max(ef_search or HNSW_EF_SEARCH, candidates), MAX_EF_SEARCH),))
+        cur.execute("SET LOCAL ivfflat.probes = %s", (probes or IVFFLAT_PROBES,))
+        where = "(%s::float8 IS NULL OR price >= %s) AND (%s::float8 IS NULL OR price <= %s)"
+        if not quantized:
+            cur.execute(
+                f"""
+                SELECT id, name, url, price, text, 1 - (embedding <=> %s::vector) AS score
+                FROM {table}
+                WHERE {where}
+                ORDER BY embedding <=> %s::vector
+                LIMIT %s;
+                """,
+                (vector, price_min, price_min, price_max, price_max, vector, top_k)
+            )
+        else:
+            cur.execute(
+                f"""
+                SELECT id, name, url, price, text, 1 - (embedding <=> %s::vector) AS score
+                FROM (
+                    SELECT id, name, url, price, text, embedding
+                    FROM {table}
+                    WHERE {where}
+                    ORDER BY {QUANTIZED_DISTANCE[quantization]}
+                    LIMIT %s
+                ) candidates
+                ORDER BY embedding <=> %s::vector
+                LIMIT %s;
+                """,
+                (vector, price_min, price_min, price_max, price_max, vector, candidates, vector, top_k)
+            )
+        return cur.fetchall()
 
 
-def evaluate_once(query: str, expected: dict, top_k: int = 5):
+def lexical_query(query: str, top_k: int = 5, price_min: float = None, price_max: float = None, table: str = None):
+    with db_cursor() as cur:
+        cur.execute("SET LOCAL pg_trgm.similarity_threshold = %s", (LEXICAL_THRESHOLD,))
+        cur.execute("SET LOCAL pg_trgm.word_similarity_threshold = %s", (LEXICAL_THRESHOLD,))
+        cur.execute(
+            f"""
+            SELECT id, name, url, price, text, greatest(similarity(name, %s), word_similarity(%s, text)) AS score
+            FROM {table or EMBEDDING_TABLE}
+            WHERE (name %% %s OR %s <%% text)
+              AND (%s::float8 IS NULL OR price >= %s) AND (%s::float8 IS NULL OR price <= %s)
+            ORDER BY score DESC
+            LIMIT %s;
+            """,
+            (query, query, query, query, price_min, price_min, price_max, price_max, top_k)
+        )
+        return cur.fetchall()
+
+
+def exact_query(structured: dict, top_k: int = 5, table: str = None):
+    if structured["id"]:
+        where, params = "id = %s OR product_id = %s", (structured["id"], structured["id"])
+    else:
+        where, params = "url = %s", (structured["url"],)
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT id, name, url, price, text, 1.0::float8 AS score
+            FROM {table or EMBEDDING_TABLE}
+            WHERE {where}
+            ORDER BY chunk_index
+            LIMIT %s;
+            """,
+            (*params, top_k)
+        )
+        return cur.fetchall()
+
+
+def needs_vector(query: str, mode: str = None) -> bool:
+    # hybrid mode answers ids and urls without an embedding
+    if (mode or RETRIEVAL_MODE) != "hybrid":
+        return True
+    structured = parse_structured(query)
+    return not (structured["id"] or structured["url"])
+
+
+def retrieve(query: str, top_k: int = 5, backend: str = None, mode: str = None, vector: List[float] = None,
+             model: str = None, table: str = None):
+    # -> (results, embed seconds, search seconds, path taken); a precomputed
+    # vector isn't counted in the embed seconds
+    if (mode or RETRIEVAL_MODE) != "hybrid":
+        t0 = time.perf_counter()
+        vector = vector if vector is not None else embed(query, model)
+        t1 = time.perf_counter()
+        results = query_db(vector, top_k=top_k, backend=backend, table=table)
+        return results, t1 - t0, time.perf_counter() - t1, "vector"
+
+    structured = parse_structured(query)
+    db_time = 0.0
+    if structured["id"] or structured["url"]:
+        # exact lookups skip the embedding
+        t0 = time.perf_counter()
+        results = exact_query(structured, top_k, table)
+        db_time = time.perf_counter() - t0
+        if results:
+            return results, 0.0, db_time, "exact"
+
+    candidates = max(top_k, HYBRID_CANDIDATES)
+    price_min, price_max = structured["price_min"], structured["price_max"]
     t0 = time.perf_counter()
-    vector = embed(query)
+    vector = vector if vector is not None else embed(query, model)
     t1 = time.perf_counter()
-    results = query_db(vector, top_k=top_k)
-    t2 = time.perf_counter()
+    vector_rows = query_db(vector, top_k=candidates, backend=backend, price_min=price_min, price_max=price_max,
+                           table=table)
+    lexical_rows = lexical_query(query, candidates, price_min, price_max, table)
+    results = rrf_fuse([vector_rows, lexical_rows], top_k, HYBRID_RRF_K)
+    return results, t1 - t0, db_time + time.perf_counter() - t1, "hybrid"
 
+
+def compute_metrics(retrieved, expected_values):
+    if not expected_values:
+        return {"hit": 0, "mrr": 0.0, "ndcg": 0.0}
+    hit = int(any(v in retrieved for v in expected_values))
+    mrr = 0.0
+    for rank, item in enumerate(retrieved, start=1):
+        if item in expected_values:
+            mrr = 1.0 / rank
+            break
+    true_rel = [1 if r in expected_values else 0 for r in retrieved]
+    ndcg = ndcg_score([true_rel], [true_rel]) if sum(true_rel) > 0 else 0.0
+    return {"hit": hit, "mrr": mrr, "ndcg": ndcg}
+
+
+def evaluate_once(query: str, expected: dict, top_k: int = 5, backend: str = None, mode: str = None,
+                  vector: List[float] = None, embed_time: float = 0.0):
+    results, own_embed_time, db_time, path = retrieve(query, top_k=top_k, backend=backend, mode=mode, vector=vector)
+    return score_case(query, expected, results, embed_time + own_embed_time, db_time, path)
+
+
+def score_case(query: str, expected: dict, results: list, embed_time: float, db_time: float, path: str):
+    # metrics of one case from its retrieved rows; the model sweep scores
+    # prefixes of one max-k result list with it
     ids = [r.get("id") for r in results]
     prices = [str(r.get("price")) for r in results]
     links = [r.get("url") for r in results]
@@ -54,19 +315,6 @@ def evaluate_once(query: str, expected: dict, top_k: int = 5):
     expected_price = expected.get("expected_price", [])
     expected_link = expected.get("expected_link", [])
 
-    def compute_metrics(retrieved, expected_values):
-        if not expected_values:
-            return {"hit": 0, "mrr": 0.0, "ndcg": 0.0}
-        hit = int(any(v in retrieved for v in expected_values))
-        mrr = 0.0
-        for rank, item in enumerate(retrieved, start=1):
-            if item in expected_values:
-                mrr = 1.0 / rank
-                break
-        true_rel = [1 if r in expected_values else 0 for r in retrieved]
-        ndcg = ndcg_score([true_rel], [true_rel]) if sum(true_rel) > 0 else 0.0
-        return {"hit": hit, "mrr": mrr, "ndcg": ndcg}
-
     metrics_ids = compute_metrics(ids, expected_ids)
     metrics_price = compute_metrics(prices, expected_price)
     metrics_link = compute_metrics(links, expected_link)
@@ -84,27 +332,102 @@ def evaluate_once(query: str, expected: dict, top_k: int = 5):
         "metrics_price": metrics_price,
         "metrics_link": metrics_link,
         "combined_hit": combined_hit,
-        "embed_time": t1 - t0,
-        "db_time": t2 - t1,
-        "total_time": t2 - t0
+        "path": path,
+        "embed_time": embed_time,
+        "db_time": db_time,
+        "total_time": embed_time + db_time
     }
 
 
-def evaluate_all(ground_truth_path: str, top_k: int = 5):
-    with open(ground_truth_path, "r", encoding="utf-8") as f:
-        cases = json.load(f)
-
-    results = []
-    for c in cases:
-        query = c.get("query")
-        expected = {
-            "expected_ids": c.get("expected_ids", []),
-            "expected_price": c.get("expected_price", []),
-            "expected_link": c.get("expected_link", [])
+def field_report(results: list) -> dict:
+    # metrics and latency per field over the cases that expect that field
+    # (the avg_* summary values average over all cases)
+    report = {}
+    for field, key in FIELDS.items():
+        cases = [r for r in results if r["expected"].get(key)]
+        if not cases:
+            continue
+        report[field] = {
+            "cases": len(cases),
+            "hit": float(np.mean([r[f"metrics_{field}"]["hit"] for r in cases])),
+            "mrr": float(np.mean([r[f"metrics_{field}"]["mrr"] for r in cases])),
+            "ndcg": float(np.mean([r[f"metrics_{field}"]["ndcg"] for r in cases])),
+            "latency_s": float(np.mean([r["total_time"] for r in cases])),
+            "exact_lookups": sum(r["path"] == "exact" for r in cases)
         }
-        res = evaluate_once(query, expected, top_k=top_k)
-        results.append(res)
+    return report
+
+
+def build_messages(context: str, question: str) -> list:
+    # the prompt of the websocket service
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {question}"}
+    ]
+
+
+def answer_query(query: str, context: str) -> dict:
+    # one streamed answer: time to the first token and to the last one, and
+    # the token usage when the api reports it
+    t0 = time.perf_counter()
+    ttft, parts, usage = None, [], None
+    stream = client.chat.completions.create(
+        model=LLM_MODEL, messages=build_messages(context, query), stream=True,
+        stream_options={"include_usage": True}
+    )
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            if ttft is None:
+                ttft = time.perf_counter() - t0
+            parts.append(chunk.choices[0].delta.content)
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+    total = time.perf_counter() - t0
+    return {
+        "answer": "".join(parts),
+        "ttft_s": ttft if ttft is not None else total,
+        "total_s": total,
+        "prompt_tokens": usage.prompt_tokens if usage else None,
+        "completion_tokens": usage.completion_tokens if usage else None
+    }
+
+
+def answer_hit(answer: str, expected: dict):
+    # whether the answer names an expected product id, link or price;
+    # None when the case expects none of them
+    ids = [str(v).rsplit("_", 1)[0] for v in expected.get("expected_ids", [])]
+    links = [str(v) for v in expected.get("expected_link", [])]
+    prices = [float(v) for v in expected.get("expected_price", [])]
+    if not (ids or links or prices):
+        return None
+    answer = answer or ""
+    numbers = {float(n.replace(",", ".")) for n in NUMBER_RE.findall(answer)}
+    # whole ids and links only: id 51 is no hit on 5186 (it is on the chunk id
+    # 51_0), a link is no hit on a longer path
+    return (
+        any(re.search(rf"(?<!\w){re.escape(v)}(?![^\W_])", answer) for v in ids)
+        or any(re.search(rf"{re.escape(v)}(?![\w/.-]*\w)", answer) for v in links)
+        or any(p in numbers for p in prices)
+    )
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0, "max": 0.0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99),
+            "mean": float(np.mean(values)), "max": float(np.max(values))}
+
 
+def expected_of(case: dict) -> dict:
+    return {
+        "expected_ids": case.get("expected_ids", []),
+        "expected_price": case.get("expected_price", []),
+        "expected_link": case.get("expected_link", [])
+    }
+
+
+def summarize(results: list, top_k: int, backend: str = None, mode: str = None) -> dict:
     avg_hit_ids = float(np.mean([r["metrics_ids"]["hit"] for r in results]))
     avg_hit_price = float(np.mean([r["metrics_price"]["hit"] for r in results]))
     avg_hit_link = float(np.mean([r["metrics_link"]["hit"] for r in results]))
@@ -120,9 +443,11 @@ def evaluate_all(ground_truth_path: str, top_k: int = 5):
 
     avg_latency = float(np.mean([r["total_time"] for r in results]))
 
-    summary = {
+    return {
         "cases": len(results),
         "top_k": top_k,
+        "backend": backend or RETRIEVAL_BACKEND,
+        "mode": mode or RETRIEVAL_MODE,
         "avg_hit_ids": avg_hit_ids,
         "avg_hit_price": avg_hit_price,
         "avg_hit_link": avg_hit_link,
@@ -134,7 +459,52 @@ def evaluate_all(ground_truth_path: str, top_k: int = 5):
         "avg_ndcg_price": avg_ndcg_price,
         "avg_ndcg_link": avg_ndcg_link,
         "avg_latency_s": avg_latency,
-        "details": results
+        "latency_s": {
+            "embed": percentiles([r["embed_time"] for r in results]),
+            "db": percentiles([r["db_time"] for r in results]),
+            "total": percentiles([r["total_time"] for r in results])
+        },
+        "fields": field_report(results)
     }
 
-    return summary
\ No newline at end of file
+
+def evaluate_all(ground_truth_path: str, top_k: int = 5, backend: str = None, mode: str = None,
+                 concurrency: int = EVAL_CONCURRENCY):
+    with open(ground_truth_path, "r", encoding="utf-8") as f:
+        cases = json.load(f)
+    wall_t0 = time.perf_counter()
+
+    # 1. embeddings of all queries in a few batched requests, the time of
+    # every request is spread over its queries
+    queries = [c.get("query") for c in cases]
+    to_embed = sorted({q for q in queries if needs_vector(q, mode)})
+    t0 = time.perf_counter()
+    vectors, batch_seconds = embed_all(to_embed)
+    embed_seconds = time.perf_counter() - t0
+    vector_of = dict(zip(to_embed, vectors))
+    embed_share = embed_seconds / len(to_embed) if to_embed else 0.0
+
+    # 2. the lookups with bounded concurrency over one connection pool
+    get_db_pool(max(1, concurrency))
+    def run_case(c):
+        query = c.get("query")
+        vector = vector_of.get(query)
+        return evaluate_once(query, expected_of(c), top_k=top_k, backend=backend, mode=mode,
+                             vector=vector, embed_time=embed_share if vector is not None else 0.0)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        results = list(executor.map(run_case, cases))
+
+    summary = summarize(results, top_k, backend, mode)
+    summary["latency_s"]["embed_requests"] = percentiles(batch_seconds)
+    summary.update({
+        "embed_phase_s": embed_seconds,
+        "wall_time_s": time.perf_counter() - wall_t0,
+        "concurrency": concurrency,
+        "vector_quantization": VECTOR_QUANTIZATION,
+        "rerank_oversample": RERANK_OVERSAMPLE,
+        "embedding_provider": get_embedding_provider().report(),
+        "embedding_cache": get_embedding_cache().report(),
+        "details": results
+    })
+    return summary
@@ -0,0 +1,203 @@
+# local stand-in for the openai api, used to measure throughput offline.
+# point any service to it with OPENAI_BASE_URL=http://<host>:8100/v1
+#
+#   python fake_openai.py --port 8100 --latency-ms 80 --per-item-ms 0.5 --ttft-ms 300 --token-ms 20
+#
+# embeddings are deterministic hashed character trigrams, so similar texts
+# get similar vectors and retrieval results stay meaningful. chat completions
+# answer with a canned text, streamed word by word when stream=true.
+
+import json
+import math
+import time
+import zlib
+import base64
+import array
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_embedding(text: str, dim: int) -> list:
+    vec = [0.0] * dim
+    padded = f"  {text.lower()}  "
+    for i in range(len(padded) - 2):
+        h = zlib.crc32(padded[i:i + 3].encode("utf-8"))
+        vec[h % dim] += 1.0 if (h >> 16) & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+
+def model_dim(model: str) -> int:
+    return 3072 if "large" in (model or "") else 1536
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings = {
+        "latency_ms": 0.0,
+        "per_item_ms": 0.0,
+        "rate_limit_every": 0,
+        "ttft_ms": 0.0,
+        "token_ms": 0.0,
+        "prompt_token_ms": 0.0,
+        "answer_words": 40
+    }
+    counter = {"requests": 0}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+
+        with self.lock:
+            self.counter["requests"] += 1
+            n = self.counter["requests"]
+        every = self.settings["rate_limit_every"]
+        if every and n % every == 0:
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                           {"Retry-After": "0.2"})
+            return
+
+        if self.path.endswith("/embeddings"):
+            self.handle_embeddings(payload)
+        elif self.path.endswith("/chat/completions"):
+            self.handle_chat(payload)
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def handle_embeddings(self, payload: dict):
+        inputs = payload.get("input")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        model = payload.get("model")
+        dim = payload.get("dimensions") or model_dim(model)
+
+        time.sleep((self.settings["latency_ms"] + self.settings["per_item_ms"] * len(inputs)) / 1000)
+
+        data = []
+        for i, text in enumerate(inputs):
+            vector = fake_embedding(text, dim)
+            if payload.get("encoding_format") == "base64":
+                vector = base64.b64encode(array.array("f", vector).tobytes()).decode("ascii")
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+
+        tokens = sum(len(t) // 2 + 1 for t in inputs)
+        self.send_json(200, {
+            "object": "list",
+            "data": data,
+            "model": model,
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        })
+
+    def fake_answer(self, payload: dict) -> list:
+        question = (payload.get("messages") or [{}])[-1].get("content", "").split("Question:")[-1].strip()
+        words = f"Примерен отговор на въпроса „{question}“:".split()
+        words += ["фосил"] * max(0, self.settings["answer_words"] - len(words))
+        return [w if i == 0 else f" {w}" for i, w in enumerate(words)]
+
+    def handle_chat(self, payload: dict):
+        model = payload.get("model")
+        tokens = self.fake_answer(payload)
+        # the prompt is "read" before the first token, longer prompts answer later
+        prompt_tokens = sum(len(m.get("content") or "") // 2 + 1 for m in payload.get("messages") or [])
+        ttft_ms = self.settings["ttft_ms"] + self.settings["prompt_token_ms"] * prompt_tokens
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens)}
+
+        if not payload.get("stream"):
+            time.sleep((ttft_ms + self.settings["token_ms"] * len(tokens)) / 1000)
+            self.send_json(200, {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            })
+            return
+
+        # server-sent events until the connection is closed
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta: dict, finish_reason=None, usage=None):
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if usage is None else []
+            }
+            if usage is not None:
+                chunk["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            time.sleep(ttft_ms / 1000)
+            event({"role": "assistant", "content": ""})
+            for token in tokens:
+                event({"content": token})
+                time.sleep(self.settings["token_ms"] / 1000)
+            event({}, "stop")
+            if (payload.get("stream_options") or {}).get("include_usage"):
+                event({}, usage=usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client cancelled the stream
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=0.0, dest="latency_ms")
+    parser.add_argument("--per-item-ms", type=float, default=0.0, dest="per_item_ms")
+    parser.add_argument("--rate-limit-every", type=int, default=0, dest="rate_limit_every",
+                        help="answer every N-th request with 429 to exercise retries")
+    parser.add_argument("--ttft-ms", type=float, default=0.0, dest="ttft_ms", help="chat time to first token")
+    parser.add_argument("--token-ms", type=float, default=0.0, dest="token_ms", help="chat delay per streamed token")
+    parser.add_argument("--prompt-token-ms", type=float, default=0.0, dest="prompt_token_ms",
+                        help="chat delay per prompt token before the first one")
+    parser.add_argument("--answer-words", type=int, default=40, dest="answer_words")
+    args = parser.parse_args()
+
+    FakeOpenAIHandler.settings.update(
+        latency_ms=args.latency_ms,
+        per_item_ms=args.per_item_ms,
+        rate_limit_every=args.rate_limit_every,
+        ttft_ms=args.ttft_ms,
+        token_ms=args.token_ms,
+        prompt_token_ms=args.prompt_token_ms,
+        answer_words=args.answer_words
+    )
+    server = ThreadingHTTPServer((args.host, args.port), FakeOpenAIHandler)
+    print(f"Fake OpenAI listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
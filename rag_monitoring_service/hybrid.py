@@ -0,0 +1,62 @@
+# helpers of the hybrid retrieval mode: structured parts of a query (exact
+# id/url, price bounds) that are answered by indexed sql predicates, and
+# reciprocal rank fusion of the vector and lexical rankings.
+# the same file is copied into the websocket and monitoring services.
+
+import re
+
+URL_RE = re.compile(r"https?://[^\s\"'<>]+", re.IGNORECASE)
+# "id 5186", "идентификатор: 5186_0", "артикул №1252" or a bare chunk id "5186_0"
+ID_RE = re.compile(r"(?:\bid\b|идентификатор|артикул|№)\s*[:#№]?\s*(\d+(?:_\d+)?)\b", re.IGNORECASE)
+CHUNK_ID_RE = re.compile(r"\b(\d+_\d+)\b")
+
+NUMBER = r"(\d+(?:[.,]\d+)?)"
+CURRENCY = r"\s*(?:лв\.?|лева|bgn|€|eur|евро)"
+PRICE_WORD_RE = re.compile(r"цен[аи]|струва|price|евтин|скъп", re.IGNORECASE)
+PRICE_RANGE_RE = re.compile(rf"(?:между|от|between|from)\s*{NUMBER}\s*(?:и|до|-|and|to)\s*{NUMBER}", re.IGNORECASE)
+PRICE_MAX_RE = re.compile(rf"(?:под|до|по-евтин\w*\s+от|under|below|<=?)\s*{NUMBER}", re.IGNORECASE)
+PRICE_MIN_RE = re.compile(rf"(?:над|по-скъп\w*\s+от|over|above|>=?)\s*{NUMBER}", re.IGNORECASE)
+CURRENCY_RE = re.compile(rf"{NUMBER}{CURRENCY}", re.IGNORECASE)
+
+
+def to_number(value: str) -> float:
+    return float(value.replace(",", "."))
+
+
+def price_bounds(query: str):
+    # only numbers that are clearly prices: followed by a currency or in a
+    # query that talks about price ("до 12см" is a size, not a price filter)
+    if not (PRICE_WORD_RE.search(query) or CURRENCY_RE.search(query)):
+        return None, None
+    match = PRICE_RANGE_RE.search(query)
+    if match:
+        lo, hi = sorted((to_number(match.group(1)), to_number(match.group(2))))
+        return lo, hi
+    lo = PRICE_MIN_RE.search(query)
+    hi = PRICE_MAX_RE.search(query)
+    return (to_number(lo.group(1)) if lo else None), (to_number(hi.group(1)) if hi else None)
+
+
+def parse_structured(query: str) -> dict:
+    url = URL_RE.search(query)
+    product_id = ID_RE.search(query) or CHUNK_ID_RE.search(query)
+    price_min, price_max = price_bounds(query)
+    return {
+        "url": url.group(0).rstrip(".,;:!?)") if url else None,
+        "id": product_id.group(1) if product_id else None,
+        "price_min": price_min,
+        "price_max": price_max
+    }
+
+
+def rrf_fuse(rankings: list, top_k: int, k: int = 60) -> list:
+    # reciprocal rank fusion: score = sum of 1 / (k + rank) over the rankings
+    # a row appears in. only ranks matter, so cosine and trigram scores don't
+    # have to be comparable
+    scores, rows = {}, {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            scores[row["id"]] = scores.get(row["id"], 0.0) + 1.0 / (k + rank)
+            rows.setdefault(row["id"], row)
+    best = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [{**rows[i], "score": scores[i]} for i in best]
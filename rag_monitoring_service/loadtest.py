@@ -0,0 +1,250 @@
+# open-loop load test of the websocket service: queries arrive as a poisson
+# process at a fixed rate, whether or not earlier ones were answered, and are
+# spread over a fixed number of websocket connections (least pending first).
+# latency is measured from the scheduled arrival, so a server that falls
+# behind shows it in the percentiles instead of slowing the arrivals down.
+# a sweep over increasing rates finds where the service saturates.
+#
+# meant to run against stand-ins: fake_openai.py for the embeddings and
+# answers, and a pgvector database seeded here with synthetic products whose
+# embeddings match the fake server's (see the loadtest compose profile).
+
+import os
+import json
+import time
+import random
+import asyncio
+import subprocess
+from collections import deque
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+import websockets
+from fake_openai import fake_embedding, model_dim
+
+LOADTEST_PG_URI = os.getenv("LOADTEST_PG_URI", "postgresql://postgres:postgres@db:5432/loadtest")
+LOADTEST_URL = os.getenv("LOADTEST_URL", "ws://localhost:8000/ws")
+
+WORDS = "амонит белемнит трилобит мегалодон зъб фосил юра креда мароко опализиран рядък образец камък".split()
+
+
+def ensure_database(pg_uri: str):
+    base, name = pg_uri.rsplit("/", 1)
+    conn = psycopg2.connect(f"{base}/postgres")
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (name,))
+            if cur.fetchone() is None:
+                cur.execute(f'CREATE DATABASE "{name}"')
+    finally:
+        conn.close()
+
+
+def seed_db(pg_uri: str = LOADTEST_PG_URI, products: int = 5000, model: str = "text-embedding-3-small",
+            seed: int = 7):
+    # same schema, indexes and products view as the ingestor creates, filled
+    # with synthetic products embedded the way fake_openai.py embeds queries
+    name = pg_uri.rsplit("/", 1)[1]
+    if name == "postgres":
+        raise ValueError("Refusing to replace fosils_embeddings in the main database, use a separate one")
+    ensure_database(pg_uri)
+    rng = random.Random(seed)
+    dim = model_dim(model)
+
+    rows = []
+    for i in range(products):
+        product_name = f"{rng.choice(WORDS).capitalize()} {rng.choice(WORDS)} {i}"
+        price = round(rng.uniform(1, 500), 2)
+        url = f"https://example.com/4-fosili/{i}-loadtest"
+        description = " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80)))
+        text = f"{description} име: {product_name} цена: {price} id/идентификатор: {i} урл/линк/url {url}"
+        vector = "[" + ",".join(map(str, fake_embedding(text, dim))) + "]"
+        rows.append((f"{i}_0", product_name, url, price, 0, text, vector, str(i), None))
+
+    t0 = time.perf_counter()
+    conn = psycopg2.connect(pg_uri)
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cur.execute("DROP TABLE IF EXISTS fosils_embeddings CASCADE")
+            cur.execute(f"""
+                CREATE TABLE fosils_embeddings (
+                    id VARCHAR PRIMARY KEY, name VARCHAR, url VARCHAR, price FLOAT, chunk_index INTEGER,
+                    text VARCHAR, embedding vector({dim}), product_id VARCHAR, content_hash VARCHAR
+                )
+            """)
+            execute_values(
+                cur,
+                "INSERT INTO fosils_embeddings (id, name, url, price, chunk_index, text, embedding, product_id, "
+                "content_hash) VALUES %s",
+                rows, page_size=500
+            )
+            cur.execute("CREATE INDEX ON fosils_embeddings (product_id)")
+            cur.execute("CREATE INDEX ON fosils_embeddings USING hnsw (embedding vector_cosine_ops)")
+            cur.execute("CREATE INDEX ON fosils_embeddings USING gin (name gin_trgm_ops)")
+            cur.execute("CREATE INDEX ON fosils_embeddings USING gin (text gin_trgm_ops)")
+            cur.execute("CREATE INDEX ON fosils_embeddings (url)")
+            cur.execute("CREATE INDEX ON fosils_embeddings (price)")
+            cur.execute(
+                "CREATE MATERIALIZED VIEW fosils_products AS "
+                "SELECT DISTINCT ON (product_id) product_id, name, url, price "
+                "FROM fosils_embeddings ORDER BY product_id, chunk_index"
+            )
+            cur.execute("CREATE UNIQUE INDEX fosils_products_product_id_idx ON fosils_products (product_id)")
+            cur.execute("CREATE INDEX fosils_products_price_idx ON fosils_products (price)")
+    finally:
+        conn.close()
+    print(f"Seeded {products} products into {name} in {time.perf_counter() - t0:.1f}s")
+
+
+def percentiles_ms(values: list) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50) * 1000, "p95": float(p95) * 1000, "p99": float(p99) * 1000,
+            "mean": float(np.mean(values)) * 1000, "max": float(np.max(values)) * 1000}
+
+
+class Connection:
+    # one websocket; the service answers the queries of a connection in
+    # order with exactly one message each (non-streaming), so replies are
+    # matched to the pending queries first in, first out
+    def __init__(self, ws, results: list):
+        self.ws = ws
+        self.pending = deque()
+        self.results = results
+        self.reader = asyncio.create_task(self.read())
+
+    async def read(self):
+        try:
+            async for message in self.ws:
+                scheduled, kind = self.pending.popleft()
+                self.results.append({
+                    "kind": kind,
+                    "latency_s": time.perf_counter() - scheduled,
+                    "done_at": time.perf_counter(),
+                    "error": "error" in json.loads(message)
+                })
+        except websockets.ConnectionClosed:
+            pass
+
+
+async def run_rate(url: str, rate: float, duration_s: float, clients: int, queries: list, gpt_ratio: float,
+                   unique_ratio: float, drain_s: float, rng: random.Random) -> dict:
+    results = []
+    connections = [Connection(await websockets.connect(url, max_size=None), results) for _ in range(clients)]
+    send_errors, send_lags, sent = 0, [], 0
+    start = time.perf_counter()
+    at = rng.expovariate(rate)
+    while at < duration_s:
+        delay = start + at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            send_lags.append(-delay)
+        query = rng.choice(queries)
+        if rng.random() < unique_ratio:
+            # misses both caches of the service
+            query = f"{query} {rng.randrange(10 ** 9)}"
+        kind = "gpt_answer" if rng.random() < gpt_ratio else "retrieval"
+        connection = min(connections, key=lambda c: len(c.pending))
+        connection.pending.append((start + at, kind))
+        try:
+            await connection.ws.send(json.dumps({"query": query, "gpt_answer": kind == "gpt_answer"}))
+        except websockets.ConnectionClosed:
+            connection.pending.pop()
+            send_errors += 1
+        sent += 1
+        at += rng.expovariate(rate)
+
+    # what is still unanswered drain_s after the last arrival counts as timed out
+    deadline = time.perf_counter() + drain_s
+    while any(c.pending for c in connections) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    timeouts = sum(len(c.pending) for c in connections)
+    for c in connections:
+        await c.ws.close()
+        c.reader.cancel()
+
+    ok = [r for r in results if not r["error"]]
+    errors = len(results) - len(ok) + send_errors + timeouts
+    elapsed = max([duration_s] + [r["done_at"] - start for r in results])
+    return {
+        "offered_rps": rate,
+        "duration_s": duration_s,
+        "clients": clients,
+        "sent": sent,
+        "completed": len(ok),
+        "errors": len(results) - len(ok),
+        "send_errors": send_errors,
+        "timeouts": timeouts,
+        "error_rate": errors / sent if sent else 0.0,
+        "throughput_rps": len(ok) / elapsed,
+        "latency_ms": percentiles_ms([r["latency_s"] for r in ok]),
+        "latency_ms_by_kind": {
+            kind: percentiles_ms([r["latency_s"] for r in ok if r["kind"] == kind])
+            for kind in ("retrieval", "gpt_answer")
+        },
+        # the generator itself falling behind the schedule
+        "max_send_lag_ms": max(send_lags) * 1000 if send_lags else 0.0
+    }
+
+
+def is_saturated(report: dict, slo_p95_ms: float, max_error_rate: float) -> bool:
+    p95 = report["latency_ms"]["p95"]
+    return (
+        report["throughput_rps"] < 0.9 * report["offered_rps"]
+        or report["error_rate"] > max_error_rate
+        or p95 is None or p95 > slo_p95_ms
+    )
+
+
+def git_commit() -> str:
+    commit = os.getenv("GIT_COMMIT")
+    if commit:
+        return commit
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def sweep(url: str, rates: list, duration_s: float, clients: int, queries: list, gpt_ratio: float,
+                unique_ratio: float, drain_s: float, slo_p95_ms: float, max_error_rate: float,
+                keep_going: bool = False, seed: int = 7) -> dict:
+    rng = random.Random(seed)
+    steps, max_sustained, saturation = [], None, None
+    for rate in sorted(rates):
+        report = await run_rate(url, rate, duration_s, clients, queries, gpt_ratio, unique_ratio, drain_s, rng)
+        report["saturated"] = is_saturated(report, slo_p95_ms, max_error_rate)
+        steps.append(report)
+        latency = report["latency_ms"]
+        print(
+            f"rate={rate:g}/s throughput={report['throughput_rps']:.1f}/s "
+            f"p50={latency['p50'] or 0:.0f}ms p95={latency['p95'] or 0:.0f}ms p99={latency['p99'] or 0:.0f}ms "
+            f"errors={report['error_rate']:.1%}{' SATURATED' if report['saturated'] else ''}"
+        )
+        if report["saturated"]:
+            saturation = saturation or rate
+            if not keep_going:
+                break
+        elif saturation is None:
+            max_sustained = rate
+    return {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "url": url,
+        "config": {
+            "rates": sorted(rates), "duration_s": duration_s, "clients": clients, "gpt_ratio": gpt_ratio,
+            "unique_ratio": unique_ratio, "slo_p95_ms": slo_p95_ms, "max_error_rate": max_error_rate
+        },
+        # highest rate below the first saturated one, and that one
+        "max_sustained_rps": max_sustained,
+        "saturation_rps": saturation,
+        "steps": steps
+    }
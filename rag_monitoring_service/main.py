@@ -4,7 +4,7 @@ import argparse
 import json
 from config import rag_configs
 from evaluate import evaluate_all
-from optimization import run_experiments, pick_best
+from optimization import run_experiments, pick_best, run_index_sweep, run_quantization_bench, run_context_bench
 
 GT = os.path.join(os.path.dirname(__file__), "ground_truth.json")
 REPORTS_DIR = os.path.join(os.path.dirname(__file__), "reports")
@@ -12,7 +12,7 @@ os.makedirs(REPORTS_DIR, exist_ok=True)
 
 def cmd_evaluate(args):
     top_k = args.top_k or rag_configs.get("TOP_K", 5)
-    summary = evaluate_all(GT, top_k=top_k)
+    summary = evaluate_all(GT, top_k=top_k, mode=args.mode, concurrency=args.concurrency)
     out = os.path.join(REPORTS_DIR, f"eval_summary_topk{top_k}.json")
     with open(out, "w", encoding="utf-8") as f:
         json.dump(summary, f, ensure_ascii=False, indent=2)
@@ -30,30 +30,189 @@ def cmd_evaluate(args):
         f"link={summary['avg_ndcg_link']:.3f} "
         f"latency={summary['avg_latency_s']:.3f}s"
     )
+    for name, dist in summary["latency_s"].items():
+        print(
+            f"{name} latency p50={dist['p50'] * 1000:.1f}ms p95={dist['p95'] * 1000:.1f}ms "
+            f"p99={dist['p99'] * 1000:.1f}ms"
+        )
+    print(f"wall time {summary['wall_time_s']:.2f}s ({summary['cases']} cases, concurrency {summary['concurrency']})")
 
 def cmd_optimize(args):
     embedding_models = args.embedding_models or [rag_configs.get("EMBEDDING_MODEL")]
     top_ks = args.top_ks or [rag_configs.get("TOP_K", 5)]
     out = os.path.join(REPORTS_DIR, "opt_reports.json")
-    reports = run_experiments(GT, embedding_models, top_ks, out)
+    reports = run_experiments(GT, embedding_models, top_ks, out, mode=args.mode, resume=not args.fresh)
     best = pick_best(reports)
     if best:
         print("BEST:", best["embedding_model"], "top_k", best["top_k"])
     print(f"Wrote {out}")
 
+    if args.ef_search or args.probes:
+        out = os.path.join(REPORTS_DIR, "index_sweep.json")
+        run_index_sweep(GT, max(top_ks), args.ef_search, args.probes, out)
+        print(f"Wrote {out}")
+
+def cmd_bench_backends(args):
+    # same ground truth through every retrieval backend; the embeddings are
+    # cached after the first pass, so the db/search time is what differs
+    top_k = args.top_k or rag_configs.get("TOP_K", 5)
+    reports = []
+    for backend in args.backends:
+        summary = evaluate_all(GT, top_k=top_k, backend=backend)
+        db_times = [d["db_time"] for d in summary["details"]]
+        report = {
+            "backend": backend,
+            "top_k": top_k,
+            "avg_hit_combined": summary["avg_hit_combined"],
+            "avg_ndcg_ids": summary["avg_ndcg_ids"],
+            "avg_search_latency_s": sum(db_times) / len(db_times) if db_times else 0.0,
+            "max_search_latency_s": max(db_times) if db_times else 0.0,
+            "avg_latency_s": summary["avg_latency_s"]
+        }
+        reports.append(report)
+        print(
+            f"backend={backend} hit={report['avg_hit_combined']:.3f} ndcg ids={report['avg_ndcg_ids']:.3f} "
+            f"search avg={report['avg_search_latency_s'] * 1000:.2f}ms max={report['max_search_latency_s'] * 1000:.2f}ms"
+        )
+    out = os.path.join(REPORTS_DIR, "backend_bench.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(reports, f, ensure_ascii=False, indent=2)
+    print(f"Wrote {out}")
+
+def cmd_bench_hybrid(args):
+    # vector vs hybrid retrieval, per field of the ground truth; gains are
+    # hybrid minus vector for the metrics and vector / hybrid for the latency.
+    # the vector pass warms the embedding cache, so the latency gain of the
+    # exact lookups (which skip the embedding) is a lower bound
+    top_k = args.top_k or rag_configs.get("TOP_K", 5)
+    fields = {mode: evaluate_all(GT, top_k=top_k, mode=mode)["fields"] for mode in ("vector", "hybrid")}
+    report = {"top_k": top_k, "fields": {}}
+    for field, vector in fields["vector"].items():
+        hybrid = fields["hybrid"][field]
+        gain = {m: hybrid[m] - vector[m] for m in ("hit", "mrr", "ndcg")}
+        gain["latency_speedup"] = vector["latency_s"] / hybrid["latency_s"] if hybrid["latency_s"] else None
+        report["fields"][field] = {"vector": vector, "hybrid": hybrid, "gain": gain}
+        print(
+            f"{field}: hit {vector['hit']:.3f} -> {hybrid['hit']:.3f} "
+            f"mrr {vector['mrr']:.3f} -> {hybrid['mrr']:.3f} "
+            f"ndcg {vector['ndcg']:.3f} -> {hybrid['ndcg']:.3f} "
+            f"latency {vector['latency_s'] * 1000:.1f}ms -> {hybrid['latency_s'] * 1000:.1f}ms "
+            f"({hybrid['exact_lookups']}/{hybrid['cases']} exact lookups)"
+        )
+    out = os.path.join(REPORTS_DIR, "hybrid_bench.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Wrote {out}")
+
+def cmd_bench_quantization(args):
+    top_k = args.top_k or rag_configs.get("TOP_K", 5)
+    out = os.path.join(REPORTS_DIR, "quantization_bench.json")
+    report = run_quantization_bench(GT, top_k, args.oversample, out)
+    storage = report["storage"]
+    print(
+        f"table {storage['table_bytes'] / 2 ** 20:.1f}MiB indexes {storage['indexes_bytes'] / 2 ** 20:.1f}MiB "
+        f"vectors " + " ".join(f"{c}={b:.0f}B" for c, b in storage["avg_vector_bytes"].items())
+    )
+    print(f"Wrote {out}")
+
+def cmd_bench_context(args):
+    top_k = args.top_k or rag_configs.get("TOP_K", 5)
+    out = os.path.join(REPORTS_DIR, "context_bench.json")
+    report = run_context_bench(GT, top_k, out, args.modes, args.rounds)
+    raw, compact = report["modes"].get("raw"), report["modes"].get("compact")
+    if raw and compact and compact["total_s"]["p50"]:
+        print(
+            f"compact context: {compact['avg_estimated_prompt_tokens'] / raw['avg_estimated_prompt_tokens']:.2f}x "
+            f"the prompt tokens, answers {raw['total_s']['p50'] / compact['total_s']['p50']:.2f}x faster (p50)"
+        )
+    print(f"Wrote {out}")
+
+def cmd_loadtest(args):
+    # imported here, the other commands don't need websockets
+    import asyncio
+    from loadtest import seed_db, sweep, LOADTEST_PG_URI, WORDS
+
+    if args.seed_products:
+        seed_db(args.pg_uri or LOADTEST_PG_URI, args.seed_products, rag_configs.get("EMBEDDING_MODEL"))
+    if args.seed_only:
+        return
+    with open(GT, "r", encoding="utf-8") as f:
+        queries = [c["query"] for c in json.load(f)] + WORDS
+    report = asyncio.run(sweep(
+        args.url, args.rates, args.duration, args.clients, queries, args.gpt_ratio, args.unique_ratio,
+        args.drain, args.slo_p95_ms, args.max_error_rate, args.keep_going
+    ))
+    print(f"max sustained {report['max_sustained_rps']}/s, saturated at {report['saturation_rps']}/s")
+    out = os.path.join(REPORTS_DIR, "loadtest.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    # one line per run, to compare across commits
+    history = {k: v for k, v in report.items() if k != "steps"}
+    history["steps"] = [
+        {k: step[k] for k in ("offered_rps", "throughput_rps", "latency_ms", "error_rate", "saturated")}
+        for step in report["steps"]
+    ]
+    with open(os.path.join(REPORTS_DIR, "loadtest_history.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(history, ensure_ascii=False) + "\n")
+    print(f"Wrote {out}")
+
 def main():
     parser = argparse.ArgumentParser()
     sub = parser.add_subparsers(dest="cmd")
     p_eval = sub.add_parser("evaluate")
     p_eval.add_argument("--top-k", type=int, dest="top_k")
+    p_eval.add_argument("--mode", choices=["vector", "hybrid"])
+    p_eval.add_argument("--concurrency", type=int, default=rag_configs.get("EVAL_CONCURRENCY", 8))
     p_opt = sub.add_parser("optimize")
     p_opt.add_argument("--embedding-models", nargs="+", dest="embedding_models")
     p_opt.add_argument("--top-ks", nargs="+", type=int, dest="top_ks")
+    p_opt.add_argument("--mode", choices=["vector", "hybrid"])
+    p_opt.add_argument("--fresh", action="store_true", help="ignore the results of an interrupted sweep")
+    p_opt.add_argument("--ef-search", nargs="+", type=int, dest="ef_search")
+    p_opt.add_argument("--probes", nargs="+", type=int, dest="probes")
+    p_bench = sub.add_parser("bench-backends")
+    p_bench.add_argument("--top-k", type=int, dest="top_k")
+    p_bench.add_argument("--backends", nargs="+", default=["pgvector", "numpy"])
+    p_hybrid = sub.add_parser("bench-hybrid")
+    p_hybrid.add_argument("--top-k", type=int, dest="top_k")
+    p_quant = sub.add_parser("bench-quantization")
+    p_quant.add_argument("--top-k", type=int, dest="top_k")
+    p_quant.add_argument("--oversample", nargs="+", type=int, default=[1, 2, 4, 8])
+    p_context = sub.add_parser("bench-context")
+    p_context.add_argument("--top-k", type=int, dest="top_k")
+    p_context.add_argument("--modes", nargs="+", default=["raw", "compact"], choices=["raw", "compact"])
+    p_context.add_argument("--rounds", type=int, default=1, help="answers per case and mode")
+    p_load = sub.add_parser("loadtest")
+    p_load.add_argument("--url", default=os.getenv("LOADTEST_URL", "ws://localhost:8000/ws"))
+    p_load.add_argument("--rates", nargs="+", type=float, default=[5, 10, 20, 40, 80, 160], help="arrivals per second")
+    p_load.add_argument("--duration", type=float, default=20.0, help="seconds per rate")
+    p_load.add_argument("--clients", type=int, default=50, help="websocket connections the arrivals are spread over")
+    p_load.add_argument("--gpt-ratio", type=float, default=0.2, dest="gpt_ratio")
+    p_load.add_argument("--unique-ratio", type=float, default=0.5, dest="unique_ratio",
+                        help="share of queries made unique so they miss the caches")
+    p_load.add_argument("--drain", type=float, default=10.0, help="seconds to wait for answers after the last arrival")
+    p_load.add_argument("--slo-p95-ms", type=float, default=1000.0, dest="slo_p95_ms")
+    p_load.add_argument("--max-error-rate", type=float, default=0.01, dest="max_error_rate")
+    p_load.add_argument("--keep-going", action="store_true", dest="keep_going", help="don't stop at the first saturated rate")
+    p_load.add_argument("--seed-products", type=int, default=0, dest="seed_products",
+                        help="(re)create the load test database with N synthetic products first")
+    p_load.add_argument("--seed-only", action="store_true", dest="seed_only")
+    p_load.add_argument("--pg-uri", dest="pg_uri")
     args = parser.parse_args()
     if args.cmd == "evaluate":
         cmd_evaluate(args)
     elif args.cmd == "optimize":
         cmd_optimize(args)
+    elif args.cmd == "bench-backends":
+        cmd_bench_backends(args)
+    elif args.cmd == "bench-hybrid":
+        cmd_bench_hybrid(args)
+    elif args.cmd == "bench-quantization":
+        cmd_bench_quantization(args)
+    elif args.cmd == "bench-context":
+        cmd_bench_context(args)
+    elif args.cmd == "loadtest":
+        cmd_loadtest(args)
     else:
         parser.print_help()
 
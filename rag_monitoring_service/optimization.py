@@ -1,21 +1,160 @@
 import os
 import time
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from config import rag_configs
-from evaluate import evaluate_all
+from evaluate import (
+    RETRIEVAL_MODE, VECTOR_QUANTIZATION, RERANK_OVERSAMPLE, EMBEDDING_TABLE, embed_all, query_db, retrieve,
+    needs_vector, score_case, summarize, expected_of, percentiles, LLM_MODEL, table_for_model, get_embedding_cache,
+    get_embedding_provider, db_cursor, answer_query, answer_hit, build_messages
+)
+from context_builder import build_context, get_token_counter
+
+SWEEP_MODEL_CONCURRENCY = rag_configs.get("SWEEP_MODEL_CONCURRENCY", 4)
+EVAL_CONCURRENCY = rag_configs.get("EVAL_CONCURRENCY", 8)
+SWEEP_EMBED_PROBES = rag_configs.get("SWEEP_EMBED_PROBES", 10)
+# quantization -> generated column of the ingestor
+QUANTIZED_COLUMNS = {"none": "embedding", "halfvec": "embedding_half", "binary": "embedding_bit"}
+
+
+def load_partial(path: str) -> dict:
+    # (model, case index) -> retrieved record of an interrupted sweep; a line
+    # cut off by the interruption is dropped
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[(record["model"], record["index"])] = record
+    return done
+
+
+def probe_query_latency(model: str, queries: list, probes: int = SWEEP_EMBED_PROBES) -> dict:
+    # one query per request past the cache: what a chat user waits for on a
+    # miss, next to the batched throughput of the sweep itself
+    provider = get_embedding_provider(model)
+    seconds = []
+    for query in queries[:probes]:
+        t0 = time.perf_counter()
+        provider.embed_many([query])
+        seconds.append(time.perf_counter() - t0)
+    return percentiles(seconds)
+
+
+def sweep_model(model: str, cases: list, max_k: int, mode: str, done: dict, append) -> tuple:
+    # every query embedded once with the model and retrieved once at max_k
+    # from the model's table; the records are appended as they finish.
+    # -> (records by case index, single query embedding latency)
+    table = table_for_model(model)
+    # a partial record is only reused when it was retrieved the same way
+    setup = {
+        "mode": mode or RETRIEVAL_MODE,
+        "table": table,
+        "backend": "pgvector",
+        "quantization": VECTOR_QUANTIZATION,
+        "oversample": RERANK_OVERSAMPLE
+    }
+
+    def reusable(i: int, c: dict) -> bool:
+        record = done.get((model, i))
+        return (
+            record is not None and record["query"] == c.get("query") and record["max_k"] >= max_k
+            and all(record.get(key) == value for key, value in setup.items())
+        )
+
+    todo = [(i, c) for i, c in enumerate(cases) if not reusable(i, c)]
+    t0 = time.perf_counter()
+    to_embed = sorted({c.get("query") for _, c in todo if needs_vector(c.get("query"), mode)})
+    vectors, _ = embed_all(to_embed, model)
+    vector_of = dict(zip(to_embed, vectors))
+    embed_share = (time.perf_counter() - t0) / len(to_embed) if to_embed else 0.0
+
+    def run_case(item):
+        i, c = item
+        query = c.get("query")
+        vector = vector_of.get(query)
+        results, embed_time, db_time, path = retrieve(
+            query, top_k=max_k, backend="pgvector", mode=mode, vector=vector, model=model, table=table
+        )
+        record = {
+            "model": model,
+            "index": i,
+            "query": query,
+            **setup,
+            "max_k": max_k,
+            "results": [{"id": r.get("id"), "price": r.get("price"), "url": r.get("url")} for r in results],
+            "embed_time": embed_time + (embed_share if vector is not None else 0.0),
+            "db_time": db_time,
+            "path": path
+        }
+        append(record)
+        return record
+
+    with ThreadPoolExecutor(max_workers=max(1, EVAL_CONCURRENCY)) as executor:
+        fresh = {r["index"]: r for r in executor.map(run_case, todo)}
+    print(f"Retrieved model={model} table={table} top_k={max_k}: {len(fresh)} cases, "
+          f"{len(cases) - len(todo)} resumed, {time.perf_counter() - t0:.2f}s")
+    records = {i: fresh.get(i) or done[(model, i)] for i in range(len(cases))}
+    return records, probe_query_latency(model, [c.get("query") for c in cases])
+
+
+def run_experiments(ground_truth_path: str, embedding_models: list, top_ks: list, output_path: str,
+                    mode: str = None, resume: bool = True):
+    # grid search over models x top_ks: the results for a smaller k are the
+    # prefix of the max k results (up to the ANN search width, which follows
+    # top_k), so each model is retrieved once and every k is scored by
+    # slicing. with VECTOR_QUANTIZATION the quantized pass looks at
+    # max_k * RERANK_OVERSAMPLE candidates, more than a real query at a
+    # smaller k re-ranks, so the smaller k score a little higher than they
+    # would be served. models run in parallel, each against its own table.
+    # every retrieved case is appended to <output>.partial.jsonl at once, a
+    # rerun after an interruption only retrieves what is missing
+    with open(ground_truth_path, "r", encoding="utf-8") as f:
+        cases = json.load(f)
+    max_k = max(top_ks)
+    partial_path = os.path.splitext(output_path)[0] + ".partial.jsonl"
+    done = load_partial(partial_path) if resume else {}
+    if done:
+        print(f"Resuming from {partial_path} ({len(done)} retrieved cases)")
+
+    lock = threading.Lock()
+    with open(partial_path, "a" if resume else "w", encoding="utf-8") as partial:
+        def append(record):
+            with lock:
+                partial.write(json.dumps(record, ensure_ascii=False) + "\n")
+                partial.flush()
+
+        t0 = time.perf_counter()
+        workers = max(1, min(len(embedding_models), SWEEP_MODEL_CONCURRENCY))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            swept = list(executor.map(lambda m: sweep_model(m, cases, max_k, mode, done, append), embedding_models))
+        retrieved = {m: records for m, (records, _) in zip(embedding_models, swept)}
+        probes = {m: probe for m, (_, probe) in zip(embedding_models, swept)}
+        wall_time = time.perf_counter() - t0
 
-def run_experiments(ground_truth_path: str, embedding_models: list, top_ks: list, output_path: str):
     reports = []
     for model in embedding_models:
-        os.environ["EMBEDDING_MODEL"] = model
-        rag_configs["EMBEDDING_MODEL"] = model
-        for k in top_ks:
-            t0 = time.perf_counter()
-            summary = evaluate_all(ground_truth_path, top_k=k)
-            t1 = time.perf_counter()
+        for k in sorted(top_ks):
+            details = []
+            for i, c in enumerate(cases):
+                record = retrieved[model][i]
+                details.append(score_case(c.get("query"), expected_of(c), record["results"][:k],
+                                          record["embed_time"], record["db_time"], record["path"]))
+            summary = summarize(details, k, "pgvector", mode)
             summary["embedding_model"] = model
-            summary["top_k"] = k
-            summary["wall_time_s"] = t1 - t0
+            summary["table"] = table_for_model(model)
+            summary["retrieved_top_k"] = max_k
+            summary["wall_time_s"] = wall_time
+            summary["query_embed_latency_s"] = probes[model]
+            summary["embedding_provider"] = get_embedding_provider(model).report()
+            summary["embedding_cache"] = get_embedding_cache(model).report()
+            summary["details"] = details
             reports.append(summary)
             print(
                 f"Done model={model} top_k={k} "
@@ -29,10 +168,13 @@ def run_experiments(ground_truth_path: str, embedding_models: list, top_ks: list
                 f"ndcg ids={summary['avg_ndcg_ids']:.3f} "
                 f"price={summary['avg_ndcg_price']:.3f} "
                 f"link={summary['avg_ndcg_link']:.3f} "
-                f"time={summary['avg_latency_s']:.3f}s"
+                f"time={summary['avg_latency_s']:.3f}s "
+                f"query embed p50={probes[model]['p50'] * 1000:.1f}ms"
             )
     with open(output_path, "w", encoding="utf-8") as f:
         json.dump(reports, f, ensure_ascii=False, indent=2)
+    # complete, the next sweep starts fresh
+    os.remove(partial_path)
     return reports
 
 def pick_best(reports):
@@ -42,3 +184,179 @@ def pick_best(reports):
         reverse=True
     )
     return reports_sorted[0] if reports_sorted else None
+
+
+def timed_ids(vector, top_k: int, **settings):
+    t0 = time.perf_counter()
+    rows = query_db(vector, top_k=top_k, **settings)
+    return [r["id"] for r in rows], time.perf_counter() - t0
+
+
+def measure_recall(vectors: list, exact: list, top_k: int, **settings) -> dict:
+    # recall@k against the exact ids, and the db latency, of one search setting
+    recalls, latencies = [], []
+    for vector, (exact_ids, _) in zip(vectors, exact):
+        ids, elapsed = timed_ids(vector, top_k, **settings)
+        recalls.append(len(set(ids) & set(exact_ids)) / len(exact_ids) if exact_ids else 1.0)
+        latencies.append(elapsed)
+    return {
+        "recall": float(np.mean(recalls)),
+        "avg_latency_s": float(np.mean(latencies)),
+        "p95_latency_s": float(np.percentile(latencies, 95))
+    }
+
+
+def run_index_sweep(ground_truth_path: str, top_k: int, ef_searches: list, probes: list, output_path: str):
+    # recall@k of the ANN index against an exact scan, next to the db latency,
+    # for every hnsw.ef_search / ivfflat.probes value
+    with open(ground_truth_path, "r", encoding="utf-8") as f:
+        queries = [c.get("query") for c in json.load(f)]
+    vectors, _ = embed_all(queries)
+
+    exact = [timed_ids(v, top_k, exact=True) for v in vectors]
+    reports = [{
+        "setting": "exact",
+        "top_k": top_k,
+        "recall": 1.0,
+        "avg_latency_s": float(np.mean([t for _, t in exact])),
+        "p95_latency_s": float(np.percentile([t for _, t in exact], 95))
+    }]
+
+    settings = [("ef_search", v) for v in ef_searches or []] + [("probes", v) for v in probes or []]
+    for name, value in settings:
+        report = {"setting": f"{name}={value}", "top_k": top_k, **measure_recall(vectors, exact, top_k, **{name: value})}
+        reports.append(report)
+        print(
+            f"Done {report['setting']} recall@{top_k}={report['recall']:.3f} "
+            f"latency avg={report['avg_latency_s'] * 1000:.1f}ms p95={report['p95_latency_s'] * 1000:.1f}ms"
+        )
+
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(reports, f, ensure_ascii=False, indent=2)
+    return reports
+
+
+def storage_report(table: str = EMBEDDING_TABLE) -> dict:
+    # bytes on disk of the table (heap + toast) and of each of its indexes,
+    # and the average stored size of the full and the quantized vectors
+    with db_cursor() as cur:
+        cur.execute(
+            "SELECT pg_total_relation_size(%s::regclass) AS total_bytes, "
+            "pg_total_relation_size(%s::regclass) - pg_indexes_size(%s::regclass) AS table_bytes, "
+            "pg_indexes_size(%s::regclass) AS indexes_bytes",
+            (table, table, table, table)
+        )
+        report = dict(cur.fetchone())
+        cur.execute(
+            "SELECT indexname, pg_relation_size(format('%%I', indexname)::regclass) AS bytes "
+            "FROM pg_indexes WHERE tablename = %s ORDER BY indexname",
+            (table,)
+        )
+        report["index_bytes"] = {r["indexname"]: r["bytes"] for r in cur.fetchall()}
+        cur.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = %s AND column_name = ANY(%s)",
+            (table, list(QUANTIZED_COLUMNS.values()))
+        )
+        columns = [r["column_name"] for r in cur.fetchall()]
+        cur.execute("SELECT " + ", ".join(f"avg(pg_column_size({c})) AS {c}" for c in columns) + f" FROM {table}")
+        report["avg_vector_bytes"] = {c: float(v or 0) for c, v in cur.fetchone().items()}
+    return report
+
+
+def run_quantization_bench(ground_truth_path: str, top_k: int, oversamples: list, output_path: str,
+                           table: str = EMBEDDING_TABLE):
+    # the full precision search and every quantized column of the table
+    # (VECTOR_QUANTIZATION of the ingestor) re-ranked at each oversampling
+    # factor: recall@k against an exact scan, db latency and the size of the
+    # index each one searches
+    with open(ground_truth_path, "r", encoding="utf-8") as f:
+        queries = [c.get("query") for c in json.load(f)]
+    vectors, _ = embed_all(queries)
+    storage = storage_report(table)
+    exact = [timed_ids(v, top_k, exact=True) for v in vectors]
+
+    def index_bytes(column: str) -> int:
+        return sum(storage["index_bytes"].get(f"{table}_{column}_{kind}_idx", 0) for kind in ("hnsw", "ivfflat"))
+
+    settings = [("none", 1)] + [
+        (quantization, oversample)
+        for quantization, column in QUANTIZED_COLUMNS.items()
+        if quantization != "none" and column in storage["avg_vector_bytes"]
+        for oversample in sorted(oversamples)
+    ]
+    reports = []
+    for quantization, oversample in settings:
+        column = QUANTIZED_COLUMNS[quantization]
+        report = {
+            "quantization": quantization,
+            "oversample": oversample,
+            "top_k": top_k,
+            **measure_recall(vectors, exact, top_k, quantization=quantization, oversample=oversample),
+            "index_bytes": index_bytes(column),
+            "avg_vector_bytes": storage["avg_vector_bytes"].get(column)
+        }
+        reports.append(report)
+        print(
+            f"Done {quantization} x{oversample} recall@{top_k}={report['recall']:.3f} "
+            f"latency avg={report['avg_latency_s'] * 1000:.1f}ms p95={report['p95_latency_s'] * 1000:.1f}ms "
+            f"index={report['index_bytes'] / 2 ** 20:.1f}MiB"
+        )
+
+    result = {"table": table, "storage": storage, "exact_avg_latency_s": float(np.mean([t for _, t in exact])),
+              "settings": reports}
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    return result
+
+
+def run_context_bench(ground_truth_path: str, top_k: int, output_path: str, modes: tuple = ("raw", "compact"),
+                      rounds: int = 1):
+    # answer latency and prompt size with the raw joined chunk texts against
+    # the compact per-product context (context_builder.py, as in the websocket
+    # service). every case is retrieved once and answered with each mode in
+    # turn, so a drift of the api latency hits both alike
+    with open(ground_truth_path, "r", encoding="utf-8") as f:
+        cases = json.load(f)
+    count_tokens = get_token_counter()
+    runs = {mode: [] for mode in modes}
+    for _ in range(max(1, rounds)):
+        for c in cases:
+            query = c.get("query")
+            results, _, _, _ = retrieve(query, top_k=top_k)
+            for mode in modes:
+                if mode == "raw":
+                    context, stats = "\n\n".join(r["text"] for r in results), {}
+                else:
+                    context, stats = build_context(results, count_tokens=count_tokens)
+                run = answer_query(query, context)
+                run["estimated_prompt_tokens"] = sum(count_tokens(m["content"]) for m in build_messages(context, query))
+                run["context"] = stats
+                run["hit"] = answer_hit(run["answer"], expected_of(c))
+                run["query"] = query
+                runs[mode].append(run)
+
+    reports = {}
+    for mode, mode_runs in runs.items():
+        hits = [r["hit"] for r in mode_runs if r["hit"] is not None]
+        reported = [r["prompt_tokens"] for r in mode_runs if r["prompt_tokens"]]
+        reports[mode] = {
+            "cases": len(mode_runs),
+            "ttft_s": percentiles([r["ttft_s"] for r in mode_runs]),
+            "total_s": percentiles([r["total_s"] for r in mode_runs]),
+            "avg_estimated_prompt_tokens": float(np.mean([r["estimated_prompt_tokens"] for r in mode_runs])),
+            # from the api's usage, when it reports it
+            "avg_prompt_tokens": float(np.mean(reported)) if reported else None,
+            "answer_hit": float(np.mean(hits)) if hits else None,
+            "runs": mode_runs
+        }
+        print(
+            f"context={mode} prompt ~{reports[mode]['avg_estimated_prompt_tokens']:.0f} tokens "
+            f"ttft p50={reports[mode]['ttft_s']['p50'] * 1000:.0f}ms "
+            f"total p50={reports[mode]['total_s']['p50'] * 1000:.0f}ms p95={reports[mode]['total_s']['p95'] * 1000:.0f}ms "
+            f"answer hit={reports[mode]['answer_hit'] if hits else float('nan'):.3f}"
+        )
+
+    result = {"top_k": top_k, "llm_model": LLM_MODEL, "modes": reports}
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    return result
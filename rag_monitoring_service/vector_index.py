@@ -0,0 +1,104 @@
+# in-process retrieval over the numpy snapshot published by the ingestor
+# (data_ingestion_service/snapshot.py). the matrix is memory-mapped read-only,
+# so every worker process on the host shares the same page cache. a new
+# snapshot is picked up by the first search check_interval_s after CURRENT
+# changes, or at once after expire().
+# the same file is copied into the websocket and monitoring services.
+
+import os
+import json
+import time
+import threading
+import numpy as np
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "/data/snapshots/fosils_embeddings")
+# rows converted to float32 at a time when the snapshot is float16
+SCORE_BLOCK_ROWS = 65536
+
+
+class SnapshotIndex:
+    def __init__(self, snapshot_dir: str = SNAPSHOT_DIR, check_interval_s: float = 2.0):
+        self.snapshot_dir = snapshot_dir
+        self.check_interval_s = check_interval_s
+        self.version = None
+        self.matrix = None
+        self.meta = None
+        self.prices = None
+        self.next_check = 0.0
+        self.lock = threading.Lock()
+
+    def expire(self):
+        # the next search re-reads CURRENT instead of waiting for check_interval_s
+        # (a NOTIFY after the ingestor published a new snapshot)
+        self.next_check = 0.0
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now < self.next_check and self.matrix is not None:
+            return
+        with self.lock:
+            self.next_check = now + self.check_interval_s
+            try:
+                with open(os.path.join(self.snapshot_dir, "CURRENT")) as f:
+                    version = f.read().strip()
+            except FileNotFoundError:
+                if self.matrix is None:
+                    raise RuntimeError(f"No snapshot published in {self.snapshot_dir}")
+                return
+            if version == self.version:
+                return
+            version_dir = os.path.join(self.snapshot_dir, version)
+            matrix = np.load(os.path.join(version_dir, "vectors.npy"), mmap_mode="r")
+            with open(os.path.join(version_dir, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            # nan never passes a price bound, like NULL in sql
+            prices = np.array([np.nan if p is None else p for p in meta["price"]], dtype=np.float64)
+            # swap all at once, searches in progress keep their old references
+            self.matrix, self.meta, self.prices, self.version = matrix, meta, prices, version
+            print(f"Loaded snapshot {version} ({matrix.shape[0]} rows, {matrix.dtype})")
+
+    def scores(self, matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+        if matrix.dtype == np.float32:
+            return matrix @ query
+        out = np.empty(matrix.shape[0], dtype=np.float32)
+        for start in range(0, matrix.shape[0], SCORE_BLOCK_ROWS):
+            block = matrix[start:start + SCORE_BLOCK_ROWS]
+            out[start:start + len(block)] = block.astype(np.float32) @ query
+        return out
+
+    def search(self, vector: list, top_k: int = 5, price_min: float = None, price_max: float = None) -> list:
+        self.maybe_reload()
+        matrix, meta, prices = self.matrix, self.meta, self.prices
+
+        query = np.array(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = self.scores(matrix, query)
+
+        candidates = len(scores)
+        if price_min is not None or price_max is not None:
+            with np.errstate(invalid="ignore"):
+                mask = np.ones(len(scores), dtype=bool)
+                if price_min is not None:
+                    mask &= prices >= price_min
+                if price_max is not None:
+                    mask &= prices <= price_max
+            scores[~mask] = -np.inf
+            candidates = int(mask.sum())
+
+        k = min(top_k, candidates)
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [
+            {
+                "id": meta["id"][i],
+                "name": meta["name"][i],
+                "url": meta["url"][i],
+                "price": meta["price"][i],
+                "text": meta["text"][i],
+                "score": float(scores[i])
+            }
+            for i in top
+        ]
@@ -1,7 +1,34 @@
+import os
+import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from bs4 import BeautifulSoup
 import json
-from typing import List
+from typing import Callable, Iterable, List, Optional, Tuple
+
+
+class HostRateLimiter:
+    # hands out request slots per host so all worker threads together
+    # stay under `rate` requests per second for any single host
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url: str):
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
 
 
 class BaseScraper:
@@ -9,16 +36,94 @@ class BaseScraper:
         "User-Agent": "Mozilla/5.0 (compatible; RAG-Scraper/1.0)"
     }
 
+    def __init__(self, concurrency: int = None, rate_limit: float = None, retries: int = None, timeout: int = 10):
+        self.concurrency = concurrency or int(os.getenv("SCRAPER_CONCURRENCY", "8"))
+        if rate_limit is None:
+            rate_limit = float(os.getenv("SCRAPER_RPS", "5"))
+        if retries is None:
+            retries = int(os.getenv("SCRAPER_RETRIES", "3"))
+        self.timeout = timeout
+        self.rate_limiter = HostRateLimiter(rate_limit)
+        self.session = self.build_session(retries)
+
+    def build_session(self, retries: int) -> requests.Session:
+        # one keep-alive pool shared by all threads, sized to the concurrency limit
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET", "HEAD"),
+            respect_retry_after_header=True
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.concurrency, max_retries=retry)
+        session = requests.Session()
+        session.headers.update(self.headers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
     def fetch(self, url: str) -> str:
-        response = requests.get(url, headers=self.headers, timeout=10)
+        self.rate_limiter.wait(url)
+        response = self.session.get(url, timeout=self.timeout)
         response.raise_for_status()
         return response.text
 
-    def parse_sitemap(self, sitemap_url: str) -> List[str]:
+    def fetch_conditional(self, url: str, etag: str = None, last_modified: str = None) -> Tuple[Optional[str], dict]:
+        # returns (None, validators) when the server answers 304 Not Modified
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        self.rate_limiter.wait(url)
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        validators = {
+            "etag": response.headers.get("ETag") or etag,
+            "last_modified": response.headers.get("Last-Modified") or last_modified
+        }
+        if response.status_code == 304:
+            return None, validators
+        response.raise_for_status()
+        return response.text, validators
+
+    def parse_sitemap_entries(self, sitemap_url: str) -> List[dict]:
         xml = self.fetch(sitemap_url)
         soup = BeautifulSoup(xml, "xml")
-        return [loc.text for loc in soup.find_all("loc")]
+        entries = []
+        for loc in soup.find_all("loc"):
+            lastmod = loc.parent.find("lastmod") if loc.parent else None
+            entries.append({"loc": loc.text.strip(), "lastmod": lastmod.text.strip() if lastmod else None})
+        return entries
+
+    def parse_sitemap(self, sitemap_url: str) -> List[str]:
+        return [entry["loc"] for entry in self.parse_sitemap_entries(sitemap_url)]
 
     def save_json(self, data: dict, path: str):
         with open(path, "w", encoding="utf-8") as f:
             json.dump(data, f, indent=2, ensure_ascii=False)
+
+    def crawl(self, urls: Iterable[str], handler: Callable[[str], str]) -> dict:
+        # runs handler(url) on a thread pool; the handler returns a status
+        # string ("saved", "failed", ...) which is counted in the summary
+        urls = list(urls)
+        stats = {"pages": len(urls)}
+        t0 = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = {pool.submit(handler, url): url for url in urls}
+            for done, future in enumerate(as_completed(futures), start=1):
+                try:
+                    status = future.result()
+                except Exception as e:
+                    print(f"ERROR: {futures[future]}: {e}")
+                    status = "failed"
+                stats[status] = stats.get(status, 0) + 1
+                if done % 50 == 0:
+                    elapsed = time.perf_counter() - t0
+                    print(f"Progress {done}/{len(urls)} pages ({done / elapsed:.1f} pages/s)")
+
+        elapsed = time.perf_counter() - t0
+        stats["elapsed_s"] = round(elapsed, 3)
+        stats["pages_per_s"] = round(len(urls) / elapsed, 2) if elapsed > 0 else 0.0
+        print(f"Crawl finished: {json.dumps(stats)}")
+        return stats
@@ -0,0 +1,123 @@
+# crawls the local fixture site (fixture_site.py) with the real scraper and
+# checks the crawl settings: the per-host rate limit, the retries of
+# 429/5xx pages, the saved products, a second, incremental run that must
+# not fetch the saved pages again and a third one after products left the
+# sitemap, which must remove their raw files. exits non-zero when a check fails.
+#
+#   python bench_crawl.py --products 40 --rps 20 --concurrency 8
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from crawl_manifest import CrawlManifest
+from fixture_site import FixtureSite
+from fosil_scraper import FosilScraper
+
+
+def make_scraper(site: FixtureSite, work_dir: str, args) -> FosilScraper:
+    scraper = FosilScraper(concurrency=args.concurrency, rate_limit=args.rps, retries=args.retries)
+    scraper.SITEMAP_URL = f"{site.url}/sitemap.xml"
+    scraper.OUTPUT_DIR = os.path.join(work_dir, "raw")
+    scraper.manifest = CrawlManifest(os.path.join(work_dir, "manifest.json"))
+    return scraper
+
+
+def check_rate(site: FixtureSite, rps: float) -> tuple:
+    # first requests of every path go through the limiter (urllib3 retries
+    # don't), their arrivals have to be spaced 1/rps apart
+    firsts = sorted({path: t for path, t, _ in reversed(site.requests())}.values())
+    if rps <= 0 or len(firsts) < 2:
+        return True, f"{len(firsts)} first requests, limit off"
+    span = firsts[-1] - firsts[0]
+    rate = (len(firsts) - 1) / span if span > 0 else float("inf")
+    min_gap = min(b - a for a, b in zip(firsts, firsts[1:]))
+    # arrivals jitter by a few ms around the slots the limiter hands out
+    ok = rate <= rps * 1.1 and min_gap >= 0.5 / rps
+    return ok, f"{len(firsts)} first requests at {rate:.1f}/s (limit {rps}/s), min gap {min_gap * 1000:.1f}ms"
+
+
+def check_retries(site: FixtureSite, retries: int) -> list:
+    checks = []
+    for product in site.products:
+        log = site.requests(product["path"])
+        statuses = [status for _, _, status in log]
+        kind = product["kind"]
+        if kind == "429_once":
+            waited = log[1][1] - log[0][1] if len(log) > 1 else 0.0
+            ok = statuses == [429, 200] and waited >= site.retry_after * 0.9
+            checks.append((ok, f"429 page retried after {waited:.2f}s (Retry-After {site.retry_after}s): {statuses}"))
+        elif kind == "503_twice":
+            checks.append((statuses == [503, 503, 200], f"503 page retried until it answered: {statuses}"))
+        elif kind == "500_always":
+            ok = statuses == [500] * (retries + 1)
+            checks.append((ok, f"500 page given up after {retries} retries: {statuses}"))
+    return checks
+
+
+def check_saved(site: FixtureSite, output_dir: str) -> tuple:
+    expected = {p["id"]: p for p in site.expected()}
+    saved = {name[:-len(".json")] for name in os.listdir(output_dir) if name.endswith(".json")}
+    wrong = []
+    for product_id in sorted(saved & set(expected)):
+        with open(os.path.join(output_dir, f"{product_id}.json"), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        product = expected[product_id]
+        if (data["name"], str(data["price"]), data["url"]) != (product["name"], product["price"], site.url + product["path"]):
+            wrong.append(product_id)
+    ok = saved == set(expected) and not wrong
+    return ok, (f"{len(saved)} products saved, {len(expected)} expected, "
+                f"missing {sorted(set(expected) - saved)}, extra {sorted(saved - set(expected))}, wrong {wrong}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=40)
+    parser.add_argument("--rps", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--retries", type=int, default=3)
+    args = parser.parse_args()
+
+    site = FixtureSite(args.products).start()
+    checks = []
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            t0 = time.perf_counter()
+            stats = make_scraper(site, work_dir, args).run()
+            print(f"First crawl: {time.perf_counter() - t0:.2f}s {json.dumps(stats)}")
+            checks.append(check_rate(site, args.rps))
+            checks.extend(check_retries(site, args.retries))
+            checks.append(check_saved(site, os.path.join(work_dir, "raw")))
+
+            # unchanged sitemap lastmod: the saved pages are skipped without a request
+            site.reset_log()
+            stats = make_scraper(site, work_dir, args).run()
+            refetched = [path for path, _, _ in site.requests() if path in {p["path"] for p in site.expected()}]
+            checks.append((
+                stats.get("unchanged") == len(site.expected()) and not refetched,
+                f"second crawl: {stats.get('unchanged', 0)} unchanged, {len(refetched)} saved pages fetched again"
+            ))
+
+            # products gone from the sitemap lose their raw file
+            gone = site.expected()[-2:]
+            site.products = [p for p in site.products if p not in gone]
+            stats = make_scraper(site, work_dir, args).run()
+            left = [p["id"] for p in gone if os.path.exists(os.path.join(work_dir, "raw", f"{p['id']}.json"))]
+            checks.append((
+                stats.get("removed") == len(gone) and not left,
+                f"third crawl: {stats.get('removed', 0)} removed of {len(gone)} gone from the sitemap, files left {left}"
+            ))
+    finally:
+        site.stop()
+
+    failed = sum(1 for ok, _ in checks if not ok)
+    for ok, message in checks:
+        print(f"{'ok  ' if ok else 'FAIL'} {message}")
+    print(f"{len(checks) - failed}/{len(checks)} checks passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
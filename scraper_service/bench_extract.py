@@ -0,0 +1,67 @@
+# micro-benchmark of the product extractors over saved html pages
+#
+#   python bench_extract.py --download 50      # save 50 product pages as fixtures
+#   python bench_extract.py --rounds 5         # pages/sec for lxml vs BeautifulSoup
+
+import os
+import time
+import argparse
+from extractors import extract_fields_fast, extract_fields_soup
+from fosil_scraper import FosilScraper
+
+FIXTURES_DIR = os.getenv("SCRAPER_FIXTURES_DIR", "/data/fixtures/fosili")
+
+
+def download_fixtures(count: int, fixtures_dir: str):
+    os.makedirs(fixtures_dir, exist_ok=True)
+    scraper = FosilScraper()
+    for i, url in enumerate(scraper.get_fosili_links()[:count]):
+        path = os.path.join(fixtures_dir, f"{i:05d}.html")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(scraper.fetch(url))
+        print(f"Saved {url} → {path}")
+
+
+def load_fixtures(fixtures_dir: str):
+    pages = []
+    for name in sorted(os.listdir(fixtures_dir)):
+        if name.endswith(".html"):
+            with open(os.path.join(fixtures_dir, name), "r", encoding="utf-8") as f:
+                pages.append(f.read())
+    return pages
+
+
+def bench(extract, pages, rounds: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for html in pages:
+            extract(html)
+    return rounds * len(pages) / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fixtures", default=FIXTURES_DIR)
+    parser.add_argument("--download", type=int, default=0)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.download:
+        download_fixtures(args.download, args.fixtures)
+
+    pages = load_fixtures(args.fixtures)
+    if not pages:
+        print(f"No .html fixtures in {args.fixtures}, run with --download N first")
+        return
+
+    mismatches = sum(1 for html in pages if extract_fields_fast(html) != extract_fields_soup(html))
+    soup_rate = bench(extract_fields_soup, pages, args.rounds)
+    fast_rate = bench(extract_fields_fast, pages, args.rounds)
+
+    print(f"pages={len(pages)} rounds={args.rounds} mismatches={mismatches}")
+    print(f"beautifulsoup: {soup_rate:.1f} pages/s")
+    print(f"lxml:          {fast_rate:.1f} pages/s ({fast_rate / soup_rate:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
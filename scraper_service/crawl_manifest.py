@@ -0,0 +1,48 @@
+import os
+import json
+import hashlib
+import threading
+
+
+def content_hash(data: dict) -> str:
+    # stable hash of an extracted product, key order and whitespace independent
+    payload = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CrawlManifest:
+    # persistent url -> {lastmod, etag, last_modified, hash, id} map,
+    # shared by the crawl threads and written atomically at the end of a run
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def get(self, url: str) -> dict:
+        with self.lock:
+            return dict(self.entries.get(url, {}))
+
+    def urls(self) -> list:
+        with self.lock:
+            return list(self.entries)
+
+    def remove(self, url: str) -> dict:
+        with self.lock:
+            return self.entries.pop(url, {})
+
+    def update(self, url: str, **fields):
+        with self.lock:
+            self.entries.setdefault(url, {}).update(fields)
+
+    def save(self):
+        with self.lock:
+            snapshot = json.dumps(self.entries, ensure_ascii=False, indent=2)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(snapshot)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,78 @@
+# extraction of the three things we need from a product page:
+# the JSON-LD script, the product_id input and the out-of-stock h4.
+# the lxml path parses in C and only evaluates three precompiled xpaths,
+# the BeautifulSoup path is the original one and is kept as a fallback.
+
+import re
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:
+    lxml = None
+
+OUT_OF_STOCK_TEXT = "Продуктът е изчерпан"
+
+# newlines/tabs become spaces, every other control char (incl. \r) is dropped
+_CONTROL_CHARS = {code: None for code in range(32)}
+_CONTROL_CHARS[ord("\n")] = " "
+_CONTROL_CHARS[ord("\t")] = " "
+# a string literal (kept as is) or a trailing comma before } or ] (dropped);
+# strings are matched first, so commas inside values are never touched
+_STRING_OR_TRAILING_COMMA = re.compile(r'"(?:[^"\\]|\\.)*"|,\s*(?=[}\]])', re.DOTALL)
+
+if lxml is not None:
+    _FIND_JSON_LD = etree.XPath('(//script[@type="application/ld+json"])[1]')
+    _FIND_PRODUCT_ID = etree.XPath('(//input[@name="product_id"])[1]/@value')
+    _FIND_OUT_OF_STOCK = etree.XPath(
+        '(//h4[contains(concat(" ", normalize-space(@class), " "), " opacity-50 ")])[1]'
+    )
+
+
+def repair_json_ld(raw: str) -> str:
+    # the site's JSON-LD has raw newlines/control chars and trailing commas,
+    # fixed with one translate() and one regex pass instead of a per-char loop
+    return _STRING_OR_TRAILING_COMMA.sub(_keep_strings, raw.translate(_CONTROL_CHARS))
+
+
+def _keep_strings(match) -> str:
+    token = match.group(0)
+    return token if token.startswith('"') else ""
+
+
+def extract_fields_fast(html: str) -> dict:
+    root = lxml.html.document_fromstring(html)
+
+    scripts = _FIND_JSON_LD(root)
+    product_ids = _FIND_PRODUCT_ID(root)
+    out_of_stock = _FIND_OUT_OF_STOCK(root)
+
+    return {
+        "json_ld": scripts[0].text_content() if scripts else None,
+        "product_id": str(product_ids[0]) if product_ids else None,
+        "out_of_stock": bool(out_of_stock) and OUT_OF_STOCK_TEXT in out_of_stock[0].text_content()
+    }
+
+
+def extract_fields_soup(html: str) -> dict:
+    soup = BeautifulSoup(html, "html.parser")
+
+    script_tag = soup.find("script", type="application/ld+json")
+    out_of_stock = soup.find("h4", class_="opacity-50")
+    product_id_tag = soup.find("input", {"name": "product_id"})
+
+    return {
+        "json_ld": script_tag.text if script_tag else None,
+        "product_id": product_id_tag.get("value") if product_id_tag else None,
+        "out_of_stock": bool(out_of_stock) and OUT_OF_STOCK_TEXT in out_of_stock.text
+    }
+
+
+def extract_fields(html: str, fast: bool = True) -> dict:
+    if fast and lxml is not None:
+        try:
+            return extract_fields_fast(html)
+        except Exception as e:
+            print(f"WARNING: lxml extraction failed, falling back to BeautifulSoup: {e}")
+    return extract_fields_soup(html)
@@ -0,0 +1,173 @@
+# local stand-in for the shop, used by bench_crawl.py: a sitemap and product
+# pages in the layout the extractors expect (JSON-LD with raw newlines and
+# trailing commas, the product_id input, the out-of-stock header), with
+# ETag/Last-Modified validators, and pages that fail on purpose:
+#
+#   429_once    429 with Retry-After on the first request, then the page
+#   503_twice   503 on the first two requests, then the page
+#   500_always  500 on every request
+#   sold_out    the page with the out-of-stock header, nothing to save
+#
+#   python fixture_site.py --port 8080 --products 40
+#   SITEMAP_URL=http://127.0.0.1:8080/sitemap.xml python run.py
+
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+FAILING_PAGES = ("429_once", "503_twice", "500_always", "sold_out")
+LASTMOD = "2024-01-01T00:00:00+00:00"
+LAST_MODIFIED = "Mon, 01 Jan 2024 00:00:00 GMT"
+
+PAGE = """<!DOCTYPE html>
+<html lang="bg">
+<head>
+<title>{name}</title>
+<script type="application/ld+json">
+{{
+  "@context": "https://schema.org/",
+  "@type": "Product",
+  "name": "{name}",
+  "description": "{description}",
+  "offers": {{"@type": "Offer", "price": "{price}", "priceCurrency": "BGN",}},
+}}
+</script>
+</head>
+<body>
+<h1>{name}</h1>
+{stock}
+<form><input type="hidden" name="product_id" value="{id}"></form>
+</body>
+</html>
+"""
+SOLD_OUT = '<h4 class="opacity-50">Продуктът е изчерпан</h4>'
+
+
+def product_of(i: int, kind: str) -> dict:
+    product_id = str(1000 + i)
+    return {
+        "id": product_id,
+        "kind": kind,
+        "name": f"Фосил {product_id}",
+        # a raw newline, like the real JSON-LD has
+        "description": f"Амонит от находище {i}.\nРазмер {i % 9 + 2} см.",
+        "price": f"{10 + i * 1.5:.2f}",
+        "path": f"/4-fosili/{product_id}-fosil-{product_id}.html"
+    }
+
+
+class FixtureSite:
+    def __init__(self, products: int = 20, port: int = 0, retry_after: int = 1):
+        kinds = list(FAILING_PAGES) + ["ok"] * max(0, products - len(FAILING_PAGES))
+        self.products = [product_of(i, kind) for i, kind in enumerate(kinds[:products])]
+        self.pages = {p["path"]: p for p in self.products}
+        self.retry_after = retry_after
+        # (path, monotonic time, status) of every request, in arrival order
+        self.log = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.handler_class())
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def expected(self) -> list:
+        # products a crawl has to save
+        return [p for p in self.products if p["kind"] in ("ok", "429_once", "503_twice")]
+
+    def requests(self, path: str = None) -> list:
+        with self.lock:
+            return [entry for entry in self.log if path is None or entry[0] == path]
+
+    def reset_log(self):
+        with self.lock:
+            self.log.clear()
+
+    def sitemap(self) -> str:
+        urls = [p["path"] for p in self.products] + ["/content/1-dostavka"]
+        entries = "".join(
+            f"<url><loc>{self.url}{path}</loc><lastmod>{LASTMOD}</lastmod></url>" for path in urls
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            f'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{entries}</urlset>'
+        )
+
+    def respond(self, path: str, headers) -> tuple:
+        # -> (status, headers, body) of a request
+        if path == "/sitemap.xml":
+            return 200, {"Content-Type": "application/xml"}, self.sitemap()
+        product = self.pages.get(path)
+        if product is None:
+            return 404, {}, "not found"
+        # counted before this request is logged
+        attempt = len(self.requests(path)) + 1
+        kind = product["kind"]
+        if kind == "429_once" and attempt == 1:
+            return 429, {"Retry-After": str(self.retry_after)}, "slow down"
+        if kind == "503_twice" and attempt <= 2:
+            return 503, {}, "unavailable"
+        if kind == "500_always":
+            return 500, {}, "error"
+
+        etag = f'"{product["id"]}-1"'
+        validators = {"ETag": etag, "Last-Modified": LAST_MODIFIED}
+        if headers.get("If-None-Match") == etag:
+            return 304, validators, ""
+        body = PAGE.format(
+            stock=SOLD_OUT if kind == "sold_out" else "",
+            **{k: v for k, v in product.items() if k not in ("kind", "path")}
+        )
+        return 200, {**validators, "Content-Type": "text/html; charset=utf-8"}, body
+
+    def handler_class(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, the scraper reuses its pooled connections
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                status, headers, body = site.respond(self.path, self.headers)
+                with site.lock:
+                    site.log.append((self.path, time.monotonic(), status))
+                payload = body.encode("utf-8")
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--products", type=int, default=40)
+    args = parser.parse_args()
+    site = FixtureSite(args.products, args.port)
+    print(f"Serving {len(site.products)} products on {site.url}/sitemap.xml")
+    print(json.dumps({p["path"]: p["kind"] for p in site.products if p["kind"] != "ok"}, indent=2))
+    site.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
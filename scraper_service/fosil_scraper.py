@@ -1,54 +1,54 @@
 import json
-from bs4 import BeautifulSoup
 from base_scraper import BaseScraper
+from crawl_manifest import CrawlManifest, content_hash
+from extractors import extract_fields, repair_json_ld
 import os
 
 
 class FosilScraper(BaseScraper):
-    SITEMAP_URL = "https://vantony.com/sitemap.xml"
+    # both overridable so the scraper can be pointed at a local fixture site
+    SITEMAP_URL = os.getenv("SITEMAP_URL", "https://vantony.com/sitemap.xml")
+    OUTPUT_DIR = os.getenv("SCRAPER_OUTPUT_DIR", "/data/raw/fosili")
+    # kept next to (not inside) the raw dir so the processor never picks it up
+    MANIFEST_PATH = os.getenv("SCRAPER_MANIFEST", "/data/raw/fosili_manifest.json")
+    FULL_REFRESH = os.getenv("SCRAPER_FULL_REFRESH", "0") == "1"
+    # lxml fast path, BeautifulSoup is used when disabled or when lxml fails
+    FAST_EXTRACT = os.getenv("SCRAPER_FAST_EXTRACT", "1") == "1"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.manifest = CrawlManifest(self.MANIFEST_PATH)
+
+    def get_fosili_entries(self):
+        #Return only sitemap entries (loc + lastmod) containing /4-fosili/.
+        entries = self.parse_sitemap_entries(self.SITEMAP_URL)
+        return [e for e in entries if "/4-fosili/" in e["loc"]]
 
     def get_fosili_links(self):
         #Return only URLs containing /4-fosili/.
-        urls = self.parse_sitemap(self.SITEMAP_URL)
-        fosili_urls = [u for u in urls if "/4-fosili/" in u]
-        return fosili_urls
+        return [e["loc"] for e in self.get_fosili_entries()]
 
     def parse_product_page(self, url: str) -> dict:
-        html = self.fetch(url)
-        soup = BeautifulSoup(html, "html.parser")
-
-        script_tag = soup.find("script", type="application/ld+json")
-        if not script_tag:
-            return None
-        
-        out_of_stock = soup.find("h4", class_="opacity-50")
-        if out_of_stock and "Продуктът е изчерпан" in out_of_stock.text:
-            return None
-
-        raw_json = script_tag.text
+        return self.extract_product(self.fetch(url), url)
 
-        cleaned = (
-            raw_json
-            .replace("\n", " ")
-            .replace("\t", " ")
-            .replace("\r", "")
-        )
+    def extract_product(self, html: str, url: str) -> dict:
+        fields = extract_fields(html, fast=self.FAST_EXTRACT)
 
-        cleaned = "".join(ch for ch in cleaned if ord(ch) >= 32)
+        raw_json = fields["json_ld"]
+        if not raw_json:
+            return None
 
-        cleaned = cleaned.replace(", }", " }")
-        cleaned = cleaned.replace(", }", " }")
-        cleaned = cleaned.replace(", ]", " ]")
+        if fields["out_of_stock"]:
+            return None
 
         try:
-            data = json.loads(cleaned)
+            data = json.loads(repair_json_ld(raw_json))
         except Exception as e:
             print(f"WARNING: Failed to parse JSON-LD on {url}: {e}")
             print("Raw JSON-LD snippet:", raw_json[:200])
             return None
 
-        product_id_tag = soup.find("input", {"name": "product_id"})
-        product_id = product_id_tag["value"] if product_id_tag else None
+        product_id = fields["product_id"]
 
         return {
             "id": product_id,
@@ -59,16 +59,69 @@ class FosilScraper(BaseScraper):
         }
 
 
+    def scrape_product(self, url: str, lastmod: str = None) -> str:
+        entry = self.manifest.get(url)
+        outfile_known = entry.get("id") is not None and os.path.exists(
+            os.path.join(self.OUTPUT_DIR, f"{entry['id']}.json"))
+
+        if not self.FULL_REFRESH and lastmod and outfile_known and entry.get("lastmod") == lastmod:
+            return "unchanged"
+
+        print(f"Scraping {url}")
+        if self.FULL_REFRESH or not outfile_known:
+            html, validators = self.fetch_conditional(url)
+        else:
+            html, validators = self.fetch_conditional(url, entry.get("etag"), entry.get("last_modified"))
+        if html is None:
+            self.manifest.update(url, lastmod=lastmod, **validators)
+            return "not_modified"
+
+        product = self.extract_product(html, url)
+        if not product:
+            print(f"Failed to extract product: {url}")
+            return "failed"
+
+        digest = content_hash(product)
+        outfile = os.path.join(self.OUTPUT_DIR, f"{product['id']}.json")
+        status = "unchanged"
+        if digest != entry.get("hash") or not os.path.exists(outfile):
+            self.save_json(product, outfile)
+            print(f"Saved {outfile}")
+            status = "saved"
+        # recorded only once the file is written: if the write fails or the run
+        # dies first, the next run still sees the old lastmod and fetches again
+        self.manifest.update(url, lastmod=lastmod, id=product["id"], hash=digest, **validators)
+        return status
+
+    def prune_removed(self, urls) -> int:
+        # products whose page left the sitemap lose their raw file and their
+        # manifest entry, so the processor and the ingestor's stale cleanup
+        # drop them too. raw files no manifest entry knows about are left alone
+        urls = set(urls)
+        if not urls:
+            # an empty sitemap is more likely a broken fetch than an empty shop
+            return 0
+        current_ids = {self.manifest.get(url).get("id") for url in urls}
+        removed = 0
+        for url in self.manifest.urls():
+            if url in urls:
+                continue
+            product_id = self.manifest.remove(url).get("id")
+            outfile = os.path.join(self.OUTPUT_DIR, f"{product_id}.json")
+            # another url may have taken over the id
+            if product_id is not None and product_id not in current_ids and os.path.exists(outfile):
+                os.remove(outfile)
+                print(f"Removed {outfile} ({url} is gone from the sitemap)")
+                removed += 1
+        return removed
+
     def run(self):
-        fosili_urls = self.get_fosili_links()
-        os.makedirs("/data/raw/fosili", exist_ok=True)
-
-        for url in fosili_urls:
-            print(f"Scraping {url}")
-            product = self.parse_product_page(url)
-            if product:
-                outfile = f"/data/raw/fosili/{product['id']}.json"
-                self.save_json(product, outfile)
-                print(f"Saved {outfile}")
-            else:
-                print(f"Failed to extract product: {url}")
+        entries = self.get_fosili_entries()
+        lastmods = {e["loc"]: e["lastmod"] for e in entries}
+        os.makedirs(self.OUTPUT_DIR, exist_ok=True)
+        try:
+            stats = self.crawl(lastmods.keys(), lambda url: self.scrape_product(url, lastmods[url]))
+            stats["removed"] = self.prune_removed(lastmods)
+            return stats
+        finally:
+            self.manifest.save()
@@ -0,0 +1,131 @@
+# catalog-wide questions ("how many products", "cheapest", "average price")
+# can't be answered from the top_k chunks the llm gets. they are detected
+# here and answered with sql over the product level materialized view
+# (one row per product, created and refreshed by the ingestor).
+
+import re
+from hybrid import price_bounds, PRICE_RANGE_RE, PRICE_MAX_RE, PRICE_MIN_RE, CURRENCY_RE
+
+PRODUCTS_VIEW = "fosils_products"
+
+# checked in order, the first match wins ("колко струва най-евтиния" is cheapest, not count)
+INTENTS = [
+    ("cheapest", re.compile(r"най[- ]евтин|cheapest", re.IGNORECASE)),
+    ("most_expensive", re.compile(r"най[- ]скъп|most expensive", re.IGNORECASE)),
+    ("avg_price", re.compile(r"средн\w*\s+цена|average price|mean price|avg price", re.IGNORECASE)),
+    ("min_price", re.compile(r"минимал\w*\s+цена|min(?:imum)? price|lowest price", re.IGNORECASE)),
+    ("max_price", re.compile(r"максимал\w*\s+цена|max(?:imum)? price|highest price", re.IGNORECASE)),
+    ("price_range", re.compile(r"ценов\w*\s+(?:диапазон|обхват)|price range|от колко до колко", re.IGNORECASE)),
+    ("count", re.compile(r"колко|брой|how many|number of", re.IGNORECASE)),
+]
+
+# only questions about the whole catalog are answered from the view ("колко
+# продукта има", "кой е най-евтиният фосил"). anything left after the intent
+# wording, the catalog wording and the price bounds is a subject ("колко вида
+# амонити има", "най-евтиният амонит") and goes to retrieval, like a price
+# question ("колко струва фосилът")
+PRICE_VERB_RE = re.compile(r"\bстру\w*|\bcosts?\b", re.IGNORECASE)
+CATALOG_NOUN_RE = re.compile(r"(?:продукт|артикул|фосил|вид|брой|product|item|fossil|kind|type)\w*$", re.IGNORECASE)
+CATALOG_WORDS = {
+    "колко", "има", "общо", "всичко", "в", "във", "на", "от", "с", "със", "ли", "са", "е", "и", "до", "под", "над",
+    "между", "каталога", "каталог", "магазина", "магазин", "сайта", "сайт", "различни", "налични", "имате",
+    "предлагате", "продавате", "цена", "цени", "цената", "цените", "лв", "лева", "евро", "eur", "bgn", "кой", "коя",
+    "кое", "кои", "които", "какъв", "каква", "какво", "какви", "струва", "струват", "ми", "ни", "покажи", "дай",
+    "how", "many", "number", "of", "are", "is", "there", "in", "the", "your", "you", "do", "does", "have", "total",
+    "catalog", "catalogue", "store", "shop", "sell", "offer", "available", "different", "with", "price", "prices",
+    "under", "over", "below", "above", "between", "and", "to", "from", "what", "which", "show", "me", "a", "cost"
+}
+
+
+def query_subject(query: str, pattern) -> str:
+    # -> the words of an aggregate question that are neither its intent
+    # wording (pattern, to the end of the word), catalog wording nor price bounds
+    query = re.sub(rf"(?:{pattern.pattern})\w*", " ", query, flags=re.IGNORECASE)
+    for bounds in (PRICE_RANGE_RE, PRICE_MAX_RE, PRICE_MIN_RE, CURRENCY_RE):
+        query = bounds.sub(" ", query)
+    words = re.findall(r"[^\W\d_]+", query.lower())
+    return " ".join(w for w in words if w not in CATALOG_WORDS and not CATALOG_NOUN_RE.match(w))
+
+
+def detect_aggregate(query: str) -> dict:
+    for intent, pattern in INTENTS:
+        if pattern.search(query):
+            if intent == "count" and PRICE_VERB_RE.search(query):
+                return None
+            if query_subject(query, pattern):
+                return None
+            price_min, price_max = price_bounds(query)
+            return {"intent": intent, "price_min": price_min, "price_max": price_max}
+    return None
+
+
+async def run_aggregate(conn, aggregate: dict, limit: int = 5) -> dict:
+    # products without a price are stored with 0.0, they don't count for price statistics
+    filters = "($1::float8 IS NULL OR price >= $1) AND ($2::float8 IS NULL OR price <= $2)"
+    bounds = (aggregate["price_min"], aggregate["price_max"])
+    intent = aggregate["intent"]
+
+    if intent in ("cheapest", "most_expensive"):
+        order = "ASC" if intent == "cheapest" else "DESC"
+        rows = await conn.fetch(
+            f"""
+            SELECT product_id, name, url, price
+            FROM {PRODUCTS_VIEW}
+            WHERE price > 0 AND {filters}
+            ORDER BY price {order}, product_id
+            LIMIT $3;
+            """,
+            *bounds, limit
+        )
+        return {**aggregate, "products": [dict(r) for r in rows]}
+
+    row = await conn.fetchrow(
+        f"""
+        SELECT
+            count(*) AS total,
+            count(*) FILTER (WHERE price > 0) AS priced,
+            min(price) FILTER (WHERE price > 0) AS min_price,
+            max(price) FILTER (WHERE price > 0) AS max_price,
+            avg(price) FILTER (WHERE price > 0) AS avg_price
+        FROM {PRODUCTS_VIEW}
+        WHERE {filters};
+        """,
+        *bounds
+    )
+    return {**aggregate, **dict(row), "products": []}
+
+
+def describe_bounds(aggregate: dict) -> str:
+    lo, hi = aggregate["price_min"], aggregate["price_max"]
+    if lo is not None and hi is not None:
+        return f" ({lo:.2f} - {hi:.2f} лв)"
+    if lo is not None:
+        return f" (над {lo:.2f} лв)"
+    if hi is not None:
+        return f" (до {hi:.2f} лв)"
+    return ""
+
+
+def format_answer(result: dict) -> str:
+    intent = result["intent"]
+    bounds = describe_bounds(result)
+    if intent in ("cheapest", "most_expensive"):
+        if not result["products"]:
+            return f"Няма продукти{bounds}."
+        title = "Най-евтините" if intent == "cheapest" else "Най-скъпите"
+        items = "; ".join(f"{p['name']} - {p['price']:.2f} лв. ({p['url']})" for p in result["products"])
+        return f"{title} продукти{bounds}: {items}"
+    if intent == "count":
+        return f"В каталога има {result['total']} продукта{bounds}."
+    if not result["priced"]:
+        return f"Няма продукти с цена{bounds}."
+    if intent == "avg_price":
+        return f"Средната цена{bounds} е {result['avg_price']:.2f} лв. ({result['priced']} продукта)."
+    if intent == "min_price":
+        return f"Най-ниската цена{bounds} е {result['min_price']:.2f} лв."
+    if intent == "max_price":
+        return f"Най-високата цена{bounds} е {result['max_price']:.2f} лв."
+    return (
+        f"Цените{bounds} са от {result['min_price']:.2f} до {result['max_price']:.2f} лв., "
+        f"средно {result['avg_price']:.2f} лв. ({result['priced']} продукта)."
+    )
@@ -1,103 +1,526 @@
 import os
 import json
+import time
 import asyncio
+from contextlib import asynccontextmanager, aclosing
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from openai import OpenAI
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from fastapi.responses import PlainTextResponse
+from openai import AsyncOpenAI
+import asyncpg
 
 from config import rag_configs
+from embedding_cache import EmbeddingCache, normalize_text
+from embedding_provider import get_provider
+from result_cache import ResultCache
+from coalescer import EmbeddingCoalescer
+from vector_index import SnapshotIndex
+from hybrid import parse_structured, rrf_fuse
+from aggregates import detect_aggregate, run_aggregate, format_answer
+from context_builder import build_context, get_token_counter
+from metrics import registry, timed, record, request_timings, collected, Counter, Gauge
 
 PG_URI = os.getenv("PG_URI", "postgresql://postgres:postgres@db:5432/postgres")
 EMBEDDING_MODEL = rag_configs.get("EMBEDDING_MODEL")
 LLM_MODEL = rag_configs.get("LLM_MODEL")
 TOP_K = rag_configs.get("TOP_K", 5)
 SYSTEM_PROMPT = rag_configs.get("SYSTEM_PROMPT")
+HNSW_EF_SEARCH = rag_configs.get("HNSW_EF_SEARCH", 40)
+IVFFLAT_PROBES = rag_configs.get("IVFFLAT_PROBES", 1)
+VECTOR_QUANTIZATION = rag_configs.get("VECTOR_QUANTIZATION", "none")
+RERANK_OVERSAMPLE = rag_configs.get("RERANK_OVERSAMPLE", 4)
+# distance on the quantized columns of the ingestor (VECTOR_QUANTIZATION there)
+QUANTIZED_DISTANCE = {
+    "halfvec": "embedding_half <=> $1::text::vector::halfvec",
+    "binary": "embedding_bit <~> binary_quantize($1::text::vector)"
+}
+# pgvector rejects a larger hnsw.ef_search, the candidates of a search are capped to it
+MAX_EF_SEARCH = 1000
+# "pgvector" or "numpy" (memory-mapped snapshot exported by the ingestor)
+RETRIEVAL_BACKEND = rag_configs.get("RETRIEVAL_BACKEND", "pgvector")
+# "vector" or "hybrid" (vector + trigram ranking fused, exact id/url lookups), per request with "mode"
+RETRIEVAL_MODE = rag_configs.get("RETRIEVAL_MODE", "vector")
+HYBRID_CANDIDATES = rag_configs.get("HYBRID_CANDIDATES", 20)
+HYBRID_RRF_K = rag_configs.get("HYBRID_RRF_K", 60)
+LEXICAL_THRESHOLD = rag_configs.get("LEXICAL_THRESHOLD", 0.3)
+# count/min/max/avg/cheapest questions are answered with sql instead of top_k chunks
+AGGREGATE_ROUTING = rag_configs.get("AGGREGATE_ROUTING", True)
+# False: templated answer without an llm call, True: the llm phrases the aggregate result
+AGGREGATE_LLM = rag_configs.get("AGGREGATE_LLM", False)
+# per request with "context": "raw" / "compact"
+CONTEXT_MODE = rag_configs.get("CONTEXT_MODE", "compact")
+# add the per-stage milliseconds to every response, otherwise only when a request asks with "timings"
+RESPONSE_TIMINGS = rag_configs.get("RESPONSE_TIMINGS", False)
 
-client = OpenAI(api_key=os.getenv("OPEN_AI_API_KEY"))
+client = AsyncOpenAI(api_key=os.getenv("OPEN_AI_API_KEY"))
+# openai embeddings through the async client, or the local hashing backend in a thread
+provider = get_provider(EMBEDDING_MODEL, async_client=client)
+# level 1: normalized query -> embedding (LRU in memory, shared file on disk)
+embedding_cache = EmbeddingCache(provider.name, max_items=rag_configs.get("QUERY_EMBEDDING_CACHE_SIZE", 10000))
+# level 2: (model, query, top_k, search params) -> results, dropped when the ingestor loads new data
+result_cache = ResultCache(
+    ttl_s=rag_configs.get("RESULT_CACHE_TTL_S", 300),
+    max_items=rag_configs.get("RESULT_CACHE_SIZE", 5000)
+)
+snapshot_index = SnapshotIndex() if RETRIEVAL_BACKEND == "numpy" else None
+INVALIDATION_CHANNEL = rag_configs.get("INVALIDATION_CHANNEL", "fosils_embeddings_changed")
 
-app = FastAPI()
+# served on GET /metrics; the stage histogram (ws_stage_seconds) lives in metrics.py
+connections_gauge = registry.gauge("ws_connections", "Open websocket connections")
+queued_gauge = registry.gauge("ws_queued_queries", "Queries waiting in the per-connection queues")
+inflight_gauge = registry.gauge("ws_inflight_queries", "Queries being handled")
+queries_total = registry.counter("ws_queries_total", "Handled queries by route and outcome", ("route", "outcome"))
+query_seconds = registry.histogram("ws_query_seconds", "Time from receiving a query to its last frame", ("route",))
+prompt_tokens = registry.histogram(
+    "ws_prompt_tokens", "Prompt tokens of the llm calls (CONTEXT_TOKENIZER)", ("route",),
+    buckets=(128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+)
+count_tokens = get_token_counter()
 
 
-def get_db():
-    conn = psycopg2.connect(PG_URI, cursor_factory=RealDictCursor)
-    return conn
+def on_data_changed(conn, pid, channel, payload):
+    print(f"Data changed ({payload}), dropping cached search results")
+    # the ingestor publishes the snapshot before it notifies: searches of the
+    # new generation must run on the new matrix, not the one still mapped
+    if snapshot_index is not None:
+        snapshot_index.expire()
+    result_cache.invalidate()
 
 
-def embed(text: str):
-    resp = client.embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=text
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one pool for the whole process instead of a connection per query
+    app.state.pool = await asyncpg.create_pool(
+        PG_URI,
+        min_size=rag_configs.get("PG_POOL_MIN", 2),
+        max_size=rag_configs.get("PG_POOL_MAX", 10)
     )
-    return resp.data[0].embedding
+    # dedicated connection, a LISTEN has to outlive the pool checkouts
+    app.state.listener = await asyncpg.connect(PG_URI)
+    await app.state.listener.add_listener(INVALIDATION_CHANNEL, on_data_changed)
+    try:
+        yield
+    finally:
+        await app.state.listener.close()
+        await app.state.pool.close()
+        await client.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+async def embed_many(texts: list):
+    return await provider.aembed_many(texts)
+
+
+# cache misses of all connections are batched into shared embeddings requests
+coalescer = EmbeddingCoalescer(
+    embed_many,
+    window_ms=rag_configs.get("EMBED_COALESCE_WINDOW_MS", 5),
+    max_batch=rag_configs.get("EMBED_COALESCE_MAX_BATCH", 64)
+)
+
+
+async def embed_coalesced(texts: list):
+    return list(await asyncio.gather(*[coalescer.embed(t) for t in texts]))
 
 
-async def semantic_search(query: str, top_k: int = TOP_K):
-    vector = embed(query)
+async def embed(text: str):
+    with timed("embed"):
+        return (await embedding_cache.aembed_many([text], embed_coalesced))[0]
 
-    conn = get_db()
-    cur = conn.cursor()
 
-    cur.execute(
+@asynccontextmanager
+async def pooled(stage: str):
+    # a pooled connection; the stage time includes the wait for it
+    with timed(stage):
+        async with app.state.pool.acquire() as conn:
+            yield conn
+
+
+def vector_literal(vector: list) -> str:
+    return "[" + ",".join(map(str, vector)) + "]"
+
+
+def vector_search_sql(quantization: str) -> str:
+    # $1 vector, $2 top_k, $3/$4 price range, $5 candidates of the quantized pass
+    where = "($3::float8 IS NULL OR price >= $3) AND ($4::float8 IS NULL OR price <= $4)"
+    if quantization not in QUANTIZED_DISTANCE:
+        return f"""
+            SELECT id, name, url, price, text, 1 - (embedding <=> $1::text::vector) AS score
+            FROM fosils_embeddings
+            WHERE {where}
+            ORDER BY embedding <=> $1::text::vector
+            LIMIT $2;
+            """
+    # the quantized index finds the candidates, the full vectors order them
+    return f"""
+        SELECT id, name, url, price, text, 1 - (embedding <=> $1::text::vector) AS score
+        FROM (
+            SELECT id, name, url, price, text, embedding
+            FROM fosils_embeddings
+            WHERE {where}
+            ORDER BY {QUANTIZED_DISTANCE[quantization]}
+            LIMIT $5
+        ) candidates
+        ORDER BY embedding <=> $1::text::vector
+        LIMIT $2;
         """
-        SELECT 
-            id,
-            name,
-            url,
-            price,
-            text,
-            1 - (embedding <=> %s::vector) AS score
-        FROM fosils_embeddings
-        ORDER BY embedding <=> %s::vector
-        LIMIT %s;
-        """,
-        (vector, vector, top_k)
+
+
+def rerank_candidates(top_k: int, oversample: int = None) -> int:
+    # rows the quantized pass hands to the re-ranking, top_k * oversample up to MAX_EF_SEARCH
+    oversample = RERANK_OVERSAMPLE if oversample is None else oversample
+    if isinstance(oversample, bool) or not isinstance(oversample, int) or oversample < 1:
+        raise ValueError("oversample must be a positive integer")
+    return max(top_k, min(top_k * oversample, MAX_EF_SEARCH))
+
+
+async def semantic_search(query: str, top_k: int = TOP_K, ef_search: int = None, probes: int = None,
+                          price_min: float = None, price_max: float = None, oversample: int = None):
+    if snapshot_index is not None:
+        vector = await embed(query)
+        with timed("vector_search"):
+            # numpy releases the GIL in the matmul, keep the event loop free meanwhile
+            return await asyncio.to_thread(snapshot_index.search, vector, top_k, price_min, price_max)
+
+    vector = vector_literal(await embed(query))
+    args = [vector, top_k, price_min, price_max]
+    candidates = top_k
+    if VECTOR_QUANTIZATION in QUANTIZED_DISTANCE:
+        candidates = rerank_candidates(top_k, oversample)
+        args.append(candidates)
+    # ef_search below the candidates would cut the result list short
+    ef_search = min(max(int(ef_search or HNSW_EF_SEARCH), candidates), MAX_EF_SEARCH)
+
+    async with pooled("vector_search") as conn:
+        async with conn.transaction():
+            # transaction scoped, the pooled connection keeps its defaults
+            await conn.execute(f"SET LOCAL hnsw.ef_search = {ef_search}")
+            await conn.execute(f"SET LOCAL ivfflat.probes = {int(probes or IVFFLAT_PROBES)}")
+            rows = await conn.fetch(
+                vector_search_sql(VECTOR_QUANTIZATION), *args
+            )
+
+    return [dict(r) for r in rows]
+
+
+async def lexical_search(query: str, top_k: int = TOP_K, price_min: float = None, price_max: float = None):
+    # trigram match on the name and on the best matching part of the text,
+    # both operators are served by the gin_trgm_ops indexes of the ingestor
+    async with pooled("lexical_search") as conn:
+        async with conn.transaction():
+            await conn.execute(f"SET LOCAL pg_trgm.similarity_threshold = {float(LEXICAL_THRESHOLD)}")
+            await conn.execute(f"SET LOCAL pg_trgm.word_similarity_threshold = {float(LEXICAL_THRESHOLD)}")
+            rows = await conn.fetch(
+                """
+                SELECT
+                    id,
+                    name,
+                    url,
+                    price,
+                    text,
+                    greatest(similarity(name, $1), word_similarity($1, text)) AS score
+                FROM fosils_embeddings
+                WHERE (name % $1 OR $1 <% text)
+                  AND ($3::float8 IS NULL OR price >= $3) AND ($4::float8 IS NULL OR price <= $4)
+                ORDER BY score DESC
+                LIMIT $2;
+                """,
+                query, top_k, price_min, price_max
+            )
+
+    return [dict(r) for r in rows]
+
+
+async def exact_search(structured: dict, top_k: int = TOP_K):
+    # id or url named in the query: plain index lookups, no embedding at all
+    if structured["id"]:
+        where, value = "id = $1 OR product_id = $1", structured["id"]
+    else:
+        where, value = "url = $1", structured["url"]
+    async with pooled("exact_search") as conn:
+        rows = await conn.fetch(
+            f"""
+            SELECT id, name, url, price, text, 1.0::float8 AS score
+            FROM fosils_embeddings
+            WHERE {where}
+            ORDER BY chunk_index
+            LIMIT $2;
+            """,
+            value, top_k
+        )
+    return [dict(r) for r in rows]
+
+
+async def hybrid_search(query: str, top_k: int = TOP_K, ef_search: int = None, probes: int = None,
+                        oversample: int = None):
+    structured = parse_structured(query)
+    if structured["id"] or structured["url"]:
+        rows = await exact_search(structured, top_k)
+        if rows:
+            return rows
+
+    # both legs look deeper than top_k, the fusion needs overlapping candidates
+    candidates = max(top_k, HYBRID_CANDIDATES)
+    price_min, price_max = structured["price_min"], structured["price_max"]
+    vector_rows, lexical_rows = await asyncio.gather(
+        semantic_search(query, candidates, ef_search, probes, price_min, price_max, oversample),
+        lexical_search(query, candidates, price_min, price_max)
     )
+    return rrf_fuse([vector_rows, lexical_rows], top_k, HYBRID_RRF_K)
+
+
+async def aggregate_search(aggregate: dict, top_k: int = TOP_K):
+    async with pooled("aggregate_search") as conn:
+        return await run_aggregate(conn, aggregate, top_k)
+
 
-    results = cur.fetchall()
-    conn.close()
+async def cached_search(query: str, top_k: int = TOP_K, ef_search: int = None, probes: int = None,
+                        mode: str = None, oversample: int = None):
+    mode = mode or RETRIEVAL_MODE
+    key = (EMBEDDING_MODEL, normalize_text(query), top_k, ef_search, probes, mode, oversample)
+    results = result_cache.get(key)
+    if results is None:
+        generation = result_cache.generation
+        if mode == "hybrid":
+            results = await hybrid_search(query, top_k, ef_search, probes, oversample)
+        else:
+            results = await semantic_search(query, top_k, ef_search, probes, oversample=oversample)
+        result_cache.put(key, results, generation)
     return results
 
 
+def build_messages(context: str, question: str) -> list:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {question}"}
+    ]
+
+
 async def generate_gpt_answer(context: str, question: str):
-    completion = client.chat.completions.create(
-        model=LLM_MODEL,
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {question}"}
-        ]
-    )
+    with timed("llm"):
+        completion = await client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=build_messages(context, question)
+        )
     return completion.choices[0].message.content
 
 
-@app.websocket("/ws")
-async def websocket_endpoint(ws: WebSocket):
-    await ws.accept()
+async def stream_gpt_answer(context: str, question: str):
+    stream = await client.chat.completions.create(
+        model=LLM_MODEL,
+        messages=build_messages(context, question),
+        stream=True
+    )
     try:
-        while True:
-            data = await ws.receive_text()
-            try:
-                msg = json.loads(data)
-                query = msg.get("query")
-                top_k = msg.get("top_k", TOP_K)
-                use_gpt = msg.get("gpt_answer", False)
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        # closes the upstream http response when the client cancels mid-stream
+        await stream.close()
+
+
+@registry.collector
+def collect_stats():
+    # the existing cache/pool counters, read at scrape time
+    embedding = embedding_cache.report()
+    results = result_cache.report()
+    coalesced = coalescer.report()
+    metrics = [
+        collected(Counter, "ws_embedding_cache_hits_total", "Query embedding cache hits", labels=("level",),
+                  series={("memory",): embedding["memory_hits"], ("disk",): embedding["disk_hits"]}),
+        collected(Counter, "ws_embedding_cache_misses_total", "Query embedding cache misses", embedding["misses"]),
+        collected(Counter, "ws_result_cache_hits_total", "Search result cache hits", results["hits"]),
+        collected(Counter, "ws_result_cache_misses_total", "Search result cache misses", results["misses"]),
+        collected(Counter, "ws_result_cache_invalidations_total", "Result cache drops on NOTIFY", results["invalidations"]),
+        collected(Gauge, "ws_result_cache_items", "Cached search results", results["size"]),
+        collected(Counter, "ws_embedding_requests_total", "Coalesced embeddings requests", coalesced["requests"]),
+        collected(Counter, "ws_embedding_texts_total", "Texts sent in coalesced embeddings requests", coalesced["texts"]),
+        collected(Counter, "ws_embedding_deduped_total", "Texts that joined a waiting or in-flight request", coalesced["deduped"])
+    ]
+    pool = getattr(app.state, "pool", None)
+    if pool is not None:
+        idle = pool.get_idle_size()
+        metrics.append(collected(Gauge, "ws_db_pool_connections", "Pooled database connections", labels=("state",),
+                                 series={("idle",): idle, ("busy",): pool.get_size() - idle}))
+        metrics.append(collected(Gauge, "ws_db_pool_max", "Pool size limit", pool.get_max_size()))
+    return metrics
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/stats")
+async def stats():
+    pool = app.state.pool
+    return {
+        "embedding_provider": provider.report(),
+        "embedding_cache": embedding_cache.report(),
+        "result_cache": result_cache.report(),
+        "embedding_coalescer": coalescer.report(),
+        "db_pool": {"size": pool.get_size(), "idle": pool.get_idle_size()}
+    }
+
+
+def prompt_report(context: str, question: str, route: str, stats: dict = None) -> dict:
+    tokens = sum(count_tokens(m["content"]) for m in build_messages(context, question))
+    prompt_tokens.observe(tokens, route=route)
+    return {**(stats or {}), "prompt_tokens": tokens}
+
+
+def timings_ms(timings: dict, t0: float) -> dict:
+    return {**{stage: round(s * 1000, 1) for stage, s in timings.items()},
+            "total": round((time.perf_counter() - t0) * 1000, 1)}
 
-                if not query:
-                    await ws.send_text(json.dumps({"error": "No query provided"}))
-                    continue
 
-                results = await semantic_search(query, top_k)
+async def handle_message(ws: WebSocket, data: str):
+    t0 = time.perf_counter()
+    # filled by timed() in the search/embed/llm calls of this task (and of
+    # the tasks it gathers, they share the dict)
+    timings = {}
+    request_timings.set(timings)
+    route, outcome = "invalid", "cancelled"
+    inflight_gauge.inc()
+    try:
+        msg = json.loads(data)
+        query = msg.get("query")
+        top_k = msg.get("top_k", TOP_K)
+        use_gpt = msg.get("gpt_answer", False)
+        want_timings = msg.get("timings", RESPONSE_TIMINGS)
 
-                response = {"results": results}
+        if not query:
+            outcome = "error"
+            await ws.send_text(json.dumps({"error": "No query provided"}))
+            return
 
-                if use_gpt:
+        aggregate = detect_aggregate(query) if AGGREGATE_ROUTING else None
+        answer, context_stats = None, None
+        if aggregate is not None:
+            route = "aggregate"
+            # the llm gets only the small aggregate result, or isn't called at all
+            aggregate = await aggregate_search(aggregate, top_k)
+            results = aggregate["products"]
+            with timed("context"):
+                context = json.dumps(aggregate, ensure_ascii=False)
+            if not AGGREGATE_LLM:
+                answer = format_answer(aggregate)
+        else:
+            route = msg.get("mode") or RETRIEVAL_MODE
+            results = await cached_search(
+                query, top_k, msg.get("ef_search"), msg.get("probes"), msg.get("mode"), msg.get("oversample")
+            )
+            with timed("context"):
+                if (msg.get("context") or CONTEXT_MODE) == "raw":
                     context = "\n\n".join([r["text"] for r in results])
-                    answer = await generate_gpt_answer(context, query)
-                    response["answer"] = answer
+                else:
+                    context, context_stats = build_context(results, count_tokens=count_tokens)
+        extra = {"aggregate": {k: v for k, v in aggregate.items() if k != "products"}} if aggregate is not None else {}
+        # size of what the llm gets, next to the timings
+        prompt = prompt_report(context, query, route, context_stats) if use_gpt and answer is None else None
+
+        if use_gpt and msg.get("stream", False):
+            # results first, then the answer as delta frames and a final done frame
+            with timed("serialize"):
+                frame = json.dumps({"type": "results", "results": results, **extra})
+            await ws.send_text(frame)
+            ttft = None
+            if answer is not None:
+                ttft = time.perf_counter() - t0
+                await ws.send_text(json.dumps({"type": "delta", "delta": answer}))
+            else:
+                llm_t0 = time.perf_counter()
+                async with aclosing(stream_gpt_answer(context, query)) as deltas:
+                    async for delta in deltas:
+                        if ttft is None:
+                            ttft = time.perf_counter() - t0
+                            record("llm_first_token", time.perf_counter() - llm_t0)
+                        await ws.send_text(json.dumps({"type": "delta", "delta": delta}))
+                # includes sending the deltas, the client's reading pace bounds it
+                record("llm", time.perf_counter() - llm_t0)
+            done = {
+                "type": "done",
+                "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+                "total_ms": round((time.perf_counter() - t0) * 1000, 1)
+            }
+            if want_timings:
+                done["timings"] = timings_ms(timings, t0)
+                if prompt is not None:
+                    done["context"] = prompt
+            await ws.send_text(json.dumps(done))
+            outcome = "ok"
+            return
+
+        response = {"results": results, **extra}
+
+        if use_gpt:
+            response["answer"] = answer if answer is not None else await generate_gpt_answer(context, query)
+        if want_timings and prompt is not None:
+            response["context"] = prompt
+
+        with timed("serialize"):
+            payload = json.dumps(response)
+        if want_timings:
+            # spliced into the serialized body, so the serialization is part of the timings
+            payload = payload[:-1] + ', "timings": ' + json.dumps(timings_ms(timings, t0)) + "}"
+        await ws.send_text(payload)
+        outcome = "ok"
+
+    except Exception as e:
+        outcome = "error"
+        await ws.send_text(json.dumps({"error": str(e)}))
+    finally:
+        inflight_gauge.dec()
+        queries_total.inc(route=route, outcome=outcome)
+        query_seconds.observe(time.perf_counter() - t0, route=route)
+
+
+def is_cancel(data: str) -> bool:
+    try:
+        msg = json.loads(data)
+    except ValueError:
+        return False
+    return isinstance(msg, dict) and bool(msg.get("cancel"))
 
-                await ws.send_text(json.dumps(response))
 
-            except Exception as e:
-                await ws.send_text(json.dumps({"error": str(e)}))
+async def query_worker(ws: WebSocket, queries: asyncio.Queue, state: dict):
+    # handles the queries of one connection in order; the current one runs as
+    # its own task so the reader can cancel it
+    while True:
+        data = await queries.get()
+        queued_gauge.dec()
+        task = asyncio.create_task(handle_message(ws, data))
+        state["current"] = task
+        try:
+            await asyncio.wait({task})
+        finally:
+            state["current"] = None
+            task.cancel()
+        if task.cancelled():
+            await ws.send_text(json.dumps({"type": "cancelled"}))
+
+
+@app.websocket("/ws")
+async def websocket_endpoint(ws: WebSocket):
+    await ws.accept()
+    connections_gauge.inc()
+    queries = asyncio.Queue()
+    state = {"current": None}
+    worker = asyncio.create_task(query_worker(ws, queries, state))
+    try:
+        while True:
+            data = await ws.receive_text()
+            if is_cancel(data):
+                if state["current"] is not None:
+                    state["current"].cancel()
+                continue
+            queries.put_nowait(data)
+            queued_gauge.inc()
     except WebSocketDisconnect:
         print("Client disconnected")
+    finally:
+        worker.cancel()
+        connections_gauge.dec()
+        queued_gauge.dec(queries.qsize())
@@ -0,0 +1,48 @@
+# routing cases of detect_aggregate: catalog-wide questions go to the
+# products view, questions about a subject (or the price of one) go to
+# retrieval (None).
+# runs offline, exits non-zero when a case is routed wrong.
+#
+#   python check_aggregates.py
+
+import sys
+from aggregates import detect_aggregate
+
+CASES = [
+    ("Колко продукта има?", "count"),
+    ("колко фосила има в каталога", "count"),
+    ("Колко артикула имате под 50 лв?", "count"),
+    ("how many products are there", "count"),
+    ("how many fossils do you sell", "count"),
+    ("Колко струва фосил на акула", None),
+    ("колко струва фосилът мегалодон", None),
+    ("Колко има амонити", None),
+    ("колко вида амонити има", None),
+    ("how many ammonites do you have", None),
+    ("how much does a trilobite cost", None),
+    ("Колко струва най-евтиния амонит", None),
+    ("най-скъпият мегалодон", None),
+    ("средна цена на амонитите", None),
+    ("Кой е най-евтиният фосил?", "cheapest"),
+    ("колко струва най-скъпият продукт", "most_expensive"),
+    ("средна цена на продуктите", "avg_price"),
+    ("what is the cheapest fossil under 100 лв", "cheapest"),
+    ("ценови диапазон на фосилите", "price_range"),
+    ("фосил на акула", None),
+]
+
+
+def main():
+    failed = 0
+    for query, expected in CASES:
+        aggregate = detect_aggregate(query)
+        intent = aggregate["intent"] if aggregate else None
+        ok = intent == expected
+        failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {query!r}: {intent} (expected {expected})")
+    print(f"{len(CASES) - failed}/{len(CASES)} routed as expected")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
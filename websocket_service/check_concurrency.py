@@ -0,0 +1,46 @@
+# opens N websocket clients at once, each sends one unique query (so the
+# embedding cache does not help) and waits for its answer.
+# overlap = sum of client latencies / wall time: ~N when the requests overlap
+# on the event loop, ~1 when they are serialized.
+#
+#   python check_concurrency.py --url ws://localhost:8000/ws --clients 20
+
+import json
+import time
+import asyncio
+import argparse
+import websockets
+
+
+async def one_client(url: str, query: str, gpt_answer: bool):
+    async with websockets.connect(url) as ws:
+        t0 = time.perf_counter()
+        await ws.send(json.dumps({"query": query, "gpt_answer": gpt_answer}))
+        msg = json.loads(await ws.recv())
+        return time.perf_counter() - t0, "error" in msg
+
+
+async def run(url: str, clients: int, query: str, gpt_answer: bool):
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*[one_client(url, f"{query} #{i}", gpt_answer) for i in range(clients)])
+    wall = time.perf_counter() - t0
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, error in results if error)
+    print(f"clients={clients} errors={errors} wall={wall:.3f}s")
+    print(f"latency min={latencies[0]:.3f}s median={latencies[len(latencies) // 2]:.3f}s max={latencies[-1]:.3f}s")
+    print(f"overlap={sum(latencies) / wall:.1f}x (serialized would be ~1x)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="ws://localhost:8000/ws")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--query", default="амонит")
+    parser.add_argument("--gpt-answer", action="store_true", dest="gpt_answer")
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.clients, args.query, args.gpt_answer))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import asyncio
+from collections import Counter
+
+
+class EmbeddingCoalescer:
+    # gathers the texts that arrive from all connections within `window_ms`
+    # (or until `max_batch` distinct texts are waiting) into one embeddings
+    # request and fans the vectors back out to the waiting coroutines.
+    # identical texts, waiting or already in flight, share one slot.
+
+    def __init__(self, embed_many, window_ms: float = 5.0, max_batch: int = 64):
+        self.embed_many = embed_many
+        self.window_s = window_ms / 1000
+        self.max_batch = max_batch
+        self.pending = {}
+        self.inflight = {}
+        self.flush_handle = None
+        self.tasks = set()
+        self.stats = {"requests": 0, "texts": 0, "deduped": 0, "batch_sizes": Counter()}
+
+    async def embed(self, text: str) -> list:
+        future = self.pending.get(text) or self.inflight.get(text)
+        if future is not None:
+            self.stats["deduped"] += 1
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.pending[text] = future
+            if len(self.pending) >= self.max_batch:
+                self.flush()
+            elif self.flush_handle is None:
+                self.flush_handle = loop.call_later(self.window_s, self.flush)
+        # a cancelled waiter must not cancel the slot other waiters share
+        return await asyncio.shield(future)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        self.inflight.update(batch)
+        task = asyncio.create_task(self.run_batch(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run_batch(self, batch: dict):
+        texts = list(batch)
+        self.stats["requests"] += 1
+        self.stats["texts"] += len(texts)
+        self.stats["batch_sizes"][len(texts)] += 1
+        try:
+            vectors = await self.embed_many(texts)
+            for text, vector in zip(texts, vectors):
+                if not batch[text].done():
+                    batch[text].set_result(vector)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+                    # mark retrieved, a waiter may have gone away meanwhile
+                    future.exception()
+        finally:
+            for text in texts:
+                if self.inflight.get(text) is batch[text]:
+                    del self.inflight[text]
+
+    def report(self) -> dict:
+        requests = self.stats["requests"]
+        return {
+            "window_ms": self.window_s * 1000,
+            "max_batch": self.max_batch,
+            "requests": requests,
+            "texts": self.stats["texts"],
+            "deduped": self.stats["deduped"],
+            "avg_batch_size": self.stats["texts"] / requests if requests else 0.0,
+            "batch_sizes": dict(sorted(self.stats["batch_sizes"].items()))
+        }
@@ -5,5 +5,34 @@ rag_configs = {
     "LLM_MODEL": "gpt-4o-mini",
     "OPEN_AI_API_KEY": os.getenv("OPEN_AI_API_KEY"),
     "TOP_K": 3,
-    "SYSTEM_PROMPT": "Answer the question concisely"
+    "SYSTEM_PROMPT": "Answer the question concisely",
+    # ANN search knobs, can be overridden per request with "ef_search"/"probes"
+    "HNSW_EF_SEARCH": int(os.getenv("HNSW_EF_SEARCH", "40")),
+    "IVFFLAT_PROBES": int(os.getenv("IVFFLAT_PROBES", "1")),
+    # quantized column of the ingestor searched first ("halfvec", "binary" or "none"),
+    # top_k * RERANK_OVERSAMPLE candidates re-ranked on the full vectors, per request with "oversample"
+    "VECTOR_QUANTIZATION": os.getenv("VECTOR_QUANTIZATION", "none").split(",")[0].strip(),
+    "RERANK_OVERSAMPLE": int(os.getenv("RERANK_OVERSAMPLE", "4")),
+    "RETRIEVAL_BACKEND": os.getenv("RETRIEVAL_BACKEND", "pgvector"),
+    # hybrid mode: candidates per leg, reciprocal rank fusion constant, pg_trgm match threshold
+    "RETRIEVAL_MODE": os.getenv("RETRIEVAL_MODE", "vector"),
+    "HYBRID_CANDIDATES": int(os.getenv("HYBRID_CANDIDATES", "20")),
+    "HYBRID_RRF_K": int(os.getenv("HYBRID_RRF_K", "60")),
+    "LEXICAL_THRESHOLD": float(os.getenv("LEXICAL_THRESHOLD", "0.3")),
+    "AGGREGATE_ROUTING": os.getenv("AGGREGATE_ROUTING", "1") == "1",
+    "AGGREGATE_LLM": os.getenv("AGGREGATE_LLM", "0") == "1",
+    # "compact": one header + budgeted passages per product (context_builder.py), "raw": every chunk text
+    "CONTEXT_MODE": os.getenv("CONTEXT_MODE", "compact"),
+    # per-stage milliseconds in every response (a request can ask with "timings": true)
+    "RESPONSE_TIMINGS": os.getenv("RESPONSE_TIMINGS", "0") == "1",
+    "PG_POOL_MIN": int(os.getenv("PG_POOL_MIN", "2")),
+    "PG_POOL_MAX": int(os.getenv("PG_POOL_MAX", "10")),
+    "QUERY_EMBEDDING_CACHE_SIZE": int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "10000")),
+    "RESULT_CACHE_TTL_S": float(os.getenv("RESULT_CACHE_TTL_S", "300")),
+    "RESULT_CACHE_SIZE": int(os.getenv("RESULT_CACHE_SIZE", "5000")),
+    # query embeddings arriving within the window are sent as one request
+    "EMBED_COALESCE_WINDOW_MS": float(os.getenv("EMBED_COALESCE_WINDOW_MS", "5")),
+    "EMBED_COALESCE_MAX_BATCH": int(os.getenv("EMBED_COALESCE_MAX_BATCH", "64")),
+    # the ingestor NOTIFYs this channel after every load that changed rows
+    "INVALIDATION_CHANNEL": os.getenv("INVALIDATION_CHANNEL", "fosils_embeddings_changed")
 }
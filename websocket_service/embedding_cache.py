@@ -0,0 +1,170 @@
+# content-addressed embedding cache shared by the ingestor, the websocket
+# service and the evaluator (the same file is copied into each service).
+#
+# key = sha256(model + normalized text). vectors live in one append-only
+# binary file per model under EMBEDDING_CACHE_DIR, every record is
+# [32 byte key][uint32 dim][dim x float32], with an in-memory LRU in front.
+# the LRU keeps float32 arrays (6 KB for 1536 dims instead of ~49 KB as a
+# list of floats), callers get lists.
+# other processes appending to the same file are picked up on a miss.
+
+import os
+import re
+import time
+import struct
+import hashlib
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional
+
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "/data/embedding_cache")
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+
+HEADER = struct.Struct("<32sI")
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text or "")).strip()
+
+
+class EmbeddingCache:
+    def __init__(self, model: str, cache_dir: str = EMBEDDING_CACHE_DIR, max_items: int = EMBEDDING_CACHE_SIZE):
+        self.model = model
+        self.max_items = max_items
+        self.memory = OrderedDict()
+        self.offsets = {}
+        self.scanned = 0
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "hit_chars": 0, "miss_seconds": 0.0}
+        self.path = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model)
+            self.path = os.path.join(cache_dir, f"{slug}.f32bin")
+            open(self.path, "ab").close()
+            self.scan()
+
+    def key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self.model}\0{normalize_text(text)}".encode("utf-8")).digest()
+
+    def scan(self):
+        # index records appended since the last scan (by us or other processes)
+        size = os.path.getsize(self.path)
+        if size <= self.scanned:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.scanned)
+            offset = self.scanned
+            while offset + HEADER.size <= size:
+                key, dim = HEADER.unpack(f.read(HEADER.size))
+                end = offset + HEADER.size + dim * 4
+                if end > size:
+                    break
+                self.offsets[key] = (offset + HEADER.size, dim)
+                f.seek(end)
+                offset = end
+        self.scanned = offset
+
+    def remember(self, key: bytes, vector: array):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def read(self, key: bytes) -> Optional[array]:
+        location = self.offsets.get(key)
+        if location is None:
+            return None
+        offset, dim = location
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            raw = os.pread(fd, dim * 4, offset)
+        finally:
+            os.close(fd)
+        return array("f", raw)
+
+    def get(self, text: str) -> Optional[list]:
+        key = self.key(text)
+        with self.lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                self.stats["hit_chars"] += len(text)
+                return vector.tolist()
+            if self.path is None:
+                return None
+            if key not in self.offsets:
+                self.scan()
+            vector = self.read(key)
+            if vector is not None:
+                self.remember(key, vector)
+                self.stats["disk_hits"] += 1
+                self.stats["hit_chars"] += len(text)
+                return vector.tolist()
+            return None
+
+    def put(self, text: str, vector: list):
+        key = self.key(text)
+        packed = array("f", vector)
+        with self.lock:
+            self.remember(key, packed)
+            if self.path is None or key in self.offsets:
+                return
+            data = packed.tobytes()
+            # header + data in a single append so concurrent writers never interleave
+            with open(self.path, "ab") as f:
+                f.write(HEADER.pack(key, len(vector)) + data)
+
+    def lookup(self, texts: List[str]):
+        # cached vectors (None for misses) and the deduplicated missing texts
+        vectors = [self.get(t) for t in texts]
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+        return vectors, missing
+
+    def fill(self, texts: List[str], vectors: List[list], missing: List[str], fresh: List[list], seconds: float):
+        with self.lock:
+            self.stats["misses"] += len(missing)
+            self.stats["miss_seconds"] += seconds
+        fresh = dict(zip(missing, fresh))
+        for text, vector in fresh.items():
+            self.put(text, vector)
+        return [v if v is not None else fresh[t] for t, v in zip(texts, vectors)]
+
+    def embed_many(self, texts: List[str], embed_fn: Callable[[List[str]], List[list]]) -> List[list]:
+        # returns vectors for texts, only the (deduplicated) misses go to embed_fn
+        vectors, missing = self.lookup(texts)
+        if not missing:
+            return vectors
+        t0 = time.perf_counter()
+        fresh = embed_fn(missing)
+        return self.fill(texts, vectors, missing, fresh, time.perf_counter() - t0)
+
+    async def aembed_many(self, texts: List[str], embed_fn: Callable[[List[str]], Awaitable[List[list]]]) -> List[list]:
+        # embed_many for a coroutine embed_fn
+        vectors, missing = self.lookup(texts)
+        if not missing:
+            return vectors
+        t0 = time.perf_counter()
+        fresh = await embed_fn(missing)
+        return self.fill(texts, vectors, missing, fresh, time.perf_counter() - t0)
+
+    def report(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        lookups = hits + stats["misses"]
+        avg_miss = stats["miss_seconds"] / stats["misses"] if stats["misses"] else 0.0
+        return {
+            "model": self.model,
+            "memory_hits": stats["memory_hits"],
+            "disk_hits": stats["disk_hits"],
+            "misses": stats["misses"],
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "avg_miss_latency_s": avg_miss,
+            # requests we did not have to make, priced at the observed miss latency
+            "est_saved_s": hits * avg_miss,
+            "est_saved_tokens": stats["hit_chars"] // 2
+        }
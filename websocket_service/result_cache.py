@@ -0,0 +1,51 @@
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    # search results keyed by (model, normalized query, top_k, ...) with a TTL
+    # and a size bound. invalidate() drops everything and bumps the generation,
+    # so a search that started before the invalidation can't store stale rows.
+
+    def __init__(self, ttl_s: float = 300.0, max_items: int = 5000):
+        self.ttl_s = ttl_s
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.generation = 0
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "invalidations": 0}
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            self.stats["misses"] += 1
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self.items[key]
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+        self.items.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+
+    def put(self, key, value, generation: int = None):
+        if generation is not None and generation != self.generation:
+            return
+        self.items[key] = (time.monotonic() + self.ttl_s, value)
+        self.items.move_to_end(key)
+        if len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def invalidate(self):
+        self.items.clear()
+        self.generation += 1
+        self.stats["invalidations"] += 1
+
+    def report(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "size": len(self.items),
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0
+        }
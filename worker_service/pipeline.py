@@ -0,0 +1,352 @@
+# long-running refresh worker: the scraper, the processor and the ingestor
+# of the other services run as overlapping stages connected by bounded
+# queues, so the first changed products are embedded and in the table while
+# the crawl is still going, instead of scrape -> process -> ingest one after
+# the other on the whole catalogue.
+#
+#   scrape (crawl pool) -> raw paths -> process (threads) -> entries
+#       -> embed (batches of WORKER_INGEST_BATCH products) -> records -> load
+#
+# a full queue blocks the stage feeding it (backpressure), so a slow
+# embeddings api throttles the crawl instead of piling up memory. every
+# batch is committed on its own; a cycle interrupted by a crash is resumed
+# at the next start, the crawl manifest skips the pages it already fetched
+# and the content hashes in the table skip the products it already loaded.
+
+import os
+import sys
+import json
+import time
+import queue
+import threading
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for service in ("scraper_service", "data_processing_service", "data_ingestion_service"):
+    sys.path.insert(0, os.path.join(ROOT, service))
+
+from fosil_scraper import FosilScraper
+from processor import DataProcessor
+from ingestor import DataIngestor, product_hash, INGEST_MODE, INGEST_DELETE_MISSING, LEXICAL_INDEX
+
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "256"))
+WORKER_PROCESS_THREADS = int(os.getenv("WORKER_PROCESS_THREADS", "2"))
+# products per embeddings + load batch, and how long the embed stage waits
+# for more before it sends a smaller one
+WORKER_INGEST_BATCH = int(os.getenv("WORKER_INGEST_BATCH", "64"))
+WORKER_FLUSH_S = float(os.getenv("WORKER_FLUSH_S", "2"))
+WORKER_INTERVAL_S = float(os.getenv("WORKER_INTERVAL_S", "21600"))
+WORKER_RETRY_S = float(os.getenv("WORKER_RETRY_S", "600"))
+WORKER_CHECKPOINT = os.getenv("WORKER_CHECKPOINT", "/data/worker_checkpoint.json")
+# crawled pages between two saves of the crawl manifest and the checkpoint
+WORKER_CHECKPOINT_EVERY = int(os.getenv("WORKER_CHECKPOINT_EVERY", "100"))
+WORKER_STATS_INTERVAL_S = float(os.getenv("WORKER_STATS_INTERVAL_S", "30"))
+WORKER_ONCE = os.getenv("WORKER_ONCE", "0") == "1"
+
+STAGES = ("scrape", "process", "embed", "load")
+STOP = object()
+
+
+class Aborted(Exception):
+    # another stage failed, unwinds the blocked ones
+    pass
+
+
+class PipelineWorker:
+    def __init__(self, checkpoint_path: str = WORKER_CHECKPOINT):
+        self.scraper = FosilScraper()
+        self.processor = DataProcessor(raw_dir=self.scraper.OUTPUT_DIR)
+        self.ingestor = DataIngestor(processed_dir=self.processor.processed_dir)
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = self.load_checkpoint()
+        self.lock = threading.Lock()
+
+    # -- checkpoint --
+
+    def load_checkpoint(self) -> dict:
+        if not os.path.exists(self.checkpoint_path):
+            return {"cycle": 0, "in_progress": False}
+        with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_checkpoint(self, **fields):
+        # written atomically, under the lock since the crawl threads save too
+        os.makedirs(os.path.dirname(self.checkpoint_path) or ".", exist_ok=True)
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with self.lock:
+            self.checkpoint.update(fields)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.checkpoint, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.checkpoint_path)
+
+    def next_due(self) -> float:
+        # a failed cycle is retried later, one interrupted by a crash is resumed at once
+        started, completed, failed = (self.checkpoint.get(k, 0) for k in ("started_at", "completed_at", "failed_at"))
+        if failed and failed >= started and failed > completed:
+            return failed + WORKER_RETRY_S
+        if self.checkpoint.get("in_progress") or not completed:
+            return time.time()
+        return completed + WORKER_INTERVAL_S
+
+    # -- stage plumbing --
+
+    def add(self, stage: str, key: str, value: float = 1):
+        with self.lock:
+            self.stats[stage][key] += value
+
+    def put(self, stage: str, q: queue.Queue, item):
+        # blocks while the next stage is behind; the wait is the stage's blocked time
+        t0 = time.perf_counter()
+        while True:
+            if self.abort.is_set():
+                raise Aborted()
+            try:
+                q.put(item, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+        self.add(stage, "blocked_s", time.perf_counter() - t0)
+
+    def get(self, stage: str, q: queue.Queue, timeout: float = None):
+        # -> next item, or None when nothing arrived within timeout
+        t0 = time.perf_counter()
+        item = None
+        while True:
+            if self.abort.is_set():
+                raise Aborted()
+            try:
+                item = q.get(timeout=0.5)
+                break
+            except queue.Empty:
+                if timeout is not None and time.perf_counter() - t0 >= timeout:
+                    break
+        self.add(stage, "idle_s", time.perf_counter() - t0)
+        return item
+
+    def run_stage(self, stage: str, fn, threads: int = 1):
+        t0 = time.perf_counter()
+        try:
+            fn()
+        except Aborted:
+            pass
+        except Exception as e:
+            print(f"ERROR: {stage} stage failed: {e}")
+            with self.lock:
+                self.error = self.error or e
+            self.abort.set()
+        finally:
+            self.add(stage, "thread_s", (time.perf_counter() - t0) * threads)
+
+    # -- stages --
+
+    def scrape_stage(self):
+        scraper = self.scraper
+        entries = scraper.get_fosili_entries()
+        lastmods = {e["loc"]: e["lastmod"] for e in entries}
+        os.makedirs(scraper.OUTPUT_DIR, exist_ok=True)
+        enqueued, crawled = set(), [0]
+
+        def emit(path: str):
+            with self.lock:
+                if path in enqueued:
+                    return
+                enqueued.add(path)
+            self.put("scrape", self.raw_queue, path)
+            self.add("scrape", "items")
+
+        def handle(url: str) -> str:
+            if self.abort.is_set():
+                raise Aborted()
+            status = scraper.scrape_product(url, lastmods[url])
+            product_id = scraper.manifest.get(url).get("id")
+            path = os.path.join(scraper.OUTPUT_DIR, f"{product_id}.json")
+            # unchanged pages still go through, the ingestor needs every
+            # product of the cycle to know which ones disappeared
+            if status != "failed" and product_id is not None and os.path.exists(path):
+                emit(path)
+            with self.lock:
+                crawled[0] += 1
+                due = crawled[0] % WORKER_CHECKPOINT_EVERY == 0
+            if due:
+                scraper.manifest.save()
+                self.save_checkpoint(crawled=crawled[0], pages=len(lastmods))
+            return status
+
+        try:
+            self.crawl_stats = scraper.crawl(lastmods.keys(), handle)
+        finally:
+            scraper.manifest.save()
+        if self.abort.is_set():
+            raise Aborted()
+        # pages gone from the sitemap lose their raw and processed files, so
+        # they are not emitted below and the end of the cycle deletes them
+        self.crawl_stats["removed"] = scraper.prune_removed(lastmods)
+        scraper.manifest.save()
+        names = sorted(name for name in os.listdir(scraper.OUTPUT_DIR) if name.endswith(".json"))
+        self.processor.prune_processed({name[:-len(".json")] for name in names})
+        # raw files of the pages that failed this time, like a full processor
+        # run sees them; their products are kept until the files are removed
+        for name in names:
+            emit(os.path.join(scraper.OUTPUT_DIR, name))
+        for _ in range(WORKER_PROCESS_THREADS):
+            self.put("scrape", self.raw_queue, STOP)
+
+    def process_stage(self):
+        while True:
+            path = self.get("process", self.raw_queue)
+            if path is STOP:
+                break
+            try:
+                processed = self.processor.process_file(path, verbose=False)
+            except Exception as e:
+                # the product stays in the table, but no stale deletions this cycle
+                print(f"ERROR: processing {path}: {e}")
+                self.add("process", "errors")
+                continue
+            entry = (str(processed["id"]), product_hash(processed), len(processed.get("chunks", [])), processed)
+            self.add("process", "items")
+            self.put("process", self.entry_queue, entry)
+        with self.lock:
+            self.processing -= 1
+            last = self.processing == 0
+        if last:
+            self.put("process", self.entry_queue, STOP)
+
+    def embed_stage(self):
+        def entries():
+            while True:
+                entry = self.get("embed", self.entry_queue, timeout=WORKER_FLUSH_S)
+                if entry is STOP:
+                    return
+                if entry is not None:
+                    self.add("embed", "items")
+                yield entry
+
+        batches = self.ingestor.iter_record_batches(
+            entries(), self.existing, self.chunk_counts, self.seen, per_batch=WORKER_INGEST_BATCH
+        )
+        for records in batches:
+            self.put("embed", self.record_queue, records)
+        self.put("embed", self.record_queue, STOP)
+
+    def load_stage(self):
+        while True:
+            records = self.get("load", self.record_queue)
+            if records is STOP:
+                break
+            if INGEST_MODE == "insert":
+                self.ingestor.write_records(records)
+                rows = len(records)
+            else:
+                rows, _ = self.ingestor.loader.load([records])
+            # the chunks past the new count of these products, right away
+            counts = Counter(r["product_id"] for r in records)
+            deleted = self.ingestor.delete_stale(dict(counts))
+            self.ingestor.notify_changed(rows, deleted)
+            self.add("load", "items", len(counts))
+            self.add("load", "rows", rows)
+            self.add("load", "deleted", deleted)
+
+    # -- cycle --
+
+    def report(self, wall_s: float) -> dict:
+        with self.lock:
+            stats = {stage: dict(values) for stage, values in self.stats.items()}
+        for values in stats.values():
+            busy = max(0.0, values["thread_s"] - values["idle_s"] - values["blocked_s"])
+            values["busy_s"] = round(busy, 3)
+            values["items_per_s"] = round(values["items"] / wall_s, 2) if wall_s else 0.0
+            # what the stage could do if it never waited
+            values["capacity_per_s"] = round(values["items"] / busy, 2) if busy else None
+            for key in ("thread_s", "idle_s", "blocked_s"):
+                values[key] = round(values[key], 3)
+        return stats
+
+    def print_progress(self, t0: float):
+        stats = self.report(time.perf_counter() - t0)
+        print(
+            f"[cycle {self.checkpoint['cycle']}] "
+            + " ".join(f"{stage}={stats[stage]['items']}" for stage in STAGES)
+            + f" queues raw={self.raw_queue.qsize()} entries={self.entry_queue.qsize()} "
+            f"records={self.record_queue.qsize()}"
+        )
+
+    def run_cycle(self) -> dict:
+        cycle = self.checkpoint.get("cycle", 0) + (0 if self.checkpoint.get("in_progress") else 1)
+        self.save_checkpoint(cycle=cycle, in_progress=True, started_at=time.time())
+        print(f"Starting cycle {cycle}")
+
+        self.abort, self.error = threading.Event(), None
+        self.raw_queue = queue.Queue(WORKER_QUEUE_SIZE)
+        self.entry_queue = queue.Queue(WORKER_QUEUE_SIZE)
+        self.record_queue = queue.Queue(max(1, WORKER_QUEUE_SIZE // WORKER_INGEST_BATCH))
+        self.stats = {stage: Counter(items=0, thread_s=0.0, idle_s=0.0, blocked_s=0.0) for stage in STAGES}
+        self.existing = self.ingestor.existing_products()
+        self.chunk_counts, self.seen = {}, set()
+        self.processing = WORKER_PROCESS_THREADS
+        self.crawl_stats = {}
+
+        threads = [threading.Thread(
+            target=self.run_stage, args=("scrape", self.scrape_stage, self.scraper.concurrency), daemon=True
+        )]
+        threads += [
+            threading.Thread(target=self.run_stage, args=("process", self.process_stage), daemon=True)
+            for _ in range(WORKER_PROCESS_THREADS)
+        ]
+        threads += [
+            threading.Thread(target=self.run_stage, args=("embed", self.embed_stage), daemon=True),
+            threading.Thread(target=self.run_stage, args=("load", self.load_stage), daemon=True)
+        ]
+        t0 = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(WORKER_STATS_INTERVAL_S)
+                if thread.is_alive():
+                    self.print_progress(t0)
+        if self.error is not None:
+            raise self.error
+
+        # what a full ingestor run does at the end: drop the products that are
+        # gone, keep the indexes, publish the changes
+        complete = not self.stats["process"]["errors"] and INGEST_DELETE_MISSING
+        deleted = self.ingestor.delete_stale(self.chunk_counts, self.seen if complete else None)
+        self.ingestor.ensure_vector_index()
+        if LEXICAL_INDEX:
+            self.ingestor.ensure_lexical_index()
+        rows = self.stats["load"]["rows"]
+        self.ingestor.publish_changes(rows, deleted + self.stats["load"]["deleted"])
+
+        wall = time.perf_counter() - t0
+        summary = {
+            "cycle": cycle,
+            "wall_s": round(wall, 3),
+            "products": len(self.seen),
+            "changed": len(self.chunk_counts),
+            "rows": rows,
+            "deleted": deleted + self.stats["load"]["deleted"],
+            "crawl": self.crawl_stats,
+            "stages": self.report(wall),
+            "embedding_cache": self.ingestor.cache.report()
+        }
+        self.save_checkpoint(in_progress=False, completed_at=time.time(), last_cycle=summary)
+        print(f"Cycle {cycle} finished: {json.dumps(summary)}")
+        return summary
+
+    def run(self):
+        while True:
+            wait = self.next_due() - time.time()
+            if wait > 0:
+                print(f"Next refresh in {wait:.0f}s")
+                time.sleep(wait)
+            try:
+                self.run_cycle()
+            except Exception as e:
+                # stays in progress, the retry keeps the cycle number
+                self.save_checkpoint(failed_at=time.time(), error=str(e))
+                if WORKER_ONCE:
+                    raise
+                print(f"Cycle failed, retrying in {WORKER_RETRY_S:.0f}s: {e}")
+            if WORKER_ONCE:
+                return
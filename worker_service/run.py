@@ -0,0 +1,5 @@
+from pipeline import PipelineWorker
+
+if __name__ == "__main__":
+    worker = PipelineWorker()
+    worker.run()